@@ -0,0 +1,211 @@
+"""
+Admission control for generation requests.
+
+Every generation runs in its own CadQuery process, so the number of concurrent jobs is
+bounded (sized to the cores and memory of the container), excess requests wait in a
+bounded queue, and anything beyond that is rejected immediately with a Retry-After hint.
+Waiting requests are granted slots round-robin per client so one client flooding the
+queue cannot starve the others.
+
+Configuration (environment):
+    ADMISSION_MAX_CONCURRENT  concurrent generation jobs (default: from cores and memory)
+    ADMISSION_JOB_MEMORY_MB   memory budget per job used for the default (default: 1024)
+    ADMISSION_MAX_QUEUE       requests allowed to wait for a slot (default: 4 x concurrency)
+    ADMISSION_MAX_PER_CLIENT  running + waiting requests per client (default: 4)
+    ADMISSION_QUEUE_TIMEOUT   seconds a request may wait for a slot (default: 30)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from cancellation import Cancelled
+
+# How often a queued request checks whether it was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request cannot be admitted.
+    status is the HTTP status to answer with (429 per-client limit, 503 server full).
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def memory_limit_mb():
+    """Memory available to this container in MB (cgroup limit if set, else host RAM), or None."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value != "max" and int(value) < 1 << 60:
+                return int(value) / (1024 * 1024)
+        except (OSError, ValueError):
+            pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def default_concurrency(job_memory_mb=1024):
+    limit = os.cpu_count() or 1
+    memory = memory_limit_mb()
+    if memory:
+        limit = min(limit, int(memory // job_memory_mb))
+    return max(1, limit)
+
+
+class _Ticket:
+    __slots__ = ("client", "granted")
+
+    def __init__(self, client):
+        self.client = client
+        self.granted = False
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent, max_queue, max_per_client=4, queue_timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting = OrderedDict()  # client -> deque of tickets, in round-robin order
+        self._waiting_count = 0
+        self._per_client = {}  # client -> running + waiting
+        self._avg_duration = 5.0
+
+        self.admitted = 0
+        self.rejected_client = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        job_memory = int(env.get("ADMISSION_JOB_MEMORY_MB", 1024))
+        max_concurrent = int(env.get("ADMISSION_MAX_CONCURRENT", 0)) or default_concurrency(job_memory)
+        return cls(
+            max_concurrent=max_concurrent,
+            max_queue=int(env.get("ADMISSION_MAX_QUEUE", 4 * max_concurrent)),
+            max_per_client=int(env.get("ADMISSION_MAX_PER_CLIENT", 4)),
+            queue_timeout=float(env.get("ADMISSION_QUEUE_TIMEOUT", 30)),
+        )
+
+    def retry_after(self):
+        """Rough seconds until a slot frees up, from the average job time and the backlog."""
+        backlog = self._waiting_count / self.max_concurrent + 1
+        return max(1, int(round(self._avg_duration * backlog)))
+
+    def acquire(self, client, cancel=None):
+        """
+        Take a slot for client, waiting in the queue if necessary.
+        A queued request gives up its place once the optional cancel token is set.
+        """
+        with self._cond:
+            if self._per_client.get(client, 0) >= self.max_per_client:
+                self.rejected_client += 1
+                raise AdmissionRejected("Too many concurrent requests from this client", 429, self.retry_after())
+
+            if self._running < self.max_concurrent and not self._waiting_count:
+                self._running += 1
+                self._per_client[client] = self._per_client.get(client, 0) + 1
+                self.admitted += 1
+                return
+
+            if self._waiting_count >= self.max_queue:
+                self.rejected_full += 1
+                raise AdmissionRejected("Server is busy, please retry", 503, self.retry_after())
+
+            ticket = _Ticket(client)
+            self._waiting.setdefault(client, deque()).append(ticket)
+            self._waiting_count += 1
+            self._per_client[client] = self._per_client.get(client, 0) + 1
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                    break
+                self._cond.wait(min(remaining, CANCEL_POLL_INTERVAL) if cancel is not None else remaining)
+
+            if not ticket.granted:
+                self._waiting[client].remove(ticket)
+                if not self._waiting[client]:
+                    del self._waiting[client]
+                self._waiting_count -= 1
+                self._decrement_client(client)
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled(cancel.reason)
+                self.rejected_timeout += 1
+                raise AdmissionRejected("Timed out waiting for a free generation slot", 503, self.retry_after())
+            self.admitted += 1
+
+    def release(self, client, duration=None):
+        with self._cond:
+            self._running -= 1
+            self._decrement_client(client)
+            if duration is not None:
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+            self._grant()
+
+    def _decrement_client(self, client):
+        count = self._per_client.get(client, 0) - 1
+        if count > 0:
+            self._per_client[client] = count
+        else:
+            self._per_client.pop(client, None)
+
+    def _grant(self):
+        # Round-robin across clients: take the first ticket of the client at the head,
+        # then move that client to the back of the rotation.
+        granted = False
+        while self._running < self.max_concurrent and self._waiting:
+            client, tickets = next(iter(self._waiting.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting.move_to_end(client)
+            else:
+                del self._waiting[client]
+            self._waiting_count -= 1
+            self._running += 1
+            ticket.granted = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, client):
+        self.acquire(client)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(client, time.monotonic() - start)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "waiting": self._waiting_count,
+                "clients": len(self._per_client),
+                "admitted": self.admitted,
+                "rejected_client": self.rejected_client,
+                "rejected_full": self.rejected_full,
+                "rejected_timeout": self.rejected_timeout,
+            }
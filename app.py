@@ -1,22 +1,45 @@
-from flask import Flask, render_template, request, send_file, jsonify, after_this_request
+from flask import Flask, render_template, request, send_file, jsonify, after_this_request, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import tempfile
 import json
 import uuid
 import logging
-import logging_loki
+import re
+import functools
+import hmac
+import time
+import threading
+import multiprocessing
 from dotenv import load_dotenv
-from generation_utils import (
-    GeometryValidationError, GenerationError,
-    generate_box_task, generate_baseplate_task, generate_lid_task,
-    generate_gear_task, generate_hinge_task, generate_tube_adapter_task
-)
+from generators import TASKS, GeometryValidationError, GenerationError, MESH_LODS, lod_path
+from params import InvalidParams, configure_params
+from feasibility import checked_params
+import task_runner
 from task_runner import run_task_with_timeout
+from loki_logging import configure_loki_logging
+import tracing
+import profiling
+import stage_cache
+from admission import AdmissionRejected
+from scheduler import Scheduler
+from coalescing import Coalescer, flight_key, share_file
+from cancellation import CancelToken, Cancelled, PreviewSessions
+from live_preview import LivePreviewPool
+from mesh_cache import MeshCache, LODS, mesh_key
+from failure_cache import FailureCache
+from cache_backends import HashRing
+from job_queue import queue_from_env
+from worker import Worker, output_files
 
 load_dotenv()
 
 app = Flask(__name__)
 
+# Number of reverse proxies in front of the app whose X-Forwarded-For can be trusted
+if int(os.environ.get('TRUSTED_PROXIES', 0)):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ['TRUSTED_PROXIES']))
+
 # Configure logging
 handler = logging.FileHandler('errors.log')
 handler.setLevel(logging.WARNING)
@@ -25,17 +48,124 @@ handler.setFormatter(formatter)
 app.logger.addHandler(handler)
 app.logger.setLevel(logging.WARNING)
 
-# Configure the Loki Handler
-handler = logging_loki.LokiHandler(
-    url="http://192.168.1.223:3100/loki/api/v1/push",
-    tags={"application": "opengridgen"},
-    version="1",
-)
-
-# Add the handler to the Flask logger
-app.logger.addHandler(handler)
+# Ship logs to Loki (if LOKI_URL is set) from a background thread so requests never wait on it
+loki_shipper = configure_loki_logging(app.logger)
 app.logger.setLevel(logging.INFO)
 
+# Request tracing (TRACING_EXPORTER=file|otlp), off by default
+tracing.configure_tracing()
+
+# Opt-in profiling of generation tasks (X-Profile header, admin switch or PROFILE_SAMPLE_RATE)
+profiling.configure_profiling()
+
+# Per-worker shape cache (STAGE_CACHE_ENTRIES), backed by the shared shape store when SHAPE_STORE_DIR is set
+stage_cache.configure_stage_cache()
+
+# Rounding of float parameters (PARAM_QUANTUM), so near-identical requests share caches
+configure_params()
+
+# Worker start method (WORKER_START_METHOD, forkserver by default) and a background self-test
+# of how long starting a worker takes, which then renders a default box end to end to warm
+# the worker pool; /readyz fails until it did. A failed attempt is retried with backoff, so
+# a transient failure does not keep the replica out of the load balancer for good.
+# WORKER_SELF_TEST=0 skips both
+worker_self_test = {"start_method": task_runner.mp_context().get_start_method(),
+                    "warm": os.environ.get('WORKER_SELF_TEST', '1') == '0'}
+SELF_TEST_RETRY_SECONDS = 5.0
+SELF_TEST_MAX_RETRY_SECONDS = 300.0
+
+def run_worker_self_test(run=task_runner.run_task_with_timeout, wait=time.sleep):
+    # run is bound here, so replacing run_task_with_timeout later (e.g. a fake) leaves the warm-up alone
+    delay = SELF_TEST_RETRY_SECONDS
+    while True:
+        try:
+            _warm_up(run)
+            return
+        except Exception as e:
+            worker_self_test["error"] = str(e)
+            app.logger.warning("Worker self-test failed, retrying in %.0f s: %s", delay, e)
+        wait(delay)
+        delay = min(2 * delay, SELF_TEST_MAX_RETRY_SECONDS)
+
+def _warm_up(run):
+    worker_self_test.update(task_runner.self_test())
+    app.logger.info("Worker self-test: %s", json.dumps(worker_self_test))
+    output_path = os.path.join(tempfile.gettempdir(), f"warmup_{uuid.uuid4().hex}.stl")
+    start = time.monotonic()
+    try:
+        run(TASKS['box'], kwargs={'params': checked_params('box', {}), 'settings': dict(SETTINGS),
+                                  'output_path': output_path, 'format': 'stl'}, timeout=300)
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    worker_self_test.pop("error", None)
+    worker_self_test.update(warm=True, warmup_seconds=round(time.monotonic() - start, 3))
+    app.logger.info("Worker pool warm: rendered a box in %.1f s", worker_self_test["warmup_seconds"])
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+def admin_required(view):
+    """
+    Protect admin endpoints with the X-Admin-Token header. They stay closed until ADMIN_TOKEN is set.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"success": False, "error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+@app.before_request
+def assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex
+    if request.path.startswith('/api/') and profiling.should_profile(request.headers):
+        # Not the client's X-Request-ID: the id names the profile's files and must not collide
+        g.profile_id = uuid.uuid4().hex
+        g.profile_token = profiling.activate(g.profile_id)
+
+@app.before_request
+def start_request_span():
+    span = tracing.start_span(
+        f"{request.method} {request.path}",
+        {"http.method": request.method, "http.target": request.path,
+         "http.route": request.url_rule.rule if request.url_rule else request.path},
+        traceparent=request.headers.get('traceparent')
+    )
+    g.trace_span = span
+    g.trace_token = tracing.activate(span)
+
+@app.after_request
+def tag_request_span(response):
+    span = g.get('trace_span')
+    if span:
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.set_error(f"HTTP {response.status_code}")
+        response.headers['X-Trace-Id'] = span.trace_id
+    response.headers['X-Request-ID'] = g.request_id
+    if g.get('profiled'):
+        response.headers['X-Profile-Id'] = g.profile_id
+    if g.get('failure_cached'):
+        response.headers['X-Failure-Cached'] = '1'
+    if g.get('artifact_key') and cache_ring:
+        response.headers['X-Cache-Node'] = cache_ring.node_for(g.artifact_key)
+    return response
+
+@app.teardown_request
+def end_request_span(exc):
+    span = g.pop('trace_span', None)
+    if span:
+        tracing.deactivate(g.pop('trace_token'))
+        span.end()
+    token = g.pop('profile_token', None)
+    if token:
+        profiling.deactivate(token)
+        profiling.prune_profiles()
+
 def send_and_remove(filepath, **kwargs):
     @after_this_request
     def remove_file(response):
@@ -44,7 +174,8 @@ def send_and_remove(filepath, **kwargs):
         except Exception as error:
             app.logger.error(f"Error removing or closing downloaded file handle: {error}")
         return response
-    return send_file(filepath, **kwargs)
+    with tracing.span("send_file"):
+        return send_file(filepath, **kwargs)
 
 # Global settings (simplified for single-user local tool)
 SETTINGS = {
@@ -73,84 +204,411 @@ def settings():
         return render_template('settings.html', settings=SETTINGS, message="Settings updated!")
     return render_template('settings.html', settings=SETTINGS)
 
-@app.route('/api/generate_box_info', methods=['POST'])
-def generate_box_info():
+def limit_arg(default=50):
+    """The ?limit= of an admin listing, or None when it is not a positive integer."""
+    value = request.args.get('limit', '').strip() or str(default)
+    return int(value) if value.isdigit() and int(value) > 0 else None
+
+@app.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    limit = limit_arg()
+    if limit is None:
+        return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+    profiles = profiling.list_profiles(limit=limit)
+    for p in profiles:
+        p['files'] = {fmt: f"/admin/profiles/{p['id']}.{fmt}" for fmt in profiling.PROFILE_FORMATS}
+    return jsonify({"success": True, "profiling": profiling.PROFILING, "profiles": profiles})
+
+@app.route('/admin/profiles/<profile_id>.<fmt>')
+@admin_required
+def admin_profile_file(profile_id, fmt):
+    path = profiling.profile_path(profile_id, fmt)
+    if path is None:
+        return jsonify({"success": False, "error": "Profile not found"}), 404
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}.{fmt}")
+
+@app.route('/admin/profiling', methods=['POST'])
+@admin_required
+def admin_profiling():
+    data = request.json or {}
+    rate = data.get('sample_rate', 0)
+    if isinstance(rate, bool) or not (isinstance(rate, int) or isinstance(rate, str) and rate.strip().isdigit()):
+        return jsonify({"success": False, "error": "sample_rate must be a non-negative integer"}), 400
+    if 'enabled' in data:
+        profiling.PROFILING['enabled'] = bool(data['enabled'])
+    if 'sample_rate' in data:
+        profiling.PROFILING['sample_rate'] = max(0, int(rate))
+    return jsonify({"success": True, "profiling": profiling.PROFILING})
+
+# Cost-aware lanes with bounded concurrency and per-client fairness in front of the generation processes
+scheduler = Scheduler.from_env()
+coalescer = Coalescer()
+preview_sessions = PreviewSessions()
+live_previews = LivePreviewPool.from_env()
+mesh_cache = MeshCache.from_env()
+failures = FailureCache.from_env()
+# Replica that should serve each part (CACHE_NODES), named in X-Cache-Node
+cache_ring = HashRing.from_env()
+# Worker daemons on other machines run the generations (JOB_QUEUE, see worker.py)
+job_queue = queue_from_env()
+# Workers in this process (JOB_LOCAL_WORKERS), which also resume the jobs queued before a restart
+local_workers = None
+if job_queue is not None and int(os.environ.get('JOB_LOCAL_WORKERS', 0)) > 0 and multiprocessing.parent_process() is None:
+    local_workers = Worker(job_queue, mesh_cache, concurrency=int(os.environ['JOB_LOCAL_WORKERS']))
+    local_workers.start(daemon=True)
+# Queued jobs run on the workers' CPUs, not this host's: they are admitted to slots of their
+# own (JOB_QUEUE_SLOTS). The local slots only bound generations run in this process
+job_scheduler = Scheduler.from_env(total=int(os.environ.get('JOB_QUEUE_SLOTS', 32)), cost_model=scheduler.costs)
+
+# Only in the server process: worker processes import this module too when they load tasks
+if os.environ.get('WORKER_SELF_TEST', '1') != '0' and multiprocessing.parent_process() is None:
+    threading.Thread(target=run_worker_self_test, name="worker-self-test", daemon=True).start()
+
+def client_id():
+    """
+    Identify the client for per-client fairness. Behind a reverse proxy set TRUSTED_PROXIES
+    so remote_addr is the real client rather than the proxy.
+    """
+    return request.remote_addr or 'unknown'
+
+def run_generation(name, task, params, kind, output_path=None, format=None, lods=()):
+    """
+    Run a generation task in a worker process once the scheduler admits it to its lane.
+    The timeout scales with the job's estimated cost. Identical concurrent requests share
+    one generation, which is cancelled when every client waiting for it disconnects or,
+    for previews, sends a newer preview from the same X-Preview-Session. Live previews
+    (X-Live-Preview: 1) run on the session's warm worker. A part that recently failed
+    validation or timed out fails again right away with the remembered error.
+    """
+    failure_key = flight_key(name, params, SETTINGS)
+    remembered = failures.get(failure_key, kind)
+    if remembered is not None:
+        g.failure_cached = True
+        raise remembered
+    key = flight_key(name, params, SETTINGS, format)
+    cancel = CancelToken(request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket'),
+                         request.environ.get('opengridgen.disconnected'))
+    session = request.headers.get('X-Preview-Session') if kind == 'preview' else None
+    if session:
+        preview_sessions.begin(session, cancel)
+    live_session = session if session and request.headers.get('X-Live-Preview') == '1' else None
     try:
-        data = request.json
-        dims = run_task_with_timeout(
-            generate_box_task,
-            kwargs={'params': data, 'settings': SETTINGS},
-            timeout=30
-        )
-        return jsonify({"success": True, "dimensions": dims})
-    except TimeoutError:
+        with tracing.span("coalesce", {"generator": name, "coalesce.leader": False}) as span:
+            def lead(flight_cancel):
+                span.set_attribute("coalesce.leader", True)
+                try:
+                    return _generate(name, task, params, kind, output_path, format, flight_cancel, live_session, lods)
+                except Exception as e:
+                    failures.record(failure_key, name, params, e, kind)
+                    raise
+            return coalescer.run(key, lead, output_path, cancel)
+    finally:
+        if session:
+            preview_sessions.end(session, cancel)
+
+def admission_lanes():
+    """The lanes generations are admitted to: this host's and, with JOB_QUEUE, those of queued jobs."""
+    lanes = dict(scheduler.lanes)
+    if job_queue is not None:
+        lanes.update({f"queued_{name}": lane for name, lane in job_scheduler.lanes.items()})
+    return lanes
+
+def _generate(name, task, params, kind, output_path, format, cancel, live_session=None, lods=()):
+    # Live previews run in this process (on a warm worker, or a one-shot one when none is free)
+    queued = job_queue is not None and live_session is None
+    slots = job_scheduler if queued else scheduler
+    job = slots.plan(name, params, kind)
+    with tracing.span("admission.wait", {"client": client_id(), "queued": queued, **job.attributes()}):
+        slots.acquire(job, client_id(), cancel)
+    start = time.monotonic()
+    # Only generations that succeed say how long the job takes: failures stop early, timeouts
+    # and cancellations at an arbitrary point
+    duration = None
+    try:
+        # Only once admitted: a worker taken before the wait could be handed over or stopped meanwhile
+        worker = live_previews.worker_for(live_session) if live_session else None
+        kwargs = {'params': params, 'settings': SETTINGS}
+        if output_path:
+            kwargs.update(output_path=output_path, format=format)
+        if lods:
+            kwargs['lods'] = list(lods)
+        if queued:
+            # Queued jobs count from when a worker started them
+            dims, duration = _generate_on_worker(name, task, params, kwargs, job.timeout, cancel)
+            return dims
+        # The task runs under this request's profile; coalesced followers and cached answers have none
+        g.profiled = 'profile_id' in g
+        dims = run_task_with_timeout(task, kwargs=kwargs, timeout=job.timeout, cancel=cancel, worker=worker)
+        # Warm runs skip start-up and reuse cached stages: they say nothing about a cold job
+        if worker is None:
+            duration = time.monotonic() - start
+        return dims
+    finally:
+        slots.release(job, client_id(), duration)
+
+def _generate_on_worker(name, task, params, kwargs, timeout, cancel):
+    """
+    Run a generation on a worker daemon: submit it to the job queue, wait for the result
+    and copy the files the worker uploaded to the artifact store to the output paths.
+    Returns the dimensions and the seconds the job ran on its worker.
+    """
+    output_path = kwargs.pop('output_path', None)
+    key = mesh_key(name, params, SETTINGS)
+    kwargs = dict(kwargs, params=dict(params), artifact_key=key)
+    with tracing.span("job_queue.run", {"generator": name}):
+        # Keyed by the artifact, so resubmitting the part from any web process joins the job
+        job_key = ":".join([key, kwargs.get('format', 'info'), *kwargs.get('lods', ())])
+        job = job_queue.run_job(task, kwargs, timeout, cancel, key=job_key)
+    for variant, path in output_files(output_path, kwargs.get('format'), kwargs.get('lods', ())).items():
+        cached = mesh_cache.get(key, variant)
+        if cached is None:
+            raise GenerationError(f"The {variant} file of the job is not in the artifact store")
+        share_file(cached[0], path)
+    return job.result, job.finished - job.started
+
+def json_error(e):
+    """
+    Map a generation failure to the JSON error response used by the info and preview endpoints.
+    """
+    if isinstance(e, InvalidParams):
+        app.logger.info(f"Invalid parameters ({e.status}): {e}")
+        return jsonify({"success": False, "error": str(e), "errors": e.errors}), e.status
+    if isinstance(e, AdmissionRejected):
+        app.logger.warning(f"Admission rejected ({e.status}): {e}")
+        response = jsonify({"success": False, "error": str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, e.status
+    if isinstance(e, Cancelled):
+        app.logger.info(f"Generation cancelled: {e.reason}")
+        return jsonify({"success": False, "error": str(e)}), e.status
+    if isinstance(e, TimeoutError):
         app.logger.error("Generation timed out")
         return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
+    if isinstance(e, GeometryValidationError):
         app.logger.warning(f"Geometry validation error: {e}")
         return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    app.logger.error(f"Unexpected error: {e}", exc_info=True)
+    return jsonify({"success": False, "error": str(e)}), 500
+
+def text_error(e):
+    """
+    Map a generation failure to the plain text error response used by the download endpoints.
+    """
+    if isinstance(e, InvalidParams):
+        app.logger.info(f"Invalid parameters ({e.status}): {e}")
+        return str(e), e.status
+    if isinstance(e, AdmissionRejected):
+        app.logger.warning(f"Admission rejected ({e.status}): {e}")
+        return str(e), e.status, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, Cancelled):
+        app.logger.info(f"Generation cancelled: {e.reason}")
+        return str(e), e.status
+    if isinstance(e, TimeoutError):
+        app.logger.error("Generation timed out")
+        return "Generation timed out", 408
+    if isinstance(e, GeometryValidationError):
+        app.logger.warning(f"Geometry validation error: {e}")
+        return str(e), 422
+    app.logger.error(f"Unexpected error: {e}", exc_info=True)
+    return str(e), 500
 
-@app.route('/api/preview_box', methods=['POST'])
-def preview_box():
+def info_response(name, task, data):
+    try:
+        dims = run_generation(name, task, checked_params(name, data), 'info')
+        return jsonify({"success": True, "dimensions": dims})
+    except Exception as e:
+        return json_error(e)
+
+def preview_response(name, task, data):
+    """
+    STL preview of a part. With ?lod=coarse|medium|fine one generation writes the mesh at
+    every level of detail into the mesh cache and the response names the cache entry
+    (X-Mesh-Key), so the viewer can fetch the finer levels from /api/mesh/ afterwards;
+    repeated previews are served from the cache.
+    """
+    lod = request.args.get('lod')
+    if lod is not None and lod not in LODS:
+        return jsonify({"success": False, "error": f"Unknown level of detail: {lod}"}), 400
     try:
-        data = request.json
-        filename = f"preview_box_{uuid.uuid4()}.stl"
+        params = checked_params(name, data)
+        key = g.artifact_key = mesh_key(name, params, SETTINGS)
+        unchanged = not_modified(key, lod or 'fine')
+        if unchanged:
+            return unchanged
+        progressive = lod is not None and mesh_cache.enabled
+        cached = mesh_cache.get(key, lod) if progressive else None
+        if cached:
+            path, dims = cached
+            return mesh_headers(send_artifact(path, key, lod), dims, key, lod)
+
+        filename = f"preview_{name}_{uuid.uuid4()}.stl"
         filepath = os.path.join(tempfile.gettempdir(), filename)
+        if not progressive:
+            dims = run_generation(name, task, params, 'preview', output_path=filepath, format='stl')
+            response = send_and_remove(filepath, mimetype='model/stl', etag=artifact_etag(key, 'fine'))
+            return mesh_headers(response, dims)
+
+        # Unless another replica is generating the same part: then wait for its meshes
+        with mesh_cache.lease(key) as waited:
+            cached = mesh_cache.get(key, lod) if waited else None
+            if cached:
+                path, dims = cached
+                return mesh_headers(send_artifact(path, key, lod), dims, key, lod)
+            lods = list(MESH_LODS)
+            dims = run_generation(name, task, params, 'preview', output_path=filepath, format='stl', lods=lods)
+            # A request that shared another one's generation only has the fine mesh
+            meshes = {l: lod_path(filepath, l) for l in lods if os.path.exists(lod_path(filepath, l))}
+            meshes['fine'] = filepath
+            mesh_cache.put(key, meshes, dims)
+        lod = lod if lod in meshes else 'fine'
+        served = meshes.pop(lod)
+        for path in meshes.values():
+            os.remove(path)
+        response = send_and_remove(served, mimetype='model/stl', etag=artifact_etag(key, lod))
+        response.headers['Content-Location'] = artifact_url(key, lod)
+        return mesh_headers(response, dims, key, lod)
+    except Exception as e:
+        return json_error(e)
+
+def mesh_headers(response, dims, key=None, lod=None):
+    response.headers['X-Dimensions'] = json.dumps(dims)
+    if key:
+        response.headers['X-Mesh-Key'] = key
+        response.headers['X-Mesh-Lod'] = lod
+        response.headers['X-Mesh-Lods'] = ','.join(LODS)
+    return response
+
+# Generated files are a pure function of (generator, params, settings, variant), so the
+# mesh key doubles as their ETag and their address under /artifacts/. Responses to GET
+# requests for a key never change and may be cached for ARTIFACT_MAX_AGE seconds.
+ARTIFACT_MAX_AGE = int(os.environ.get('ARTIFACT_MAX_AGE', 365 * 24 * 3600))
+ARTIFACT_FORMATS = {'stl': 'fine', 'step': 'step'}  # download format: artifact variant
+ARTIFACT_NAME_RE = re.compile(r'^(?P<key>[0-9a-f]{64})(?:\.(?P<lod>coarse|medium|fine))?\.(?P<ext>stl|step)$')
+
+def artifact_etag(key, variant):
+    return f"{key}.{variant}"
+
+def artifact_url(key, variant):
+    if variant == 'step':
+        return f"/artifacts/{key}.step"
+    return f"/artifacts/{key}.stl" if variant == 'fine' else f"/artifacts/{key}.{variant}.stl"
+
+def not_modified(key, variant):
+    """
+    The response when the client already has this artifact (If-None-Match), else None:
+    304 for GET and HEAD, and 412 Precondition Failed for the POST previews and downloads
+    (RFC 9110, 13.1.2). Answered before anything is generated or read, since the ETag
+    follows from the request.
+    """
+    etag = artifact_etag(key, variant)
+    if not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304 if request.method in ('GET', 'HEAD') else 412)
+    response.set_etag(etag)
+    return response
+
+def send_artifact(path, key, variant, **kwargs):
+    """Serve a cached artifact; GET responses can be cached by browsers, proxies and CDNs."""
+    mimetype = 'model/step' if variant == 'step' else 'model/stl'
+    with tracing.span("send_file"):
+        if request.method != 'GET':
+            response = send_file(path, mimetype=mimetype, etag=artifact_etag(key, variant), **kwargs)
+            response.headers['Content-Location'] = artifact_url(key, variant)
+            return response
+        response = send_file(path, mimetype=mimetype, etag=artifact_etag(key, variant), max_age=ARTIFACT_MAX_AGE, **kwargs)
+    response.cache_control.immutable = True
+    return response
+
+def artifact_not_found():
+    response = jsonify({"success": False, "error": "Not cached"})
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 404
+
+@app.route('/api/mesh/<key>/<lod>')
+def preview_mesh(key, lod):
+    """A level of detail of a cached preview mesh (see preview_response)."""
+    g.artifact_key = key
+    try:
+        cached = mesh_cache.get(key, lod) if lod in LODS else None
+    except ValueError:
+        cached = None
+    if not cached:
+        return artifact_not_found()
+    path, dims = cached
+    return mesh_headers(send_artifact(path, key, lod), dims, key, lod)
+
+@app.route('/artifacts/<name>')
+def artifact(name):
+    """
+    A generated file by its address: <key>.stl, <key>.<lod>.stl or <key>.step, with the key
+    from X-Mesh-Key or Content-Location. 404 until generated and once evicted from the cache.
+    """
+    match = ARTIFACT_NAME_RE.match(name)
+    if not match or (match['ext'] == 'step' and match['lod']):
+        return artifact_not_found()
+    g.artifact_key = match['key']
+    variant = match['lod'] or ARTIFACT_FORMATS[match['ext']]
+    cached = mesh_cache.get(match['key'], variant)
+    if not cached:
+        return artifact_not_found()
+    path, dims = cached
+    return mesh_headers(send_artifact(path, match['key'], variant), dims)
+
+def download_response(name, task, params, format_type, user_filename):
+    variant = ARTIFACT_FORMATS.get(format_type)
+    if variant is None:
+        return f"Unsupported format: {format_type}", 400
+    try:
+        key = g.artifact_key = mesh_key(name, params, SETTINGS)
+        unchanged = not_modified(key, variant)
+        if unchanged:
+            return unchanged
+        cached = mesh_cache.get(key, variant) if mesh_cache.enabled else None
+        if cached:
+            return send_artifact(cached[0], key, variant, as_attachment=True, download_name=user_filename)
+
+        disk_filename = f"download_{name}_{uuid.uuid4()}.{format_type}"
+        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
 
-        dims = run_task_with_timeout(
-            generate_box_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
+        if not mesh_cache.enabled:
+            run_generation(name, task, params, 'download', output_path=filepath, format=format_type)
+            return send_and_remove(filepath, as_attachment=True, download_name=user_filename,
+                                   etag=artifact_etag(key, variant))
+
+        # Unless another replica is generating the same part: then wait for its file
+        with mesh_cache.lease(key) as waited:
+            cached = mesh_cache.get(key, variant) if waited else None
+            if cached:
+                return send_artifact(cached[0], key, variant, as_attachment=True, download_name=user_filename)
+            dims = run_generation(name, task, params, 'download', output_path=filepath, format=format_type)
+            mesh_cache.put(key, {variant: filepath}, dims)
+        response = send_and_remove(filepath, as_attachment=True, download_name=user_filename,
+                                   etag=artifact_etag(key, variant))
+        response.headers['Content-Location'] = artifact_url(key, variant)
         return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+        return text_error(e)
+
+@app.route('/api/generate_box_info', methods=['POST'])
+def generate_box_info():
+    return info_response('box', TASKS['box'], request.json)
+
+@app.route('/api/preview_box', methods=['POST'])
+def preview_box():
+    return preview_response('box', TASKS['box'], request.json)
 
 @app.route('/api/download_box', methods=['POST'])
 def download_box():
     try:
         # Form data handling
-        params = {
-            'width': int(request.form.get('width', 1)),
-            'length': int(request.form.get('length', 1)),
-            'height': int(request.form.get('height', 1)),
-            'solid': request.form.get('solid') == 'true'
-        }
+        params = checked_params('box', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"box_{params['width']}x{params['length']}x{params['height']}.{format_type}"
-        disk_filename = f"download_box_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_box_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=60
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"box_{params['width']}x{params['length']}x{params['height']}.{format_type}"
+    return download_response('box', TASKS['box'], params, format_type, user_filename)
 
 @app.route('/lid')
 def lid():
@@ -158,141 +616,37 @@ def lid():
 
 @app.route('/api/preview_lid', methods=['POST'])
 def preview_lid():
-    try:
-        data = request.json
-        filename = f"preview_lid_{uuid.uuid4()}.stl"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-
-        dims = run_task_with_timeout(
-            generate_lid_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
-        return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return preview_response('lid', TASKS['lid'], request.json)
 
 @app.route('/api/download_lid', methods=['POST'])
 def download_lid():
     try:
-        params = {
-            'width': int(request.form.get('width', 1)),
-            'length': int(request.form.get('length', 1)),
-            'height': float(request.form.get('height', 0.5)),
-            'handle_style': request.form.get('handle_style', 'none'),
-            'handle_height': float(request.form.get('handle_height', 5.0))
-        }
+        params = checked_params('lid', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"lid_{params['width']}x{params['length']}.{format_type}"
-        disk_filename = f"download_lid_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_lid_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=60
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"lid_{params['width']}x{params['length']}.{format_type}"
+    return download_response('lid', TASKS['lid'], params, format_type, user_filename)
 
 @app.route('/api/generate_baseplate_info', methods=['POST'])
 def generate_baseplate_info():
-    try:
-        data = request.json
-        dims = run_task_with_timeout(
-            generate_baseplate_task,
-            kwargs={'params': data, 'settings': SETTINGS},
-            timeout=30
-        )
-        return jsonify({"success": True, "dimensions": dims})
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return info_response('baseplate', TASKS['baseplate'], request.json)
 
 @app.route('/api/preview_baseplate', methods=['POST'])
 def preview_baseplate():
-    try:
-        data = request.json
-        filename = f"preview_baseplate_{uuid.uuid4()}.stl"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-
-        dims = run_task_with_timeout(
-            generate_baseplate_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
-        return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return preview_response('baseplate', TASKS['baseplate'], request.json)
 
 @app.route('/api/download_baseplate', methods=['POST'])
 def download_baseplate():
     try:
-        params = {
-            'width': int(request.form.get('width', 1)),
-            'length': int(request.form.get('length', 1)),
-            'padding_width': float(request.form.get('padding_width', 0)),
-            'padding_length': float(request.form.get('padding_length', 0)),
-            'corner_screws': request.form.get('corner_screws') == 'true'
-        }
+        params = checked_params('baseplate', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"baseplate_{params['width']}x{params['length']}.{format_type}"
-        disk_filename = f"download_baseplate_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_baseplate_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=60
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"baseplate_{params['width']}x{params['length']}.{format_type}"
+    return download_response('baseplate', TASKS['baseplate'], params, format_type, user_filename)
 
 @app.route('/gear')
 def gear():
@@ -308,189 +662,122 @@ def tube_adapter():
 
 @app.route('/api/preview_gear', methods=['POST'])
 def preview_gear():
-    try:
-        data = request.json
-        filename = f"preview_gear_{uuid.uuid4()}.stl"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-
-        dims = run_task_with_timeout(
-            generate_gear_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
-        return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return preview_response('gear', TASKS['gear'], request.json)
 
 @app.route('/api/download_gear', methods=['POST'])
 def download_gear():
     try:
-        params = {
-            'teeth': int(request.form.get('teeth', 20)),
-            'module': float(request.form.get('module', 1.0)),
-            'width': float(request.form.get('width', 5.0)),
-            'bore_d': float(request.form.get('bore_d', 5.0)),
-            'pressure_angle': float(request.form.get('pressure_angle', 20.0)),
-            'shaft_type': request.form.get('shaft_type', 'circle'),
-            'helix_angle': float(request.form.get('helix_angle', 0.0)),
-            'gear_type': request.form.get('gear_type', 'spur'),
-            'backlash': float(request.form.get('backlash', 0.0))
-        }
+        params = checked_params('gear', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"gear_m{params['module']}_z{params['teeth']}.{format_type}"
-        disk_filename = f"download_gear_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_gear_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=120
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"gear_m{params['module']}_z{params['teeth']}.{format_type}"
+    return download_response('gear', TASKS['gear'], params, format_type, user_filename)
 
 @app.route('/api/preview_tube_adapter', methods=['POST'])
 def preview_tube_adapter():
-    try:
-        data = request.json
-        filename = f"preview_tube_adapter_{uuid.uuid4()}.stl"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-
-        dims = run_task_with_timeout(
-            generate_tube_adapter_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
-        return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return preview_response('tube_adapter', TASKS['tube_adapter'], request.json)
 
 @app.route('/api/download_tube_adapter', methods=['POST'])
 def download_tube_adapter():
     try:
-        params = {
-            'side_a_id': float(request.form.get('side_a_id', 4.0)),
-            'side_a_od': float(request.form.get('side_a_od', 6.0)),
-            'side_a_barb': request.form.get('side_a_barb') == 'true',
-            'side_b_id': float(request.form.get('side_b_id', 4.0)),
-            'side_b_od': float(request.form.get('side_b_od', 6.0)),
-            'side_b_barb': request.form.get('side_b_barb') == 'true',
-            'length': float(request.form.get('length', 30.0)),
-            'num_barbs': int(request.form.get('num_barbs', 3)),
-            'barb_height_percentage': float(request.form.get('barb_height_percentage', 10.0)),
-            'barb_width': float(request.form.get('barb_width', 2.0))
-        }
+        params = checked_params('tube_adapter', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"adapter_a{params['side_a_od']}_b{params['side_b_od']}.{format_type}"
-        disk_filename = f"download_tube_adapter_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_tube_adapter_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=60
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"adapter_a{params['side_a_od']}_b{params['side_b_od']}.{format_type}"
+    return download_response('tube_adapter', TASKS['tube_adapter'], params, format_type, user_filename)
 
 @app.route('/api/preview_hinge', methods=['POST'])
 def preview_hinge():
-    try:
-        data = request.json
-        filename = f"preview_hinge_{uuid.uuid4()}.stl"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-
-        dims = run_task_with_timeout(
-            generate_hinge_task,
-            kwargs={'params': data, 'settings': SETTINGS, 'output_path': filepath, 'format': 'stl'},
-            timeout=60
-        )
-
-        response = send_and_remove(filepath, mimetype='model/stl')
-        response.headers['X-Dimensions'] = json.dumps(dims)
-        return response
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return jsonify({"success": False, "error": "Generation timed out"}), 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return jsonify({"success": False, "error": str(e)}), 500
+    return preview_response('hinge', TASKS['hinge'], request.json)
 
 @app.route('/api/download_hinge', methods=['POST'])
 def download_hinge():
     try:
-        params = {
-            'length': float(request.form.get('length', 40.0)),
-            'width': float(request.form.get('width', 40.0)),
-            'height': float(request.form.get('height', 5.0)),
-            'pin_diam': float(request.form.get('pin_diam', 3.0)),
-            'clearance': float(request.form.get('clearance', 0.4))
-        }
+        params = checked_params('hinge', request.form)
         format_type = request.form.get('format', 'step').lower()
-
-        user_filename = f"hinge_{params['length']}x{params['width']}.{format_type}"
-        disk_filename = f"download_hinge_{uuid.uuid4()}.{format_type}"
-        filepath = os.path.join(tempfile.gettempdir(), disk_filename)
-
-        run_task_with_timeout(
-            generate_hinge_task,
-            kwargs={'params': params, 'settings': SETTINGS, 'output_path': filepath, 'format': format_type},
-            timeout=60
-        )
-
-        return send_and_remove(filepath, as_attachment=True, download_name=user_filename)
-    except TimeoutError:
-        app.logger.error("Generation timed out")
-        return "Generation timed out", 408
-    except GeometryValidationError as e:
-        app.logger.warning(f"Geometry validation error: {e}")
-        return str(e), 422
     except Exception as e:
-        app.logger.error(f"Unexpected error: {e}", exc_info=True)
-        return str(e), 500
+        return text_error(e)
+
+    user_filename = f"hinge_{params['length']}x{params['width']}.{format_type}"
+    return download_response('hinge', TASKS['hinge'], params, format_type, user_filename)
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the web process answers requests."""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness: 200 once the worker pool is warm (a box was rendered end to end, see
+    run_worker_self_test) and while new generations can still be admitted, else 503. The
+    body reports the load, so a load balancer can also weigh replicas by it.
+    """
+    lanes = {name: lane.stats() for name, lane in admission_lanes().items()}
+    checks = {"warm": bool(worker_self_test.get("warm")) and "error" not in worker_self_test,
+              # Every queue full: new generations would be turned away with 503
+              "capacity": any(lane["running"] < lane["max_concurrent"] or lane["waiting"] < lane["max_queue"]
+                              for lane in lanes.values())}
+    report = {
+        "queue_depth": sum(lane["waiting"] for lane in lanes.values()),
+        "busy_workers": sum(lane["running"] for lane in lanes.values()),
+        "workers": sum(lane["max_concurrent"] for lane in lanes.values()),
+        "live_preview_workers": live_previews.stats()["busy"],
+        "warmup_seconds": worker_self_test.get("warmup_seconds"),
+        "error": worker_self_test.get("error"),
+    }
+    if job_queue is not None:
+        try:
+            jobs = job_queue.stats()
+            report["jobs_queued"] = jobs.get("queued", 0)
+            checks["job_queue"] = True
+        except Exception as e:
+            app.logger.warning(f"Job queue unavailable: {e}")
+            checks["job_queue"] = False
+    cache = mesh_cache.stats()
+    report["cache"] = {"enabled": mesh_cache.enabled, "entries": cache["entries"], "bytes": cache["bytes"],
+                       "max_bytes": cache["max_bytes"], "shared": cache["shared"]["backend"] if cache["shared"] else None}
+    ready = all(checks.values())
+    return jsonify({"ready": ready, "checks": checks, **report}), 200 if ready else 503
+
+@app.route('/admin/scheduler')
+@admin_required
+def admin_scheduler():
+    return jsonify({"success": True, "scheduler": scheduler.stats(),
+                    "job_scheduler": job_scheduler.stats() if job_queue is not None else None,
+                    "coalescing": coalescer.stats(),
+                    "live_preview": live_previews.stats(),
+                    "shape_store": stage_cache.STAGES.store.stats() if stage_cache.STAGES.store else None,
+                    "mesh_cache": mesh_cache.stats(), "workers": worker_self_test,
+                    "job_queue": job_queue.stats() if job_queue is not None else None,
+                    "local_workers": local_workers.stats() if local_workers is not None else None})
+
+@app.route('/admin/jobs')
+@admin_required
+def admin_jobs():
+    """The latest jobs of the job queue (see job_queue.py), with their params, timings, worker and artifact."""
+    if job_queue is None:
+        return jsonify({"success": False, "error": "No job queue configured (JOB_QUEUE)"}), 404
+    limit = limit_arg()
+    if limit is None:
+        return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+    jobs = job_queue.recent(limit=limit)
+    return jsonify({"success": True, "stats": job_queue.stats(), "jobs": [job.as_dict() for job in jobs]})
+
+@app.route('/admin/failures', methods=['GET', 'DELETE'])
+@admin_required
+def admin_failures():
+    """Parameter sets that fail most often (see failure_cache.py); DELETE forgets them, e.g. after a fix."""
+    limit = limit_arg()
+    if limit is None:
+        return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+    if request.method == 'DELETE':
+        failures.clear()
+    return jsonify({"success": True, "stats": failures.stats(), "failures": failures.top(limit=limit)})
 
 if __name__ == '__main__':
     app.run(debug=True, port=4242)
@@ -0,0 +1,236 @@
+"""
+ASGI serving mode: uvicorn asgi:application
+
+Serves the Flask app (same routes, templates and behaviour) from an event loop, so an
+open connection costs a coroutine rather than a thread. Request bodies are read and
+responses written by the event loop, files (previews, downloads, artifacts) are streamed
+from it in chunks read by worker threads, and a request only takes a thread from a bounded pool while the app handles it.
+Generation requests (POST /api/preview_*, /api/download_*, /api/generate_*) have their
+own pool, sized to the generation slots, so hundreds of clients waiting for one cost
+nothing but their connection, and pages, meshes and artifacts are never stuck behind
+them. A client that disconnects while waiting for a thread is dropped without running
+its request; one that disconnects later cancels its generation (see cancellation.py).
+Beyond ASGI_MAX_WAITING waiting generation requests, new ones get 503 with Retry-After.
+
+Configuration (environment):
+    ASGI_THREADS             threads handling requests other than generations (default: 16)
+    ASGI_GENERATION_THREADS  threads handling generation requests (default: twice the
+                             generation slots, see scheduler.py)
+    ASGI_MAX_WAITING         generation requests waiting for a thread (default: 1000)
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import admission_lanes, app
+
+GENERATION_PATH = re.compile(r'^/api/(preview|download|generate)_')
+FILE_CHUNK = 256 * 1024
+RETRY_AFTER = 5
+
+
+class FileWrapper:
+    """wsgi.file_wrapper: lets the event loop stream the files send_file answers with."""
+
+    def __init__(self, file, buffer_size=FILE_CHUNK):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        while chunk := self.file.read(self.buffer_size):
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class _Pool:
+    def __init__(self, threads, name, max_waiting=None):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+        self.threads = threads
+        self.max_waiting = max_waiting
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.busy = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def count(self, **changes):
+        with self._lock:
+            for name, change in changes.items():
+                setattr(self, name, getattr(self, name) + change)
+
+    def stats(self):
+        with self._lock:
+            return {"threads": self.threads, "busy": self.busy, "waiting": self.waiting,
+                    "dropped": self.dropped, "rejected": self.rejected}
+
+
+class ASGIApp:
+    """Runs a WSGI app for an ASGI server, handling requests in bounded thread pools."""
+
+    def __init__(self, wsgi_app, threads=16, generation_threads=8, max_waiting=1000):
+        self.wsgi_app = wsgi_app
+        self.pools = {
+            "default": _Pool(threads, "asgi"),
+            "generation": _Pool(generation_threads, "asgi-generation", max_waiting),
+        }
+
+    @classmethod
+    def from_env(cls, wsgi_app, env=None):
+        env = os.environ if env is None else env
+        slots = sum(lane.max_concurrent for lane in admission_lanes().values())
+        return cls(wsgi_app, threads=int(env.get("ASGI_THREADS", 16)),
+                   generation_threads=int(env.get("ASGI_GENERATION_THREADS", 0)) or max(4, 2 * slots),
+                   max_waiting=int(env.get("ASGI_MAX_WAITING", 1000)))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for pool in self.pools.values():
+                    pool.executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = io.BytesIO()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.write(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body.seek(0)
+
+        generation = scope["method"] == "POST" and GENERATION_PATH.match(scope["path"])
+        pool = self.pools["generation" if generation else "default"]
+        if pool.max_waiting is not None and pool.waiting >= pool.max_waiting:
+            pool.count(rejected=1)
+            await self._send_busy(send)
+            return
+
+        disconnected = threading.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        environ = self._environ(scope, body, disconnected)
+        pool.count(waiting=1)
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(
+                pool.executor, self._run, pool, environ, disconnected)
+            if response is not None:
+                await self._send_response(send, *response)
+        finally:
+            watcher.cancel()
+
+    def _run(self, pool, environ, disconnected):
+        """Handle a request in a pool thread; returns (status, headers, body) or None if the client left."""
+        if disconnected.is_set():
+            pool.count(waiting=-1, dropped=1)
+            return None
+        pool.count(waiting=-1, busy=1)
+        try:
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response.update(status=int(status.split(" ", 1)[0]), headers=headers)
+                return lambda data: response.setdefault("written", []).append(data)
+
+            result = self.wsgi_app(environ, start_response)
+            if isinstance(result, FileWrapper):
+                # Streamed by the event loop, which closes it
+                return response["status"], response["headers"], result
+            try:
+                chunks = response.get("written", []) + list(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+            return response["status"], response["headers"], chunks
+        finally:
+            pool.count(busy=-1)
+
+    async def _send_response(self, send, status, headers, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+        if isinstance(body, FileWrapper):
+            # Disk reads block: they run in a thread, so a slow disk never stalls the event loop
+            try:
+                while chunk := await asyncio.to_thread(body.file.read, body.buffer_size):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            finally:
+                await asyncio.to_thread(body.close)
+        else:
+            # Already read by the pool thread (see _run)
+            for chunk in body:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_busy(self, send):
+        body = json.dumps({"success": False, "error": "Server busy, retry later"}).encode()
+        await self._send_response(send, 503, [("Content-Type", "application/json"),
+                                              ("Content-Length", str(len(body))),
+                                              ("Retry-After", str(RETRY_AFTER))], [body])
+
+    def _environ(self, scope, body, disconnected):
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+            "opengridgen.disconnected": disconnected,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[name] = value
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+
+application = ASGIApp.from_env(app)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host="0.0.0.0", port=4242)
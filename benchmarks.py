@@ -0,0 +1,260 @@
+"""
+Benchmark suite for the generate_*_task functions.
+
+Every case runs in a fresh worker process (like a real request) and reports wall time,
+time per generation stage (from the tracing spans), peak memory and output size.
+Results can be saved as a baseline and later runs compared against it, failing when a
+case regresses by more than the threshold:
+
+    python benchmarks.py --suite quick --save-baseline bench_baseline.json
+    python benchmarks.py --suite quick --compare bench_baseline.json --threshold 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import tracing
+from task_runner import run_task_with_timeout
+
+DEFAULT_SETTINGS = {"GRU": 25.0, "GRHU": 5.0}
+
+STAGES = ("generate.build", "generate.validate", "generate.export")
+
+
+def _box_cases(sizes, heights):
+    return [("box", {"width": s, "length": s, "height": h}) for s in sizes for h in heights]
+
+
+def _baseplate_cases(sizes):
+    return [("baseplate", {"width": s, "length": s}) for s in sizes]
+
+
+def _lid_cases(sizes, handle_styles):
+    return [("lid", {"width": s, "length": s, "handle_style": style}) for s in sizes for style in handle_styles]
+
+
+def _gear_cases(teeth, types):
+    cases = []
+    for gear_type in types:
+        for z in teeth:
+            helix = 0.0 if gear_type == "spur" else 20.0
+            cases.append(("gear", {"teeth": z, "module": 1.0, "width": 5.0, "gear_type": gear_type, "helix_angle": helix}))
+    return cases
+
+
+def _hinge_cases(lengths):
+    return [("hinge", {"length": length, "width": 40.0, "height": 5.0}) for length in lengths]
+
+
+def _tube_adapter_cases(barbs):
+    return [("tube_adapter", {"side_a_id": 4.0, "side_a_od": 6.0, "side_a_barb": True,
+                              "side_b_id": 6.0, "side_b_od": 8.0, "side_b_barb": True,
+                              "length": 10.0 * n, "num_barbs": n, "barb_width": 2.0})
+            for n in barbs]
+
+
+SUITES = {
+    # Small enough to run on every PR
+    "quick": (
+        _box_cases([1, 2], [3])
+        + _baseplate_cases([1, 3])
+        + _lid_cases([2], ["loop"])
+        + _gear_cases([8, 40], ["spur", "helical"])
+        + _hinge_cases([40.0])
+        + _tube_adapter_cases([3])
+    ),
+    # The realistic parameter grid
+    "full": (
+        _box_cases(range(1, 7), [1, 3, 6])
+        + _baseplate_cases(range(1, 11))
+        + _lid_cases([1, 3, 6], ["none", "simple", "loop"])
+        + _gear_cases([8, 20, 50, 100, 200], ["spur", "helical", "herringbone"])
+        + _hinge_cases([20.0, 40.0, 80.0, 160.0])
+        + _tube_adapter_cases([1, 3, 6, 10])
+    ),
+}
+
+
+def case_id(generator, params):
+    return generator + "[" + ",".join(f"{k}={params[k]}" for k in sorted(params)) + "]"
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(generator, params, settings, output_path, format):
+    """
+    Runs inside the worker process: one generation, measured stage by stage.
+    """
+    import generation_utils
+    task = getattr(generation_utils, f"generate_{generator}_task")
+
+    rss_before = _peak_rss_mb()
+    with tracing.collect_spans() as spans:
+        start = time.perf_counter()
+        dims = task(params, settings, output_path=output_path, format=format)
+        elapsed = time.perf_counter() - start
+
+    stages = {}
+    for data in spans:
+        if data["name"] in STAGES:
+            span = tracing.Span.from_otlp(data)
+            stages[span.name] = stages.get(span.name, 0.0) + span.duration
+
+    return {
+        "task_time": elapsed,
+        "stages": stages,
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_growth_mb": _peak_rss_mb() - rss_before,
+        "output_bytes": os.path.getsize(output_path) if output_path and os.path.exists(output_path) else 0,
+        "dims": dims,
+    }
+
+
+def benchmark(cases, repeat=1, format="stl", timeout=600, settings=None, log=print):
+    settings = settings or DEFAULT_SETTINGS
+    results = {}
+    for generator, params in cases:
+        cid = case_id(generator, params)
+        runs = []
+        for _ in range(repeat):
+            output_path = os.path.join(tempfile.gettempdir(), f"bench_{uuid.uuid4()}.{format}")
+            start = time.perf_counter()
+            try:
+                run = run_task_with_timeout(run_case, args=(generator, params, settings, output_path, format), timeout=timeout)
+                run["wall_time"] = time.perf_counter() - start
+                runs.append(run)
+            except Exception as e:
+                results[cid] = {"generator": generator, "params": params, "error": f"{type(e).__name__}: {e}"}
+                break
+            finally:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+        if runs:
+            results[cid] = _summarize(generator, params, runs)
+        log(_format_result(cid, results[cid]))
+    return results
+
+
+def _summarize(generator, params, runs):
+    stages = {}
+    for stage in STAGES:
+        values = [r["stages"][stage] for r in runs if stage in r["stages"]]
+        if values:
+            stages[stage] = statistics.median(values)
+    return {
+        "generator": generator,
+        "params": params,
+        "repeat": len(runs),
+        "wall_time": statistics.median(r["wall_time"] for r in runs),
+        "task_time": statistics.median(r["task_time"] for r in runs),
+        "stages": stages,
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+        "rss_growth_mb": max(r["rss_growth_mb"] for r in runs),
+        "output_bytes": runs[-1]["output_bytes"],
+    }
+
+
+def _format_result(cid, result):
+    if "error" in result:
+        return f"{cid:70s} ERROR {result['error']}"
+    stages = " ".join(f"{name.split('.')[-1]}={secs:.2f}s" for name, secs in result["stages"].items())
+    return (f"{cid:70s} wall={result['wall_time']:.2f}s task={result['task_time']:.2f}s {stages} "
+            f"rss={result['peak_rss_mb']:.0f}MB size={result['output_bytes'] / 1024:.0f}KB")
+
+
+# Metrics compared against the baseline; wall_time includes process start-up so the task time is used
+COMPARED_METRICS = ("task_time", "peak_rss_mb", "output_bytes")
+
+
+def compare(baseline, current, threshold=0.25, min_seconds=0.05):
+    """
+    Compare two result sets. Returns a list of regressions as
+    (case_id, metric, baseline_value, current_value, relative_change).
+    Timings below min_seconds are too noisy to gate on and are ignored.
+    """
+    regressions = []
+    for cid, result in current.items():
+        base = baseline.get(cid)
+        if not base or "error" in base:
+            continue
+        if "error" in result:
+            regressions.append((cid, "error", None, result["error"], None))
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if metric == "task_time" and max(old, new) < min_seconds:
+                continue
+            change = (new - old) / old
+            if change > threshold:
+                regressions.append((cid, metric, old, new, change))
+    return regressions
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--generator", action="append", help="Only run cases for this generator (repeatable)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case, the median is reported")
+    parser.add_argument("--format", choices=["stl", "step"], default="stl")
+    parser.add_argument("--timeout", type=int, default=600)
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--save-baseline", help="Write results as a baseline file")
+    parser.add_argument("--compare", help="Baseline file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression (default 0.25)")
+    args = parser.parse_args(argv)
+
+    cases = SUITES[args.suite]
+    if args.generator:
+        cases = [c for c in cases if c[0] in args.generator]
+
+    results = benchmark(cases, repeat=args.repeat, format=args.format, timeout=args.timeout)
+    report = {"environment": environment(), "suite": args.suite, "format": args.format, "results": results}
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline["results"], results, threshold=args.threshold)
+        for cid, metric, old, new, change in regressions:
+            if metric == "error":
+                print(f"REGRESSION {cid}: now fails with {new}")
+            else:
+                print(f"REGRESSION {cid}: {metric} {old:.3f} -> {new:.3f} (+{change:.0%})")
+        if regressions:
+            return 1
+        print(f"No regressions above {args.threshold:.0%} against {args.compare}")
+
+    if any("error" in r for r in results.values()):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""
+Cache storage shared by the replicas of a deployment.
+
+The mesh cache and the shape store keep their files on the local disk of one replica,
+so behind a load balancer every replica generates each part once. With CACHE_BACKEND
+set they also publish what they write to a shared backend and fall back to it on a
+local miss: a part generated by any replica is then served by all of them, and its
+shapes are loaded instead of rebuilt. Backends store opaque byte strings by key:
+
+- DiskBackend: a directory, local or on a volume mounted by every replica (NFS, EFS,
+  a Docker volume), which also stands in for a network backend in development;
+- RedisBackend: Redis or any server speaking its protocol (Valkey, KeyDB, Dragonfly),
+  through the optional redis package. Size the server's memory and set an eviction
+  policy (e.g. allkeys-lru); CACHE_TTL expires entries on top of that (and removes
+  entries of a directory backend unused for that long).
+
+Values are published atomically (readers see the whole value or none of it). Before a
+replica generates a part it takes the part's lease, and replicas that find the lease
+taken wait for the artifact to be published instead of generating the same part again.
+Leases expire after CACHE_LEASE_SECONDS, so a replica that dies while generating only
+delays the others. They are an optimization, not a lock: in the rare race where two
+replicas generate the same part both publish identical files.
+
+HashRing maps a part to one of CACHE_NODES by consistent hashing. Responses name that
+replica in X-Cache-Node, so a proxy can send follow-up requests for the part (its
+finer meshes, /artifacts/ URLs) to the replica that has it on local disk; adding or
+removing a replica only moves the parts of its share of the ring.
+
+Configuration (environment):
+    CACHE_BACKEND         shared backend: a directory (/path or dir:///path) or
+                          redis://host:port/db (default: unset, every replica caches alone)
+    CACHE_BACKEND_MAX_MB  size limit of a directory backend (default: 2048)
+    CACHE_TTL             seconds entries are kept, in a directory backend since last used
+                          (default: 0, until evicted)
+    CACHE_LEASE_SECONDS   how long a lease on a part being generated lasts (default: 600)
+    CACHE_NODE            name of this replica (default: the host name)
+    CACHE_NODES           comma separated names of all replicas, for X-Cache-Node (default: unset)
+"""
+import abc
+import bisect
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Backend keys are "/" separated names, e.g. "artifact/<mesh key>/fine"
+KEY_PART = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def check_key(key):
+    parts = key.split("/")
+    if not all(KEY_PART.match(part) and part not in (".", "..") for part in parts):
+        raise ValueError(f"Invalid cache key: {key!r}")
+    return parts
+
+
+class CacheBackend(abc.ABC):
+    """
+    Byte strings by key, published atomically, plus expiring leases. Backends never
+    raise on I/O errors: a failing shared cache only makes replicas generate more.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """The value published under key, or None."""
+
+    @abc.abstractmethod
+    def publish(self, key, value):
+        """Store value (bytes) under key, replacing any previous value in one step."""
+
+    @abc.abstractmethod
+    def acquire(self, key, owner, ttl):
+        """Take the lease `key` for owner for ttl seconds; True if owner holds it now."""
+
+    @abc.abstractmethod
+    def release(self, key, owner):
+        """Give up the lease `key` if owner still holds it."""
+
+    def stats(self):
+        return {}
+
+
+class DiskBackend(CacheBackend):
+    """
+    Values are files under root, written to a temporary file and renamed into place.
+    A lease is a file holding its owner and expiry, created exclusively; an expired one
+    is replaced. Values unused for ttl seconds are removed, and the least recently used
+    ones beyond max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=2048 * 2**20, ttl=0, clock=time.time):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.publishes = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.root, *check_key(key))
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def _write(self, path, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def publish(self, key, value):
+        try:
+            self._write(self.path_for(key), value)
+        except OSError as e:
+            logger.warning("Could not publish %s: %s", key, e)
+            return
+        with self._lock:
+            self.publishes += 1
+        self._enforce_limit()
+
+    def _lease_path(self, key):
+        return os.path.join(self.root, "leases", *check_key(key))
+
+    def _read_lease(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, key, owner, ttl):
+        path = self._lease_path(key)
+        lease = json.dumps({"owner": owner, "expires": self._clock() + ttl}).encode()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            current = self._read_lease(path)
+            if current is not None and current["owner"] != owner and current["expires"] > self._clock():
+                return False
+            # Ours (renewed), expired, or half written by a replica that died
+            try:
+                self._write(path, lease)
+            except OSError:
+                return False
+            # Two replicas replacing the same expired lease: the last rename wins
+            current = self._read_lease(path)
+            return current is not None and current["owner"] == owner
+        except OSError as e:
+            logger.warning("Could not take lease %s: %s", key, e)
+            return True  # generate rather than wait on a broken backend
+        with os.fdopen(fd, "wb") as f:
+            f.write(lease)
+        return True
+
+    def release(self, key, owner):
+        path = self._lease_path(key)
+        current = self._read_lease(path)
+        if current is not None and current["owner"] == owner:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _files(self):
+        files = []
+        for directory, subdirs, names in os.walk(self.root):
+            if directory == self.root and "leases" in subdirs:
+                subdirs.remove("leases")
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue  # removed meanwhile
+                files.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        return files
+
+    def _enforce_limit(self):
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        expired = self._clock() - self.ttl if self.ttl else None
+        for used, size, path in sorted(files):
+            if total <= self.max_bytes and (expired is None or used >= expired):
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        files = self._files()
+        with self._lock:
+            return {"backend": "dir", "root": self.root, "entries": len(files),
+                    "bytes": sum(size for _, size, _ in files), "max_bytes": self.max_bytes, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "publishes": self.publishes,
+                    "evictions": self.evictions}
+
+
+class RedisBackend(CacheBackend):
+    """
+    Values are Redis strings (SET replaces a value atomically). A lease is a key set
+    with NX and an expiry, released by a script that deletes it only for its owner.
+    """
+
+    RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, client, prefix="opengridgen:", ttl=0):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.publishes = 0
+        self.errors = 0
+
+    @classmethod
+    def from_url(cls, url, ttl=0):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis://... needs the redis package (pip install redis)") from None
+        return cls(redis.Redis.from_url(url, socket_timeout=5), ttl=ttl)
+
+    def _key(self, key):
+        check_key(key)
+        return self.prefix + key
+
+    def _failed(self, action, key, e):
+        logger.warning("Redis cache could not %s %s: %s", action, key, e)
+        with self._lock:
+            self.errors += 1
+
+    def get(self, key):
+        name = self._key(key)
+        try:
+            value = self.client.get(name)
+        except Exception as e:
+            self._failed("read", key, e)
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def publish(self, key, value):
+        name = self._key(key)
+        try:
+            self.client.set(name, value, ex=int(self.ttl) or None)
+        except Exception as e:
+            self._failed("publish", key, e)
+            return
+        with self._lock:
+            self.publishes += 1
+
+    def acquire(self, key, owner, ttl):
+        name = self._key(f"leases/{key}")
+        milliseconds = max(1, int(ttl * 1000))
+        try:
+            if self.client.set(name, owner, nx=True, px=milliseconds):
+                return True
+            if _text(self.client.get(name)) == owner:
+                self.client.pexpire(name, milliseconds)
+                return True
+            return False
+        except Exception as e:
+            self._failed("take lease", key, e)
+            return True  # generate rather than wait on a broken backend
+
+    def release(self, key, owner):
+        name = self._key(f"leases/{key}")
+        try:
+            self.client.eval(self.RELEASE, 1, name, owner)
+        except Exception as e:
+            self._failed("release lease", key, e)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "redis", "hits": self.hits, "misses": self.misses,
+                    "publishes": self.publishes, "errors": self.errors, "ttl": self.ttl}
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def backend_from_env(env=None):
+    """The shared backend configured by CACHE_BACKEND, or None."""
+    env = os.environ if env is None else env
+    url = env.get("CACHE_BACKEND")
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend.from_url(url, ttl=float(env.get("CACHE_TTL", 0)))
+    root = url[len("dir://"):] if url.startswith("dir://") else url
+    return DiskBackend(root, max_bytes=int(float(env.get("CACHE_BACKEND_MAX_MB", 2048)) * 2**20),
+                       ttl=float(env.get("CACHE_TTL", 0)))
+
+
+def lease_seconds(env=None):
+    env = os.environ if env is None else env
+    return float(env.get("CACHE_LEASE_SECONDS", 600))
+
+
+def node_name(env=None):
+    env = os.environ if env is None else env
+    return env.get("CACHE_NODE") or socket.gethostname()
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, each placed at `points` spots on the ring."""
+
+    def __init__(self, nodes, points=100):
+        self.nodes = sorted(set(nodes))
+        ring = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(points))
+        self._hashes = [h for h, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    @classmethod
+    def from_env(cls, env=None):
+        """The ring of CACHE_NODES, or None when it is not set."""
+        env = os.environ if env is None else env
+        nodes = [node.strip() for node in env.get("CACHE_NODES", "").split(",") if node.strip()]
+        return cls(nodes) if nodes else None
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[i]
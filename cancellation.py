@@ -0,0 +1,88 @@
+"""
+Cancellation of generations whose result nobody is waiting for any more.
+
+A CancelToken is created per request. It is cancelled when the client disconnects
+(checked lazily on the request socket, or signalled by the ASGI server, see asgi.py) or when a newer preview from the same preview
+session supersedes it. run_task_with_timeout polls the token and terminates the worker
+process as soon as it is set.
+"""
+import select
+import socket
+import threading
+
+SUPERSEDED = "superseded"
+DISCONNECTED = "disconnected"
+
+
+class Cancelled(Exception):
+    """
+    Raised when a generation was cancelled before it finished.
+    status is the HTTP status to answer with (409 superseded, 499 client closed request).
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Generation cancelled ({reason})")
+        self.reason = reason
+        self.status = 409 if reason == SUPERSEDED else 499
+
+
+def client_disconnected(sock):
+    """True if the peer closed the connection. Pipelined request data does not count."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # e.g. TLS sockets, which do not support MSG_PEEK; never cancel on those
+        return False
+    except OSError:
+        return True
+
+
+class CancelToken:
+    def __init__(self, sock=None, disconnected=None):
+        self.reason = None
+        self._event = threading.Event()
+        self._sock = sock
+        self._disconnected = disconnected
+
+    def cancel(self, reason):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_set(self):
+        if not self._event.is_set() and self._disconnected is not None and self._disconnected.is_set():
+            self.cancel(DISCONNECTED)
+        if not self._event.is_set() and self._sock is not None and client_disconnected(self._sock):
+            self.cancel(DISCONNECTED)
+        return self._event.is_set()
+
+
+class PreviewSessions:
+    """
+    Tracks the latest preview of every preview session; starting a new one cancels the previous.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = {}
+        self.superseded = 0
+
+    def begin(self, session, token):
+        with self._lock:
+            previous = self._current.get(session)
+            self._current[session] = token
+        if previous is not None and not previous.is_set():
+            self.superseded += 1
+            previous.cancel(SUPERSEDED)
+
+    def end(self, session, token):
+        with self._lock:
+            if self._current.get(session) is token:
+                del self._current[session]
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._current), "superseded": self.superseded}
@@ -0,0 +1,129 @@
+"""
+Single-flight deduplication of identical in-flight generations.
+
+When many people open the same part at once, only the first request (the leader) runs
+the generation; identical requests that arrive while it is running (followers) wait for
+it and share its result. Output files are hard linked (or copied) to every follower's
+own path before the flight completes, so each response can send and remove its file
+independently.
+
+If the leader is rejected by admission control or cancelled, its followers are not:
+they retry and one of them becomes the new leader. Any other failure, including a
+timeout, is shared, because an identical job would fail the same way. The generation
+itself is only cancelled once every request sharing it has been cancelled.
+"""
+import json
+import os
+import shutil
+import threading
+
+from admission import AdmissionRejected
+from cancellation import Cancelled
+
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def flight_key(generator, params, settings, format=None):
+    """Canonical key of a generation: identical requests map to the same key."""
+    return json.dumps([generator, format, dict(params), settings], sort_keys=True, default=str)
+
+
+def share_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class _Flight:
+    def __init__(self, token):
+        self.closed = threading.Event()  # set once no request can join or leave any more
+        self.done = threading.Event()  # set once the result and the followers' files are ready
+        self.result = None
+        self.error = None
+        self.followers = []  # (output path, cancel token) of the followers
+        self.tokens = [token]
+
+    def is_set(self):
+        """Cancel token of the shared generation: set once every participant cancelled."""
+        return all(t is not None and t.is_set() for t in self.tokens)
+
+    @property
+    def reason(self):
+        return self.tokens[0].reason if self.tokens and self.tokens[0] is not None else None
+
+
+class Coalescer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def run(self, key, fn, output_path=None, cancel=None):
+        """
+        Run fn(flight_cancel) once per key among concurrent callers and return its result.
+        fn writes its output to output_path; followers get a copy at their own output_path.
+        flight_cancel is set once every caller's cancel token is set.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight(cancel)
+                    self.leaders += 1
+                    leader = True
+                else:
+                    flight.followers.append((output_path, cancel))
+                    flight.tokens.append(cancel)
+                    self.coalesced += 1
+                    leader = False
+
+            if leader:
+                return self._lead(key, flight, fn, output_path)
+
+            self._follow(flight, output_path, cancel)
+            if isinstance(flight.error, (AdmissionRejected, Cancelled)):
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+    def _follow(self, flight, output_path, cancel):
+        while not flight.done.wait(CANCEL_POLL_INTERVAL if cancel is not None else None):
+            if cancel.is_set():
+                with self._lock:
+                    if not flight.closed.is_set():
+                        flight.followers.remove((output_path, cancel))
+                        flight.tokens.remove(cancel)
+                        raise Cancelled(cancel.reason)
+
+    def _lead(self, key, flight, fn, output_path):
+        try:
+            flight.result = fn(flight)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                # No one can join once the flight is removed, so the follower list is final
+                del self._flights[key]
+                flight.closed.set()
+            if flight.error is None and output_path:
+                for path, _ in flight.followers:
+                    try:
+                        share_file(output_path, path)
+                    except OSError as e:
+                        flight.error = e
+                        break
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "waiting": sum(len(f.followers) for f in self._flights.values()),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
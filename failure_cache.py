@@ -0,0 +1,140 @@
+"""
+Negative cache of generations that failed.
+
+A part whose geometry fails validation fails the same way every time, and a part that
+hit the timeout almost certainly does again, yet users retry them, each time holding a
+worker for up to the whole timeout. The cache remembers these failures by canonical
+params and settings for a while and answers repeats immediately with the remembered
+error (422 or 408). Only timeouts of a task that ran past its own budget in a worker
+process of its own are remembered (task_runner.TaskTimeout), not those of a request
+that waited too long for a busy worker or queue, and only for the kind of request that
+timed out (info, preview or download: a preview builds more than an info request) and
+for a shorter time, since a loaded machine also runs tasks slower.
+
+Entries outlive their TTL (up to FAILURE_CACHE_ENTRIES, least recently seen first out)
+so /admin/failures can list the parameter sets that fail most often.
+
+Configuration (environment):
+    FAILURE_CACHE_TTL           seconds a validation failure is remembered (default: 600, 0 disables)
+    FAILURE_CACHE_TIMEOUT_TTL   seconds a timeout is remembered (default: 120, 0 disables)
+    FAILURE_CACHE_ENTRIES       failing parameter sets kept for the admin view (default: 1000)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from generators import GeometryValidationError
+from task_runner import TaskTimeout
+
+# What is remembered, by exception type: (name in the admin view, TTL attribute)
+KINDS = {
+    GeometryValidationError: ("validation", "ttl"),
+    TaskTimeout: ("timeout", "timeout_ttl"),
+}
+# Failures that depend on the kind of request (info, preview, download), remembered per kind
+PER_REQUEST_KIND = {TaskTimeout}
+
+
+class _Failure:
+    def __init__(self, generator, params, error_type, message, request_kind=None):
+        self.generator = generator
+        self.params = dict(params)
+        self.request_kind = request_kind
+        self.error_type = error_type
+        self.message = message
+        self.failures = 0
+        self.hits = 0
+        self.first_seen = time.time()
+        self.last_seen = None
+        self.expires = 0.0
+
+
+class FailureCache:
+    def __init__(self, ttl=600.0, timeout_ttl=120.0, max_entries=1000, clock=time.monotonic):
+        self.ttl = ttl
+        self.timeout_ttl = timeout_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        return cls(ttl=float(env.get("FAILURE_CACHE_TTL", 600)),
+                   timeout_ttl=float(env.get("FAILURE_CACHE_TIMEOUT_TTL", 120)),
+                   max_entries=int(env.get("FAILURE_CACHE_ENTRIES", 1000)))
+
+    def get(self, key, request_kind=None):
+        """A fresh copy of the remembered error of key (for this kind of request), or None."""
+        now = self._clock()
+        with self._lock:
+            for entry_key in (key, (key, request_kind)):
+                entry = self._entries.get(entry_key)
+                if entry is None or now >= entry.expires:
+                    continue
+                self._entries.move_to_end(entry_key)
+                entry.hits += 1
+                self.hits += 1
+                return entry.error_type(entry.message)
+            return None
+
+    def record(self, key, generator, params, error, request_kind=None):
+        """Remember error if it is a failure that repeats (see KINDS); other errors are ignored."""
+        kind = KINDS.get(type(error))
+        if kind is None:
+            return
+        ttl = getattr(self, kind[1])
+        if ttl <= 0:
+            return
+        if type(error) in PER_REQUEST_KIND:
+            key = (key, request_kind)
+        else:
+            request_kind = None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = _Failure(generator, params, type(error), str(error), request_kind)
+            entry.error_type = type(error)
+            entry.message = str(error)
+            entry.failures += 1
+            entry.last_seen = time.time()
+            entry.expires = self._clock() + ttl
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def top(self, limit=50):
+        """The parameter sets that failed most often, counting the repeats answered from the cache."""
+        now = self._clock()
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e.failures + e.hits, reverse=True)[:limit]
+            return [{
+                "generator": e.generator,
+                "params": e.params,
+                "kind": KINDS[e.error_type][0],
+                "request_kind": e.request_kind,
+                "error": e.message,
+                "failures": e.failures,
+                "hits": e.hits,
+                "first_seen": e.first_seen,
+                "last_seen": e.last_seen,
+                "expires_in": max(0.0, round(e.expires - now, 1)),
+            } for e in entries]
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "active": sum(1 for e in self._entries.values() if e.expires > now),
+                "hits": self.hits,
+                "ttl": self.ttl,
+                "timeout_ttl": self.timeout_ttl,
+            }
@@ -0,0 +1,78 @@
+"""
+Feasibility checks of generator parameters.
+
+Parameters can be valid one by one and still describe a part that cannot be built: a
+tube wall with the inner diameter above the outer one, more barbs than fit on the tube,
+a gear bore wider than the tooth root. Without these checks such a request would only
+fail after a worker process started and CadQuery built part of the geometry. The rules
+here restate the generators' own geometry in plain arithmetic, so the web process
+rejects those requests in microseconds with a 422 naming the field to change.
+
+Like params.py, this module has no dependencies.
+"""
+from math import pi
+
+from params import InvalidParams, parse_params
+
+
+class Infeasible(InvalidParams):
+    """Parameters that are valid one by one but describe a part that cannot be built."""
+    status = 422
+
+
+def _tube_adapter(p):
+    for side in ('a', 'b'):
+        inner, outer = p[f'side_{side}_id'], p[f'side_{side}_od']
+        if inner >= outer:
+            yield f'side_{side}_id', f"Side {side.upper()} ID ({inner:g} mm) must be less than OD ({outer:g} mm)"
+    if p['side_a_barb'] or p['side_b_barb']:
+        # Each barbed end is 40% of the length (see TubeAdapter.render)
+        available = p['length'] * 0.4
+        required = p['num_barbs'] * p['barb_width']
+        if required > available:
+            yield 'num_barbs', (f"Barbs do not fit: {p['num_barbs']} barbs of {p['barb_width']:g} mm need "
+                                f"{required:g} mm, the barbed section is {available:g} mm long")
+
+
+def _hinge(p):
+    # The knuckles are cylinders of the hinge's height, bored for the pin plus clearance
+    if p['pin_diam'] + 2 * p['clearance'] >= p['height']:
+        yield 'pin_diam', (f"Pin ({p['pin_diam']:g} mm) plus clearance on both sides must be less than "
+                           f"the knuckle diameter, which is the height ({p['height']:g} mm)")
+    knuckles = max(3, int(p['length'] / 10))
+    knuckles += 1 - knuckles % 2
+    if p['length'] - (knuckles - 1) * p['clearance'] <= 0:
+        yield 'clearance', (f"Clearance ({p['clearance']:g} mm) between {knuckles} knuckles leaves no room "
+                            f"for them in a {p['length']:g} mm long hinge")
+
+
+def _gear(p):
+    root = p['module'] * (p['teeth'] - 2.5)
+    if p['bore_d'] >= root:
+        yield 'bore_d', f"Bore ({p['bore_d']:g} mm) must be smaller than the root diameter ({root:.2f} mm)"
+    thickness = pi * p['module'] / 2
+    if p['backlash'] >= thickness:
+        yield 'backlash', f"Backlash ({p['backlash']:g} mm) must be less than the tooth thickness ({thickness:.2f} mm)"
+    if p['gear_type'] == 'herringbone' and p['helix_angle'] == 0:
+        yield 'helix_angle', "A herringbone gear needs a non-zero helix angle"
+
+
+RULES = {
+    'tube_adapter': _tube_adapter,
+    'hinge': _hinge,
+    'gear': _gear,
+}
+
+
+def check(params):
+    """Return params if the part can be built, else raise Infeasible listing every problem."""
+    rule = RULES.get(params.generator)
+    errors = [{"field": field, "error": error} for field, error in rule(params)] if rule else []
+    if errors:
+        raise Infeasible(errors)
+    return params
+
+
+def checked_params(generator, data):
+    """parse_params() followed by check(): raises InvalidParams (400) or Infeasible (422)."""
+    return check(parse_params(generator, data))
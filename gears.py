@@ -1,6 +1,9 @@
 import cadquery as cq
 from math import cos, sin, tan, pi, sqrt, radians, acos, atan2
 
+import stage_cache
+from part_export import export_step, export_stl
+
 class Gear:
     def __init__(self, teeth=20, module=1.0, width=5.0, bore_d=5.0, pressure_angle=20.0, shaft_type='circle',
                  helix_angle=0.0, gear_type='spur', backlash=0.0):
@@ -16,10 +19,23 @@ class Gear:
         self.cq_obj = None
 
     def render(self):
+        # Each stage is memoized on the params it depends on, so changing only the bore
+        # reuses the body, and changing only the width or gear type reuses the profile
+        profile_key = (self.teeth, self.module, self.pressure_angle, self.backlash)
+        wire = stage_cache.memo("gear.profile", profile_key, self.profile_wire)
+        body_key = profile_key + (self.gear_type, self.helix_angle, self.width)
+        body = stage_cache.memo("gear.body", body_key, lambda: self.extrude_body(wire))
+        self.cq_obj = self.cut_bore(cq.Workplane("XY").add(body))
+        return self.cq_obj
+
+    def _pitch_radius(self):
+        return self.module * self.teeth / 2.0
+
+    def profile_wire(self):
+        """The closed 2D outline of all teeth, as a cq.Wire."""
         m = self.module
         z = self.teeth
         phi = radians(self.pressure_angle)
-        width = self.width
 
         d_pitch = m * z
         d_base = d_pitch * cos(phi)
@@ -102,7 +118,13 @@ class Gear:
         # This will connect the last point (RootR of last tooth) to first point (RootL of first tooth).
         # This creates the Bottom Land.
 
-        gear_wire = cq.Workplane("XY").polyline(full_points).close().wire()
+        return cq.Workplane("XY").polyline(full_points).close().wire().val()
+
+    def extrude_body(self, wire):
+        """The toothed gear body without the bore, as a cq.Shape."""
+        width = self.width
+        r_pitch = self._pitch_radius()
+        gear_wire = cq.Workplane("XY").add(wire).toPending()
 
         if self.gear_type == 'helical':
             helix_rad = radians(self.helix_angle)
@@ -134,7 +156,10 @@ class Gear:
         else:
             gear_face = gear_wire.extrude(width)
 
-        # Add the bore
+        return gear_face.val()
+
+    def cut_bore(self, gear_face):
+        width = self.width
         if self.shaft_type == 'circle':
             gear_final = gear_face.faces(">Z").workplane().circle(self.bore_d / 2).cutThruAll()
         elif self.shaft_type == 'hex':
@@ -159,13 +184,12 @@ class Gear:
         else:
             gear_final = gear_face.faces(">Z").workplane().circle(self.bore_d / 2).cutThruAll()
 
-        self.cq_obj = gear_final
-        return self.cq_obj
+        return gear_final
 
     def save_step_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStep(filename)
+        export_step(self.cq_obj.val(), filename, 'gear')
 
     def save_stl_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStl(filename)
+        export_stl(self.cq_obj.val(), filename, 1e-3, 0.1, relative=True)
@@ -4,11 +4,18 @@ import cqgridfinity.gf_baseplate
 import cqgridfinity.gf_box
 import cqgridfinity.gf_obj
 import cadquery as cq
+import os
 from math import sqrt
 from gears import Gear
 from hinges import Hinge
 from gridfinity_lid import GridfinityBoxLid
+from gridfinity_blocks import GridfinityBox, GridfinityBaseplate, SCALED_CONSTANTS, constants_key
 from tube_adapter import TubeAdapter
+import stage_cache
+import tracing
+from generators import GeometryValidationError, GenerationError, MESH_LODS, lod_path
+from feasibility import checked_params
+from part_export import export_stl
 
 # OCP imports for enhanced validation
 from OCP.BRepCheck import BRepCheck_Analyzer
@@ -17,12 +24,6 @@ from OCP.TopAbs import TopAbs_FACE, TopAbs_EDGE, TopAbs_VERTEX, TopAbs_WIRE, Top
 from OCP.BRepBndLib import BRepBndLib
 from OCP.Bnd import Bnd_Box
 
-class GeometryValidationError(Exception):
-    pass
-
-class GenerationError(Exception):
-    pass
-
 def update_constants(settings):
     """
     Update global cqgridfinity constants based on settings dictionary.
@@ -82,15 +83,8 @@ def update_constants(settings):
         cqgridfinity.gf_box,
     ]
 
-    keys_to_update = [
-        'GRU', 'GRHU', 'GRU2', 'GRU_CUT',
-        'GR_HOLE_DIST', 'GR_BREG_R0', 'GR_BREG_R1',
-        'GR_BOT_H', 'GR_BASE_HEIGHT',
-        'GR_BASE_PROFILE', 'GR_BOX_PROFILE'
-    ]
-
     for mod in modules:
-        for key in keys_to_update:
+        for key in SCALED_CONSTANTS:
             if hasattr(mod, key):
                 setattr(mod, key, getattr(cqgridfinity.constants, key))
 
@@ -230,7 +224,7 @@ def validate_geometry(cq_obj):
 
     return True
 
-class CustomGridfinityBaseplate(cqgridfinity.GridfinityBaseplate):
+class CustomGridfinityBaseplate(GridfinityBaseplate):
     def __init__(self, length_u, width_u, length_padding=0, width_padding=0, **kwargs):
         self.length_padding = length_padding
         self.width_padding = width_padding
@@ -244,210 +238,133 @@ class CustomGridfinityBaseplate(cqgridfinity.GridfinityBaseplate):
     def width(self):
         return self.width_u * cqgridfinity.constants.GRU + self.width_padding
 
-def generate_box_task(params, settings, output_path=None, format=None):
-    update_constants(settings)
-    try:
-        width = int(params.get('width', 1))
-        length = int(params.get('length', 1))
-        height = int(params.get('height', 1))
-        solid = params.get('solid', False)
-
-        box = cqgridfinity.GridfinityBox(length, width, height, solid=solid)
-
-        # cq_obj is populated in __init__ for cqgridfinity objects usually,
-        # or we might need to call render()?
-        # cqgridfinity objects usually create geometry in __init__ and store in .cq_obj
-        if not box.cq_obj:
-            box.render() # Just in case
-
-        validate_geometry(box.cq_obj)
+def render_part(generator, part, params, gridfinity=False):
+    """
+    Render part, or reuse the finished shape built for the same params earlier in this
+    worker or, with a shape store configured, by any worker (so e.g. a STEP download
+    after an STL preview skips the build). Gridfinity parts also depend on the settings.
+    """
+    key = tuple(sorted(params.items()))
+    if gridfinity:
+        key += (constants_key(),)
+    shape = stage_cache.memo(generator + ".part", key, lambda: part.render().val())
+    part.cq_obj = cq.Workplane("XY").add(shape)
+    return part.cq_obj
+
+def validate_and_export(generator, part, cq_obj, output_path=None, format=None, lods=()):
+    """
+    Shared tail of every generation task: validate the geometry, measure it and
+    optionally export it. `part` is the generator object providing save_*_file().
+    An STL export also writes the preview meshes named in `lods` (see MESH_LODS)
+    next to output_path.
+    """
+    with tracing.span("generate.validate", {"generator": generator}):
+        validate_geometry(cq_obj)
 
-        bb = box.cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
+    bb = cq_obj.val().BoundingBox()
+    dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
 
-        if output_path and format:
+    if output_path and format:
+        with tracing.span("generate.export", {"generator": generator, "format": format}):
             if format == 'step':
-                box.save_step_file(output_path)
+                part.save_step_file(output_path)
             elif format == 'stl':
-                box.save_stl_file(output_path)
+                part.save_stl_file(output_path)
+                for lod in lods:
+                    export_stl(cq_obj.val(), lod_path(output_path, lod), *MESH_LODS[lod])
+
+    return dims
+
+def generate_box_task(params, settings, output_path=None, format=None, lods=()):
+    params = checked_params('box', params)
+    update_constants(settings)
+    try:
+        with tracing.span("generate.build", tracing.param_attributes('box', params)):
+            box = GridfinityBox(params['length'], params['width'], params['height'], solid=params['solid'])
+            cq_obj = render_part('box', box, params, gridfinity=True)
 
-        return dims
+        return validate_and_export('box', box, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
         raise GenerationError(str(e))
 
 
-def generate_tube_adapter_task(params, settings, output_path=None, format=None):
+def generate_tube_adapter_task(params, settings, output_path=None, format=None, lods=()):
+    params = checked_params('tube_adapter', params)
     try:
-        side_a_id = float(params.get('side_a_id', 4.0))
-        side_a_od = float(params.get('side_a_od', 6.0))
-        side_a_barb = params.get('side_a_barb', False)
-        side_b_id = float(params.get('side_b_id', 4.0))
-        side_b_od = float(params.get('side_b_od', 6.0))
-        side_b_barb = params.get('side_b_barb', False)
-        length = float(params.get('length', 30.0))
-
-        num_barbs = int(params.get('num_barbs', 3))
-        barb_height_percentage = float(params.get('barb_height_percentage', 10.0))
-        barb_width = float(params.get('barb_width', 2.0))
-
-        adapter_obj = TubeAdapter(side_a_id=side_a_id, side_a_od=side_a_od, side_a_barb=side_a_barb,
-                                  side_b_id=side_b_id, side_b_od=side_b_od, side_b_barb=side_b_barb,
-                                  length=length,
-                                  num_barbs=num_barbs,
-                                  barb_height_percentage=barb_height_percentage,
-                                  barb_width=barb_width)
-
-        cq_obj = adapter_obj.render()
-        validate_geometry(cq_obj)
-
-        bb = cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
-
-        if output_path and format:
-            if format == 'step':
-                adapter_obj.save_step_file(output_path)
-            elif format == 'stl':
-                adapter_obj.save_stl_file(output_path)
+        with tracing.span("generate.build", tracing.param_attributes('tube_adapter', params)):
+            adapter_obj = TubeAdapter(**params)
+            cq_obj = render_part('tube_adapter', adapter_obj, params)
 
-        return dims
+        return validate_and_export('tube_adapter', adapter_obj, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
         raise GenerationError(str(e))
 
-def generate_lid_task(params, settings, output_path=None, format=None):
+def generate_lid_task(params, settings, output_path=None, format=None, lods=()):
+    params = checked_params('lid', params)
     update_constants(settings)
     try:
-        width = int(params.get('width', 1))
-        length = int(params.get('length', 1))
-        height = float(params.get('height', 0.5))
-        handle_style = params.get('handle_style', 'none')
-        handle_height = float(params.get('handle_height', 5.0))
-
-        lid_obj = GridfinityBoxLid(length, width, height,
-                                 handle_style=handle_style,
-                                 handle_height=handle_height)
+        with tracing.span("generate.build", tracing.param_attributes('lid', params)):
+            lid_obj = GridfinityBoxLid(params['length'], params['width'], params['height'],
+                                     handle_style=params['handle_style'],
+                                     handle_height=params['handle_height'])
 
-        cq_obj = lid_obj.render()
-        validate_geometry(cq_obj)
-
-        bb = cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
-
-        if output_path and format:
-            if format == 'step':
-                lid_obj.save_step_file(output_path)
-            elif format == 'stl':
-                lid_obj.save_stl_file(output_path)
+            cq_obj = render_part('lid', lid_obj, params, gridfinity=True)
 
-        return dims
+        return validate_and_export('lid', lid_obj, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
         raise GenerationError(str(e))
 
-def generate_baseplate_task(params, settings, output_path=None, format=None):
+def generate_baseplate_task(params, settings, output_path=None, format=None, lods=()):
+    params = checked_params('baseplate', params)
     update_constants(settings)
     try:
-        width = int(params.get('width', 1))
-        length = int(params.get('length', 1))
-        padding_width = float(params.get('padding_width', 0))
-        padding_length = float(params.get('padding_length', 0))
-        corner_screws = params.get('corner_screws', False)
-
         kwargs = {}
-        if corner_screws:
+        if params['corner_screws']:
             kwargs['corner_screws'] = True
             kwargs['csk_hole'] = 3.6
             kwargs['csk_diam'] = 7.0
 
-        bp = CustomGridfinityBaseplate(length, width,
-                                     length_padding=padding_length,
-                                     width_padding=padding_width,
-                                     **kwargs)
-
-        if not bp.cq_obj:
-            bp.render() # Ensure geometry exists
-
-        validate_geometry(bp.cq_obj)
-
-        bb = bp.cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
-
-        if output_path and format:
-            if format == 'step':
-                bp.save_step_file(output_path)
-            elif format == 'stl':
-                bp.save_stl_file(output_path)
+        with tracing.span("generate.build", tracing.param_attributes('baseplate', params)):
+            bp = CustomGridfinityBaseplate(params['length'], params['width'],
+                                         length_padding=params['padding_length'],
+                                         width_padding=params['padding_width'],
+                                         **kwargs)
+            cq_obj = render_part('baseplate', bp, params, gridfinity=True)
 
-        return dims
+        return validate_and_export('baseplate', bp, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
         raise GenerationError(str(e))
 
-def generate_gear_task(params, settings, output_path=None, format=None):
+def generate_gear_task(params, settings, output_path=None, format=None, lods=()):
     # Gears don't use gridfinity settings usually, but we pass them anyway
+    params = checked_params('gear', params)
     try:
-        teeth = int(params.get('teeth', 20))
-        module = float(params.get('module', 1.0))
-        width = float(params.get('width', 5.0))
-        bore_d = float(params.get('bore_d', 5.0))
-        pressure_angle = float(params.get('pressure_angle', 20.0))
-        shaft_type = params.get('shaft_type', 'circle')
-        helix_angle = float(params.get('helix_angle', 0.0))
-        gear_type = params.get('gear_type', 'spur')
-        backlash = float(params.get('backlash', 0.0))
-
-        gear_obj = Gear(teeth=teeth, module=module, width=width,
-                        bore_d=bore_d, pressure_angle=pressure_angle,
-                        shaft_type=shaft_type, helix_angle=helix_angle,
-                        gear_type=gear_type, backlash=backlash)
-
-        cq_obj = gear_obj.render()
-        validate_geometry(cq_obj)
-
-        bb = cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
-
-        if output_path and format:
-            if format == 'step':
-                gear_obj.save_step_file(output_path)
-            elif format == 'stl':
-                gear_obj.save_stl_file(output_path)
+        with tracing.span("generate.build", tracing.param_attributes('gear', params)):
+            gear_obj = Gear(**params)
+            cq_obj = render_part('gear', gear_obj, params)
 
-        return dims
+        return validate_and_export('gear', gear_obj, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
         raise GenerationError(str(e))
 
-def generate_hinge_task(params, settings, output_path=None, format=None):
+def generate_hinge_task(params, settings, output_path=None, format=None, lods=()):
+    params = checked_params('hinge', params)
     try:
-        length = float(params.get('length', 40.0))
-        width = float(params.get('width', 40.0))
-        height = float(params.get('height', 5.0))
-        pin_diam = float(params.get('pin_diam', 3.0))
-        clearance = float(params.get('clearance', 0.4))
-
-        hinge_obj = Hinge(length=length, width=width, height=height,
-                          pin_diam=pin_diam, clearance=clearance)
-
-        cq_obj = hinge_obj.render()
-        validate_geometry(cq_obj)
-
-        bb = cq_obj.val().BoundingBox()
-        dims = {"x": bb.xlen, "y": bb.ylen, "z": bb.zlen}
-
-        if output_path and format:
-            if format == 'step':
-                hinge_obj.save_step_file(output_path)
-            elif format == 'stl':
-                hinge_obj.save_stl_file(output_path)
+        with tracing.span("generate.build", tracing.param_attributes('hinge', params)):
+            hinge_obj = Hinge(**params)
+            cq_obj = render_part('hinge', hinge_obj, params)
 
-        return dims
+        return validate_and_export('hinge', hinge_obj, cq_obj, output_path, format, lods)
     except Exception as e:
         if isinstance(e, GeometryValidationError):
             raise e
@@ -0,0 +1,39 @@
+"""
+What the web process needs to know about the generators, without the CAD stack.
+
+Importing generation_utils loads cadquery, OCP and every generator module, which takes
+seconds and a few hundred MB. Generation only ever runs in worker processes, so the web
+process refers to the tasks by name ("module:function", resolved by task_runner inside
+the worker) and takes the exception types and preview mesh levels from here.
+"""
+import os
+
+# Part of the key of cached artifacts and of their ETags: bump it when a change to the
+# generators changes their output, so clients and caches do not keep the old files
+ARTIFACT_VERSION = 2
+
+# Generation task of each generator, run in a worker process
+TASKS = {
+    'box': 'generation_utils:generate_box_task',
+    'lid': 'generation_utils:generate_lid_task',
+    'baseplate': 'generation_utils:generate_baseplate_task',
+    'gear': 'generation_utils:generate_gear_task',
+    'tube_adapter': 'generation_utils:generate_tube_adapter_task',
+    'hinge': 'generation_utils:generate_hinge_task',
+}
+
+# Preview meshes coarser than the part's own STL export: (linear, angular) tolerance
+MESH_LODS = {
+    'coarse': (0.5, 0.8),
+    'medium': (0.1, 0.3),
+}
+
+class GeometryValidationError(Exception):
+    pass
+
+class GenerationError(Exception):
+    pass
+
+def lod_path(output_path, lod):
+    """Where an STL export to output_path puts its `lod` preview mesh."""
+    return f"{os.path.splitext(output_path)[0]}.{lod}.stl"
@@ -0,0 +1,148 @@
+"""
+Gridfinity parts built from memoized building blocks.
+
+Boxes, lids and baseplates repeat the same sub-features: one foot (or baseplate cell
+cutter) per grid cell, composited into a grid, and corner screw tabs. These subclasses
+of the cqgridfinity parts take those shapes from the stage cache, keyed on the scaled
+constants set by update_constants() and the dimensions they depend on, so a warm worker
+only builds the features that actually changed.
+
+Constants are read from the cqgridfinity modules at render time because
+update_constants() patches them per request.
+
+The upstream cq_obj property renders the part again on every access (validation and
+export each read it); these classes keep the rendered object instead, and accept an
+assigned one (e.g. a finished shape loaded from the shape store). They also export
+through part_export, so the same part always gives the same bytes.
+"""
+import cadquery as cq
+import cqgridfinity
+import cqgridfinity.constants
+from cqgridfinity import gf_baseplate, gf_box
+from cqkit import VerticalEdgeSelector, HasZCoordinateSelector
+from cqkit.cq_helpers import composite_from_pts, recentre, rotate_x, rounded_rect_sketch
+
+import stage_cache
+from part_export import export_step, export_stl
+
+# Constants update_constants() scales from the GRU/GRHU settings
+SCALED_CONSTANTS = [
+    'GRU', 'GRHU', 'GRU2', 'GRU_CUT',
+    'GR_HOLE_DIST', 'GR_BREG_R0', 'GR_BREG_R1',
+    'GR_BOT_H', 'GR_BASE_HEIGHT',
+    'GR_BASE_PROFILE', 'GR_BOX_PROFILE'
+]
+
+
+def constants_key():
+    return tuple(getattr(cqgridfinity.constants, name) for name in SCALED_CONSTANTS)
+
+
+class KeepsRender:
+    @property
+    def cq_obj(self):
+        if self._cq_obj is None:
+            return self.render()
+        return self._cq_obj
+
+    @cq_obj.setter
+    def cq_obj(self, obj):
+        self._cq_obj = obj
+
+    def save_step_file(self, filename):
+        export_step(self.cq_obj.val(), filename, self.filename())
+
+    def save_stl_file(self, filename, tol=1e-2, ang_tol=0.1):
+        # The tolerances of the upstream save_stl_file(), which writes ASCII
+        export_stl(self.cq_obj.val(), filename, tol, ang_tol, relative=True)
+
+
+class GridfinityBox(KeepsRender, cqgridfinity.GridfinityBox):
+    def render(self):
+        self._cq_obj = super().render()
+        return self._cq_obj
+
+    def render_shell(self, as_solid=False):
+        """Renders the box shell; the outer solid only depends on the size in units."""
+        key = (constants_key(), self.length_u, self.width_u, self.height_u, self.outer_rad)
+        rc = cq.Workplane("XY").add(stage_cache.memo("gridfinity.box_shell", key, self._render_outer))
+        if not as_solid:
+            return rc.cut(self.interior_solid)
+        return rc
+
+    def _render_outer(self):
+        key = (constants_key(), self.length_u, self.width_u, self.outer_rad)
+        r = cq.Workplane("XY").add(stage_cache.memo("gridfinity.box_feet", key, self._render_feet))
+        rs = rounded_rect_sketch(*self.outer_dim, self.outer_rad)
+        rw = (
+            cq.Workplane("XY")
+            .placeSketch(rs)
+            .extrude(self.bin_height - gf_box.GR_BASE_CLR)
+            .translate((*self.half_dim, gf_box.GR_BASE_CLR))
+        )
+        rc = (
+            cq.Workplane("XY")
+            .placeSketch(rs)
+            .extrude(-gf_box.GR_BASE_HEIGHT - 1)
+            .translate((*self.half_dim, 0.5))
+        )
+        return rc.intersect(r).union(rw).val()
+
+    def _render_feet(self):
+        key = (constants_key(), self.outer_rad)
+        foot = cq.Workplane("XY").add(stage_cache.memo("gridfinity.box_foot", key, self._render_foot))
+        return composite_from_pts(foot, self.grid_centres).val()
+
+    def _render_foot(self):
+        r = self.extrude_profile(
+            rounded_rect_sketch(gf_box.GRU, gf_box.GRU, self.outer_rad + gf_box.GR_BASE_CLR),
+            gf_box.GR_BOX_PROFILE,
+        )
+        r = r.translate((0, 0, -gf_box.GR_BASE_CLR))
+        return r.mirror(mirrorPlane="XY").val()
+
+
+class GridfinityBaseplate(KeepsRender, cqgridfinity.GridfinityBaseplate):
+    def render(self):
+        key = (constants_key(), self.length_u, self.width_u, self.straight_bottom, self.ext_depth)
+        rc = cq.Workplane("XY").add(stage_cache.memo("gridfinity.baseplate_cells", key, self._render_cells))
+        r = (
+            cq.Workplane("XY")
+            .rect(self.length, self.width)
+            .extrude(gf_baseplate.GR_BASE_HEIGHT + self.ext_depth)
+            .edges("|Z")
+            .fillet(gf_baseplate.GR_RAD)
+            .faces(">Z")
+            .cut(rc)
+        )
+        if self.corner_screws:
+            key = (self.ext_depth, self.corner_tab_size, self.csk_hole, self.csk_diam, self.csk_angle)
+            rs = cq.Workplane("XY").add(stage_cache.memo("gridfinity.screw_tab", key, self._render_screw_tab))
+            r = r.union(recentre(composite_from_pts(rs, self._corner_pts()), "XY"))
+            bs = VerticalEdgeSelector(self.ext_depth) & HasZCoordinateSelector(0)
+            r = r.edges(bs).fillet(gf_baseplate.GR_RAD)
+        self._cq_obj = r
+        return r
+
+    def _render_cells(self):
+        key = (constants_key(), self.straight_bottom, self.ext_depth)
+        rc = cq.Workplane("XY").add(stage_cache.memo("gridfinity.baseplate_cell", key, self._render_cell))
+        return recentre(composite_from_pts(rc, self.grid_centres), "XY").val()
+
+    def _render_cell(self):
+        profile = gf_baseplate.GR_BASE_PROFILE if not self.straight_bottom else gf_baseplate.GR_STR_BASE_PROFILE
+        if self.ext_depth > 0:
+            profile = [*profile, self.ext_depth]
+        rc = self.extrude_profile(
+            rounded_rect_sketch(gf_baseplate.GRU_CUT, gf_baseplate.GRU_CUT, gf_baseplate.GR_RAD), profile
+        )
+        rc = rotate_x(rc, 180).translate((gf_baseplate.GRU2, gf_baseplate.GRU2,
+                                          gf_baseplate.GR_BASE_HEIGHT + self.ext_depth))
+        return rc.val()
+
+    def _render_screw_tab(self):
+        rs = cq.Sketch().rect(self.corner_tab_size, self.corner_tab_size)
+        rs = cq.Workplane("XY").placeSketch(rs).extrude(self.ext_depth)
+        return rs.faces(">Z").cskHole(
+            self.csk_hole, cskDiameter=self.csk_diam, cskAngle=self.csk_angle
+        ).val()
@@ -1,7 +1,11 @@
 import cqgridfinity
+import cqgridfinity.constants
 import cadquery as cq
 
-class GridfinityBoxLid(cqgridfinity.GridfinityBox):
+import stage_cache
+from gridfinity_blocks import GridfinityBox
+
+class GridfinityBoxLid(GridfinityBox):
     def __init__(self, length_u, width_u, height_u=1.0, handle_style="none", handle_height=5.0, **kwargs):
         # Force solid and no_lip for lid
         kwargs['solid'] = True
@@ -16,8 +20,11 @@ class GridfinityBoxLid(cqgridfinity.GridfinityBox):
         self.handle_height = handle_height
 
     def render(self):
-        # Render the base box (lid body)
-        box = super().render()
+        # Render the base box (lid body); memoized so changing only the handle reuses it
+        body_key = (self.length_u, self.width_u, self.height_u,
+                    cqgridfinity.constants.GRU, cqgridfinity.constants.GRHU)
+        body = stage_cache.memo("lid.body", body_key, lambda: self._render_body().val())
+        box = cq.Workplane("XY").add(body)
 
         if self.handle_style == "simple" or self.handle_style == "loop":
             # Calculate handle dimensions
@@ -61,3 +68,6 @@ class GridfinityBoxLid(cqgridfinity.GridfinityBox):
 
         self._cq_obj = box
         return box
+
+    def _render_body(self):
+        return super().render()
@@ -1,4 +1,5 @@
 import cadquery as cq
+from part_export import export_step, export_stl
 
 class Hinge:
     def __init__(self, length=40.0, width=40.0, height=5.0, pin_diam=3.0, clearance=0.4):
@@ -117,8 +118,8 @@ class Hinge:
 
     def save_step_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStep(filename)
+        export_step(self.cq_obj.val(), filename, 'hinge')
 
     def save_stl_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStl(filename)
+        export_stl(self.cq_obj.val(), filename, 1e-3, 0.1, relative=True)
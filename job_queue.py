@@ -0,0 +1,542 @@
+"""
+Queue of generation jobs for worker daemons on other machines.
+
+By default the web server runs every generation in a local worker process (see
+task_runner.py). With JOB_QUEUE set it submits them to this queue instead, and worker
+daemons (python -m worker, see worker.py) on any number of machines claim and run them,
+so the CPU-heavy gears and baseplates do not need the web tier's hosts. Workers upload
+the generated files to the artifact store (the mesh cache and its shared backend, see
+cache_backends.py) and report the dimensions and any error here; the web server waits
+for that and copies the files from the store.
+
+A running job carries the heartbeat of its worker. A job whose heartbeat is older than
+JOB_STALE_SECONDS (its worker died or lost the network) goes back to the queue, up to
+JOB_MAX_ATTEMPTS tries; failures of the generation itself are final, since they repeat.
+A job submitted with a canonical key (the part's artifact key) is joined by every later
+submission of the same key while it is queued or running, from any web process: a user
+who resubmits a heavy part after a deploy or a crash waits for the job already under way
+instead of queueing another. A job is cancelled once every submission gave up on it (the
+clients left or timed out), and its worker stops it at the next heartbeat.
+
+Jobs are durable: the SQLite queue is a file, and jobs outlive the web process that
+submitted them. Queued jobs are picked up by the workers (or JOB_LOCAL_WORKERS) after a
+restart, running ones are retried once their heartbeat is stale, and the results land in
+the artifact store for the next request. Each job records its params, state, timings,
+worker and the address of its artifact (GET /admin/jobs); finished jobs are kept for
+JOB_KEEP_SECONDS.
+
+Backends:
+
+- SQLiteQueue: a SQLite database, the default. Every worker must open the same file:
+  workers on the web host, or a volume whose locking SQLite supports (not most NFS).
+- RedisQueue: Redis or a server speaking its protocol, through the optional redis
+  package, for workers on other machines.
+
+Jobs are plain JSON: the task ("module:function") and its keyword arguments.
+
+Configuration (environment):
+    JOB_QUEUE               sqlite:///path/jobs.db (or a path) or redis://host:port/db
+                            (default: unset, generations run in local worker processes)
+    JOB_HEARTBEAT_SECONDS   how often workers report on a running job (default: 5)
+    JOB_STALE_SECONDS       a running job without a heartbeat for this long is retried (default: 30)
+    JOB_MAX_ATTEMPTS        tries of a job whose worker died (default: 3)
+    JOB_QUEUE_TIMEOUT       seconds a job may wait for a worker before it times out (default: 60)
+    JOB_KEEP_SECONDS        how long finished jobs are kept (default: 86400)
+    JOB_LOCAL_WORKERS       jobs the web server runs itself from the queue (default: 0)
+    JOB_QUEUE_SLOTS         jobs each web server has queued or running at once, instead of its
+                            own generation slots; about the WORKER_CONCURRENCY of all workers
+                            together (default: 32)
+"""
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from cancellation import Cancelled
+from feasibility import Infeasible
+from generators import GenerationError, GeometryValidationError
+from params import InvalidParams
+from task_runner import TaskTimeout
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Errors a job can end with, re-raised by the web server; any other becomes GenerationError
+ERRORS = {cls.__name__: cls for cls in (GeometryValidationError, GenerationError, TimeoutError, TaskTimeout,
+                                        InvalidParams, Infeasible)}
+
+POLL_INTERVAL = 0.1
+
+
+class WorkerLost(GenerationError):
+    """The job's worker died on every attempt."""
+
+
+ERRORS[WorkerLost.__name__] = WorkerLost
+
+
+def error_text(error):
+    """How a job's error is stored: the message, or the per-field errors of invalid params (JSON)."""
+    if isinstance(error, InvalidParams):
+        return json.dumps(error.errors)
+    return str(error)
+
+
+class Job:
+    def __init__(self, id, task, kwargs, state=QUEUED, attempts=0, worker=None, heartbeat=None,
+                 result=None, error_type=None, error=None, created=None, started=None, finished=None,
+                 key=None, waiters=1, artifact=None):
+        self.id = id
+        self.task = task
+        self.kwargs = kwargs
+        self.state = state
+        self.attempts = attempts
+        self.worker = worker
+        self.heartbeat = heartbeat
+        self.result = result
+        self.error_type = error_type
+        self.error = error
+        self.created = created
+        self.started = started
+        self.finished = finished
+        self.key = key
+        self.waiters = waiters
+        self.artifact = artifact
+
+    def raise_error(self):
+        """Raise the error the job ended with (a failed or cancelled job)."""
+        if self.state == CANCELLED:
+            raise Cancelled(self.error or "cancelled")
+        error_type = ERRORS.get(self.error_type, GenerationError)
+        if issubclass(error_type, InvalidParams):
+            raise error_type(json.loads(self.error))
+        raise error_type(self.error)
+
+    def as_dict(self):
+        job = {name: getattr(self, name) for name in
+               ("id", "key", "task", "state", "attempts", "worker", "waiters", "artifact", "error_type", "error",
+                "created", "started", "finished")}
+        job["params"] = self.kwargs.get("params")
+        job["wait_seconds"] = self.started - self.created if self.started is not None else None
+        job["run_seconds"] = self.finished - self.started if None not in (self.started, self.finished) else None
+        return job
+
+
+class JobQueue(abc.ABC):
+    """
+    What the web server and the workers share. Subclasses store the jobs; this class
+    implements waiting for a result on top of get().
+    """
+
+    def __init__(self, heartbeat_seconds=5.0, stale_seconds=30.0, max_attempts=3, queue_timeout=60.0,
+                 keep_seconds=86400.0, clock=time.time):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.queue_timeout = queue_timeout
+        self.keep_seconds = keep_seconds
+        self._clock = clock
+
+    @abc.abstractmethod
+    def submit(self, task, kwargs, key=None):
+        """Queue a job, or join the queued or running job of key; returns its id."""
+
+    @abc.abstractmethod
+    def claim(self, worker):
+        """The oldest queued job, now running on worker, or None."""
+
+    @abc.abstractmethod
+    def heartbeat(self, job_id, worker):
+        """Report that worker still runs the job; False if it should stop (cancelled, taken over)."""
+
+    @abc.abstractmethod
+    def finish(self, job_id, worker, result=None, error=None, artifact=None):
+        """Record the result (JSON) or the error (an exception) of a job worker ran, and where its files are."""
+
+    @abc.abstractmethod
+    def cancel(self, job_id, reason="cancelled"):
+        """Give up one submission of the job; the last one cancels it."""
+
+    @abc.abstractmethod
+    def get(self, job_id):
+        """The job with this id (a Job), or None."""
+
+    @abc.abstractmethod
+    def recent(self, limit=50):
+        """The latest jobs submitted, newest first."""
+
+    @abc.abstractmethod
+    def requeue_stale(self):
+        """Retry running jobs whose worker stopped sending heartbeats; returns how many."""
+
+    def stats(self):
+        return {}
+
+    def run(self, task, kwargs, timeout, cancel=None, key=None):
+        """
+        Submit a job (see submit) and wait for its result, like run_task_with_timeout:
+        timeout counts from when a worker starts the job, which must happen within
+        queue_timeout. Raises the job's error, TimeoutError or Cancelled.
+        """
+        return self.run_job(task, kwargs, timeout, cancel, key).result
+
+    def run_job(self, task, kwargs, timeout, cancel=None, key=None):
+        """Like run, but returns the finished Job, with its timings."""
+        job_id = self.submit(task, dict(kwargs, timeout=timeout), key)
+        queued_until = time.monotonic() + self.queue_timeout
+        deadline = None
+        reaped = time.monotonic()
+        while True:
+            job = self.get(job_id)
+            if job.state == DONE:
+                return job
+            if job.state in FINISHED:
+                job.raise_error()
+            if cancel is not None and cancel.is_set():
+                self.cancel(job_id, cancel.reason)
+                raise Cancelled(cancel.reason)
+            now = time.monotonic()
+            if job.state == RUNNING and deadline is None:
+                # Some slack for the worker to start the process and upload the files
+                deadline = now + timeout + self.stale_seconds
+            if now >= (deadline or queued_until):
+                self.cancel(job_id, "timed out")
+                raise TimeoutError(f"Job {job_id} timed out {'running' if deadline else 'waiting for a worker'}")
+            if now - reaped >= self.heartbeat_seconds:
+                # Workers retry stale jobs when they claim; this covers all of them being gone
+                self.requeue_stale()
+                reaped = now
+            time.sleep(POLL_INTERVAL)
+
+
+class SQLiteQueue(JobQueue):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            task TEXT NOT NULL,
+            kwargs TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            heartbeat REAL,
+            result TEXT,
+            error_type TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            key TEXT,
+            waiters INTEGER NOT NULL DEFAULT 1,
+            artifact TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, created);
+    """
+    # Columns added since the first schema, added to older databases on open
+    ADDED_COLUMNS = {"key": "TEXT", "waiters": "INTEGER NOT NULL DEFAULT 1", "artifact": "TEXT"}
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS jobs_by_key ON jobs (key, state);
+        CREATE INDEX IF NOT EXISTS jobs_by_created ON jobs (created);
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.executescript(self.SCHEMA)
+        columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+        for name, definition in self.ADDED_COLUMNS.items():
+            if name not in columns:
+                db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+        db.executescript(self.INDEXES)
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    class _Transaction:
+        def __init__(self, db):
+            self.db = db
+
+        def __enter__(self):
+            # IMMEDIATE: take the write lock up front, so two workers never claim one job
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db
+
+        def __exit__(self, exc_type, exc, tb):
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+    def _transaction(self):
+        return self._Transaction(self._db())
+
+    def _job(self, row):
+        if row is None:
+            return None
+        return Job(row["id"], row["task"], json.loads(row["kwargs"]), row["state"], row["attempts"],
+                   row["worker"], row["heartbeat"], json.loads(row["result"]) if row["result"] else None,
+                   row["error_type"], row["error"], row["created"], row["started"], row["finished"],
+                   row["key"], row["waiters"], row["artifact"])
+
+    def submit(self, task, kwargs, key=None):
+        with self._transaction() as db:
+            if key is not None:
+                row = db.execute("SELECT id FROM jobs WHERE key = ? AND state IN (?, ?)",
+                                 (key, QUEUED, RUNNING)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET waiters = waiters + 1 WHERE id = ?", (row["id"],))
+                    return row["id"]
+            job_id = uuid.uuid4().hex
+            db.execute("INSERT INTO jobs (id, task, kwargs, state, created, key) VALUES (?, ?, ?, ?, ?, ?)",
+                       (job_id, task, json.dumps(kwargs), QUEUED, self._clock(), key))
+        return job_id
+
+    def claim(self, worker):
+        now = self._clock()
+        with self._transaction() as db:
+            self._requeue_stale(db, now)
+            row = db.execute("SELECT id FROM jobs WHERE state = ? ORDER BY created LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = ?, worker = ?, heartbeat = ?, started = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (RUNNING, worker, now, now, row["id"]))
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def heartbeat(self, job_id, worker):
+        with self._transaction() as db:
+            updated = db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = ? AND worker = ?",
+                                 (self._clock(), job_id, RUNNING, worker)).rowcount
+        return updated == 1
+
+    def finish(self, job_id, worker, result=None, error=None, artifact=None):
+        state = DONE if error is None else FAILED
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = ?, result = ?, error_type = ?, error = ?, artifact = ?, finished = ? "
+                       "WHERE id = ? AND state = ? AND worker = ?",
+                       (state, json.dumps(result) if error is None else None,
+                        type(error).__name__ if error is not None else None,
+                        error_text(error) if error is not None else None,
+                        artifact, self._clock(), job_id, RUNNING, worker))
+
+    def cancel(self, job_id, reason="cancelled"):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET waiters = waiters - 1 WHERE id = ? AND state IN (?, ?)",
+                       (job_id, QUEUED, RUNNING))
+            db.execute("UPDATE jobs SET state = ?, error = ?, finished = ? "
+                       "WHERE id = ? AND state IN (?, ?) AND waiters <= 0",
+                       (CANCELLED, reason, self._clock(), job_id, QUEUED, RUNNING))
+
+    def get(self, job_id):
+        return self._job(self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def recent(self, limit=50):
+        rows = self._db().execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def _requeue_stale(self, db, now):
+        stale = db.execute("SELECT id, attempts FROM jobs WHERE state = ? AND heartbeat < ?",
+                           (RUNNING, now - self.stale_seconds)).fetchall()
+        for row in stale:
+            if row["attempts"] < self.max_attempts:
+                db.execute("UPDATE jobs SET state = ?, worker = NULL WHERE id = ?", (QUEUED, row["id"]))
+            else:
+                db.execute("UPDATE jobs SET state = ?, error_type = ?, error = ?, finished = ? WHERE id = ?",
+                           (FAILED, WorkerLost.__name__, f"Worker died running the job {row['attempts']} times",
+                            now, row["id"]))
+        # Finished jobs are only kept for their waiters
+        db.execute(f"DELETE FROM jobs WHERE state IN ({', '.join('?' * len(FINISHED))}) AND finished < ?",
+                   (*FINISHED, now - self.keep_seconds))
+        return len(stale)
+
+    def requeue_stale(self):
+        with self._transaction() as db:
+            return self._requeue_stale(db, self._clock())
+
+    def stats(self):
+        rows = self._db().execute("SELECT state, COUNT(*) AS jobs FROM jobs GROUP BY state").fetchall()
+        return {"backend": "sqlite", "path": self.path, **dict.fromkeys((QUEUED, RUNNING, *FINISHED), 0),
+                **{row["state"]: row["jobs"] for row in rows}}
+
+
+class RedisQueue(JobQueue):
+    """
+    Job ids wait in a list; each job is a hash. A worker moves an id to the claimed list
+    atomically, then marks the job running and adds it to the running set, scored by
+    heartbeat, in one transaction. An id left on the claimed list by a worker that died
+    in between is put back once it has been seen there for JOB_STALE_SECONDS. The job of
+    a key is a string naming its id; the latest RECENT ids are kept in a list.
+    """
+
+    RECENT = 1000
+
+    def __init__(self, client, prefix="opengridgen:jobs:", **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("JOB_QUEUE=redis://... needs the redis package (pip install redis)") from None
+        return cls(redis.Redis.from_url(url, decode_responses=True, socket_timeout=10), **kwargs)
+
+    def _name(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def submit(self, task, kwargs, key=None):
+        job_id = uuid.uuid4().hex
+        if key is not None:
+            current = self.client.get(self._name("key", key))
+            if current is not None and self.client.hget(self._name("job", current), "state") in (QUEUED, RUNNING):
+                self.client.hincrby(self._name("job", current), "waiters", 1)
+                return current
+        job = {"task": task, "kwargs": json.dumps(kwargs), "state": QUEUED, "attempts": 0, "waiters": 1,
+               "created": self._clock(), "key": key or ""}
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self._name("job", job_id), mapping=job)
+        if key is not None:
+            pipe.set(self._name("key", key), job_id, ex=int(self.keep_seconds))
+        pipe.lpush(self._name("recent"), job_id)
+        pipe.ltrim(self._name("recent"), 0, self.RECENT - 1)
+        pipe.lpush(self._name("queue"), job_id)
+        pipe.execute()
+        return job_id
+
+    def claim(self, worker):
+        self.requeue_stale()
+        while True:
+            job_id = self.client.rpoplpush(self._name("queue"), self._name("claimed"))
+            if job_id is None:
+                return None
+            if self.client.hget(self._name("job", job_id), "state") != QUEUED:
+                # Cancelled while queued
+                self.client.lrem(self._name("claimed"), 0, job_id)
+                continue
+            now = self._clock()
+            pipe = self.client.pipeline(transaction=True)
+            pipe.hset(self._name("job", job_id), mapping={
+                "state": RUNNING, "worker": worker, "heartbeat": now, "started": now})
+            pipe.hincrby(self._name("job", job_id), "attempts", 1)
+            pipe.zadd(self._name("running"), {job_id: now})
+            pipe.lrem(self._name("claimed"), 0, job_id)
+            pipe.execute()
+            return self.get(job_id)
+
+    def heartbeat(self, job_id, worker):
+        job = self.client.hmget(self._name("job", job_id), "state", "worker")
+        if job != [RUNNING, worker]:
+            return False
+        now = self._clock()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self._name("job", job_id), "heartbeat", now)
+        pipe.zadd(self._name("running"), {job_id: now})
+        pipe.execute()
+        return True
+
+    def finish(self, job_id, worker, result=None, error=None, artifact=None):
+        if self.client.hmget(self._name("job", job_id), "state", "worker") != [RUNNING, worker]:
+            return
+        fields = {"state": DONE, "result": json.dumps(result), "artifact": artifact or "", "finished": self._clock()}
+        if error is not None:
+            fields = {"state": FAILED, "error_type": type(error).__name__, "error": error_text(error),
+                      "finished": self._clock()}
+        self._end(job_id, fields)
+
+    def _end(self, job_id, fields):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self._name("job", job_id), mapping=fields)
+        pipe.zrem(self._name("running"), job_id)
+        pipe.expire(self._name("job", job_id), int(self.keep_seconds))
+        pipe.execute()
+
+    def cancel(self, job_id, reason="cancelled"):
+        state = self.client.hget(self._name("job", job_id), "state")
+        if state not in (QUEUED, RUNNING):
+            return
+        if self.client.hincrby(self._name("job", job_id), "waiters", -1) > 0:
+            return
+        self._end(job_id, {"state": CANCELLED, "error": reason, "finished": self._clock()})
+        if state == QUEUED:
+            self.client.lrem(self._name("queue"), 0, job_id)
+
+    def get(self, job_id):
+        values = self.client.hgetall(self._name("job", job_id))
+        if not values:
+            return None
+        number = lambda name: float(values[name]) if values.get(name) not in (None, "") else None
+        return Job(job_id, values["task"], json.loads(values["kwargs"]), values["state"], int(values["attempts"]),
+                   values.get("worker") or None, number("heartbeat"),
+                   json.loads(values["result"]) if values.get("result") else None,
+                   values.get("error_type"), values.get("error"),
+                   number("created"), number("started"), number("finished"),
+                   values.get("key") or None, int(values.get("waiters", 1)), values.get("artifact") or None)
+
+    def recent(self, limit=50):
+        jobs = (self.get(job_id) for job_id in self.client.lrange(self._name("recent"), 0, limit - 1))
+        return [job for job in jobs if job is not None]
+
+    def requeue_stale(self):
+        now = self._clock()
+        requeued = 0
+        for job_id in self.client.zrangebyscore(self._name("running"), 0, now - self.stale_seconds):
+            # Only the caller that removes it from the running set retries it
+            if not self.client.zrem(self._name("running"), job_id):
+                continue
+            requeued += 1
+            attempts = int(self.client.hget(self._name("job", job_id), "attempts") or 0)
+            if attempts < self.max_attempts:
+                pipe = self.client.pipeline(transaction=True)
+                pipe.hset(self._name("job", job_id), mapping={"state": QUEUED, "worker": ""})
+                pipe.rpush(self._name("queue"), job_id)
+                pipe.execute()
+            else:
+                self._end(job_id, {"state": FAILED, "error_type": WorkerLost.__name__,
+                                   "error": f"Worker died running the job {attempts} times", "finished": now})
+        seen = self._name("claimed_seen")
+        claimed = set(self.client.lrange(self._name("claimed"), 0, -1))
+        for job_id, first_seen in self.client.hgetall(seen).items():
+            if job_id not in claimed:
+                self.client.hdel(seen, job_id)
+            elif float(first_seen) < now - self.stale_seconds and self.client.lrem(self._name("claimed"), 0, job_id):
+                self.client.rpush(self._name("queue"), job_id)
+                self.client.hdel(seen, job_id)
+        for job_id in claimed:
+            self.client.hsetnx(seen, job_id, now)
+        return requeued
+
+    def stats(self):
+        return {"backend": "redis", QUEUED: self.client.llen(self._name("queue")),
+                RUNNING: self.client.zcard(self._name("running"))}
+
+
+def queue_from_env(env=None):
+    """The queue configured by JOB_QUEUE, or None."""
+    env = os.environ if env is None else env
+    url = env.get("JOB_QUEUE")
+    if not url:
+        return None
+    options = {
+        "heartbeat_seconds": float(env.get("JOB_HEARTBEAT_SECONDS", 5)),
+        "stale_seconds": float(env.get("JOB_STALE_SECONDS", 30)),
+        "max_attempts": int(env.get("JOB_MAX_ATTEMPTS", 3)),
+        "queue_timeout": float(env.get("JOB_QUEUE_TIMEOUT", 60)),
+        "keep_seconds": float(env.get("JOB_KEEP_SECONDS", 86400)),
+    }
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisQueue.from_url(url, **options)
+    path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url
+    return SQLiteQueue(path, **options)
@@ -0,0 +1,104 @@
+"""
+Warm workers for live preview.
+
+With live preview enabled the page re-renders shortly after every input change. Those
+previews (X-Live-Preview: 1 with an X-Preview-Session) run on a worker process bound to
+the session instead of a fresh process per request: no start-up cost, and the worker's
+stage cache still holds the intermediate shapes of the previous preview, so nudging a
+single parameter only rebuilds what depends on it.
+
+Each warm worker holds a CadQuery process in memory, so their number is capped. When
+every worker is taken the least recently used idle one is handed over; if all of them
+are busy the preview falls back to a one-shot process.
+
+Configuration (environment):
+    LIVE_PREVIEW_MAX_WORKERS   warm workers kept at most (default: 2, 0 disables live preview workers)
+    LIVE_PREVIEW_IDLE_SECONDS  idle time after which a worker is stopped (default: 120)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from task_runner import SessionWorker
+
+# A worker handed out moments ago is about to be used; never evict it for another session
+MIN_IDLE_BEFORE_EVICTION = 1.0
+
+
+class LivePreviewPool:
+    def __init__(self, max_workers=2, idle_seconds=120.0):
+        self.max_workers = max_workers
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._workers = OrderedDict()  # session -> SessionWorker, least recently used first
+        self.started = 0
+        self.reused = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        return cls(
+            max_workers=int(env.get("LIVE_PREVIEW_MAX_WORKERS", 2)),
+            idle_seconds=float(env.get("LIVE_PREVIEW_IDLE_SECONDS", 120)),
+        )
+
+    def worker_for(self, session):
+        """The warm worker of a session, starting one if possible; None to use a one-shot process."""
+        if self.max_workers <= 0:
+            return None
+        # Processes are started and stopped outside the lock: stopping one can take a second
+        with self._lock:
+            stopped = self._reap()
+            worker = self._workers.get(session)
+            if worker is not None:
+                self._workers.move_to_end(session)
+                self.reused += 1
+            elif len(self._workers) >= self.max_workers and not self._evict_idle(stopped):
+                self.fallbacks += 1
+            else:
+                worker = self._workers[session] = SessionWorker(start=False)
+                self.started += 1
+        for old in stopped:
+            old.stop()
+        if worker is not None:
+            # Every request handed a new worker starts it; only the first one does
+            worker.start()
+        return worker
+
+    def _evict_idle(self, stopped):
+        now = time.monotonic()
+        idle = next((s for s, w in self._workers.items()
+                     if not w.busy() and now - w.last_used > MIN_IDLE_BEFORE_EVICTION), None)
+        if idle is None:
+            return False
+        stopped.append(self._workers.pop(idle))
+        return True
+
+    def _reap(self):
+        """Remove the workers that exited or sat idle for too long; the caller stops them."""
+        now = time.monotonic()
+        reaped = []
+        for session, worker in list(self._workers.items()):
+            if not worker.alive() or (not worker.busy() and now - worker.last_used > self.idle_seconds):
+                reaped.append(self._workers.pop(session))
+        return reaped
+
+    def shutdown(self):
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "busy": sum(w.busy() for w in self._workers.values()),
+                "max_workers": self.max_workers,
+                "started": self.started,
+                "reused": self.reused,
+                "fallbacks": self.fallbacks,
+            }
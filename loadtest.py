@@ -0,0 +1,292 @@
+"""
+HTTP load test and capacity report for a running OpenGridGen instance.
+
+Replays a realistic mix of preview/download/info requests at increasing concurrency and
+reports latency percentiles, throughput, 408 (timeout) and error rates and host memory
+for each level, then writes a capacity report that can be compared across releases.
+
+By default each request draws its own dimensions near those of the mix (--params vary),
+so the numbers measure generation: identical requests would be answered by the mesh
+cache or share one generation. Grid sizes are whole numbers with few values near the
+mix, so some box and baseplate requests still repeat. --params fixed replays the mix as
+is and measures the cached path. The report records which mode it comes from.
+
+
+    python loadtest.py --url http://127.0.0.1:4242 --levels 1,2,4,8 --requests 20 --report capacity.json
+    python loadtest.py --url http://127.0.0.1:4242 --compare capacity.json
+    python loadtest.py --url http://127.0.0.1:4242 --params fixed --report cached.json
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from params import MODELS
+
+# (weight, path, kind, params). Weights follow real traffic: mostly box/baseplate previews.
+DEFAULT_MIX = [
+    (30, "/api/preview_box", "json", {"width": 2, "length": 2, "height": 3}),
+    (10, "/api/preview_box", "json", {"width": 1, "length": 1, "height": 2}),
+    (15, "/api/preview_baseplate", "json", {"width": 4, "length": 4}),
+    (10, "/api/preview_lid", "json", {"width": 2, "length": 2, "height": 0.5, "handle_style": "simple"}),
+    (10, "/api/preview_gear", "json", {"teeth": 30, "module": 1.0, "width": 5.0, "gear_type": "spur"}),
+    (5, "/api/preview_hinge", "json", {"length": 40, "width": 40, "height": 5}),
+    (5, "/api/preview_tube_adapter", "json", {"side_a_od": 6, "side_b_od": 8, "side_b_id": 6}),
+    (5, "/api/generate_box_info", "json", {"width": 3, "length": 2, "height": 4}),
+    (5, "/api/download_box", "form", {"width": 2, "length": 2, "height": 3, "format": "step"}),
+    (5, "/api/download_baseplate", "form", {"width": 3, "length": 3, "format": "stl"}),
+]
+
+# Kept as is: they pick what is generated rather than how big it is
+FIXED_PARAMS = {"format", "gear_type", "handle_style"}
+
+
+def generator_of(path):
+    """The generator an /api/ path runs: /api/preview_tube_adapter is tube_adapter."""
+    return path.rsplit("/", 1)[1].split("_", 1)[1].removesuffix("_info")
+
+
+def vary(generator, params, rng):
+    """
+    Feasible params near `params`, drawn from `rng`: counts and grid sizes within +-50%,
+    lengths and angles within +-10%, rounded to the default PARAM_QUANTUM.
+    """
+    fields = MODELS.get(generator, {})
+    varied = {}
+    for name, value in params.items():
+        kind = fields[name].kind if name in fields else None
+        if name in FIXED_PARAMS or kind not in (int, float):
+            varied[name] = value
+        elif kind is int:
+            varied[name] = rng.randint(max(1, int(value * 0.5 + 0.5)), int(value * 1.5 + 0.5))
+        else:
+            varied[name] = round(value * rng.uniform(0.9, 1.1), 2)
+    return varied
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def host_memory_mb():
+    """(total, available) host memory in MB from /proc/meminfo, or None where unavailable."""
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return info["MemTotal"] / 1024, info["MemAvailable"] / 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class MemorySampler:
+    """Samples host memory in the background while a level runs."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.min_available = None
+        self.total = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            mem = host_memory_mb()
+            if mem:
+                self.total = mem[0]
+                self.min_available = mem[1] if self.min_available is None else min(self.min_available, mem[1])
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def send(base_url, path, kind, params, timeout):
+    if kind == "json":
+        body = json.dumps(params).encode()
+        headers = {"Content-Type": "application/json"}
+    else:
+        body = urllib.parse.urlencode(params).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    req = urllib.request.Request(base_url.rstrip("/") + path, data=body, headers=headers, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            size = len(resp.read())
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        size = len(e.read())
+        status = e.code
+    except Exception:
+        # Connection refused/reset or client timeout
+        size = 0
+        status = 0
+    return {"path": path, "status": status, "latency": time.perf_counter() - start, "bytes": size}
+
+
+def run_level(base_url, concurrency, total_requests, mix=None, timeout=300, seed=0, params="vary"):
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    weights = [m[0] for m in mix]
+    picks = rng.choices(mix, weights=weights, k=total_requests)
+    if params == "vary":
+        picks = [(weight, path, kind, vary(generator_of(path), p, rng)) for weight, path, kind, p in picks]
+
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda m: send(base_url, m[1], m[2], m[3], timeout), picks))
+        elapsed = time.perf_counter() - start
+
+    return summarize(concurrency, results, elapsed, memory)
+
+
+def summarize(concurrency, results, elapsed, memory=None):
+    latencies = [r["latency"] for r in results]
+    ok = [r for r in results if r["status"] == 200]
+    count = len(results)
+    summary = {
+        "concurrency": concurrency,
+        "requests": count,
+        "duration": elapsed,
+        "throughput": len(ok) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "ok_rate": len(ok) / count if count else 0.0,
+        "timeout_rate": sum(r["status"] == 408 for r in results) / count if count else 0.0,
+        "error_rate": sum(r["status"] != 200 for r in results) / count if count else 0.0,
+        "status_counts": {},
+    }
+    for r in results:
+        summary["status_counts"][str(r["status"])] = summary["status_counts"].get(str(r["status"]), 0) + 1
+    if memory is not None and memory.total:
+        summary["host_memory_total_mb"] = memory.total
+        summary["host_memory_min_available_mb"] = memory.min_available
+    return summary
+
+
+def capacity(levels, p95_slo, max_error_rate):
+    """Highest concurrency that met the p95 latency SLO and error budget (0 if none did)."""
+    best = 0
+    for level in levels:
+        if level["p95"] is not None and level["p95"] <= p95_slo and level["error_rate"] <= max_error_rate:
+            best = max(best, level["concurrency"])
+    return best
+
+
+def markdown(report):
+    lines = [
+        f"# Capacity report ({report['url']})",
+        "",
+        f"Capacity: **{report['capacity']}** concurrent requests "
+        f"(p95 <= {report['p95_slo']}s, error rate <= {report['max_error_rate']:.0%})",
+        "",
+        "Params: " + ("fixed, mostly answered from the caches" if report.get("params") == "fixed"
+                      else "varied per request, mostly generated"),
+        "",
+        "| concurrency | req/s | p50 (s) | p95 (s) | p99 (s) | 408 rate | error rate | min host mem avail (MB) |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for lv in report["levels"]:
+        mem = lv.get("host_memory_min_available_mb")
+        mem_str = f"{mem:.0f}" if mem is not None else "-"
+        lines.append(
+            f"| {lv['concurrency']} | {lv['throughput']:.2f} | {lv['p50']:.2f} | {lv['p95']:.2f} | {lv['p99']:.2f} "
+            f"| {lv['timeout_rate']:.1%} | {lv['error_rate']:.1%} | {mem_str} |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def compare(previous, current):
+    """Human readable per-level differences between two reports."""
+    lines = [f"Capacity: {previous['capacity']} -> {current['capacity']}"]
+    # Reports from before --params replayed the mix as is
+    modes = previous.get("params", "fixed"), current.get("params", "fixed")
+    if modes[0] != modes[1]:
+        lines.append(f"Warning: params {modes[0]} -> {modes[1]}, cached and generated figures are not comparable")
+    prev_levels = {lv["concurrency"]: lv for lv in previous["levels"]}
+    for lv in current["levels"]:
+        old = prev_levels.get(lv["concurrency"])
+        if not old:
+            continue
+        lines.append(
+            f"c={lv['concurrency']}: p95 {old['p95']:.2f}s -> {lv['p95']:.2f}s, "
+            f"throughput {old['throughput']:.2f} -> {lv['throughput']:.2f} req/s, "
+            f"408 rate {old['timeout_rate']:.1%} -> {lv['timeout_rate']:.1%}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:4242")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per concurrency level")
+    parser.add_argument("--timeout", type=float, default=300, help="Client timeout per request (s)")
+    parser.add_argument("--p95-slo", type=float, default=10.0, help="p95 latency target used for the capacity figure")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--report", default="capacity_report.json", help="Report path (.md written alongside)")
+    parser.add_argument("--compare", help="Previous report to compare against")
+    parser.add_argument("--params", choices=("vary", "fixed"), default="vary",
+                        help="Draw dimensions per request (generation) or replay the mix as is (caches)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request picks and dimensions")
+    args = parser.parse_args(argv)
+
+    # Read the previous report up front, it may be the path we are about to overwrite
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    levels = []
+    for i, concurrency in enumerate(int(c) for c in args.levels.split(",")):
+        # Each level draws other dimensions, or it would hit the parts generated by the one before
+        seed = args.seed + i if args.params == "vary" else args.seed
+        level = run_level(args.url, concurrency, args.requests, timeout=args.timeout, seed=seed, params=args.params)
+        levels.append(level)
+        print(f"c={concurrency:3d} req/s={level['throughput']:.2f} p50={level['p50']:.2f}s p95={level['p95']:.2f}s "
+              f"p99={level['p99']:.2f}s 408={level['timeout_rate']:.1%} errors={level['error_rate']:.1%}")
+
+    report = {
+        "url": args.url,
+        "timestamp": time.time(),
+        "cpu_count": os.cpu_count(),
+        "requests_per_level": args.requests,
+        "params": args.params,
+        "seed": args.seed,
+        "p95_slo": args.p95_slo,
+        "max_error_rate": args.max_error_rate,
+        "capacity": capacity(levels, args.p95_slo, args.max_error_rate),
+        "levels": levels,
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.splitext(args.report)[0] + ".md", "w") as f:
+        f.write(markdown(report))
+    print(f"Capacity: {report['capacity']} concurrent requests, report written to {args.report}")
+
+    if previous:
+        print(compare(previous, report))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,264 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
+
+from logging_loki.emitter import LokiEmitterV1
+
+DEFAULT_TAGS = {"application": "opengridgen"}
+
+logger = logging.getLogger("loki_logging")
+
+
+class DropCountingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the calling thread.
+    When the bounded queue is full the record is dropped and counted instead.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingLokiHandler(logging.Handler):
+    """
+    Collects formatted records and pushes them to Loki in batches.
+    Only ever called from the QueueListener thread, never from a request thread.
+    """
+
+    def __init__(self, url, tags=None, auth=None, batch_size=100, timeout=5.0):
+        super().__init__()
+        self.emitter = LokiEmitterV1(url, tags, auth)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.buffer = []
+        self.sent = 0
+        self.failed = 0
+
+    def emit(self, record):
+        try:
+            self.buffer.append((record, self.format(record)))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def build_payload(self, batch):
+        """
+        Group records into one Loki stream per distinct label set.
+        """
+        streams = {}
+        for record, line in batch:
+            labels = self.emitter.build_tags(record)
+            key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+            if key not in streams:
+                streams[key] = {"stream": dict(key), "values": []}
+            streams[key]["values"].append([str(int(record.created * 1e9)), line])
+        return {"streams": list(streams.values())}
+
+    def flush(self):
+        self.acquire()
+        try:
+            batch, self.buffer = self.buffer, []
+        finally:
+            self.release()
+        if not batch:
+            return
+
+        try:
+            resp = self.emitter.session.post(self.emitter.url, json=self.build_payload(batch), timeout=self.timeout)
+            if resp.status_code != self.emitter.success_response_code:
+                raise ValueError(f"Unexpected Loki API response status code: {resp.status_code}")
+            self.sent += len(batch)
+        except Exception:
+            # Loki being down must never surface in the application, just account for it
+            self.failed += len(batch)
+            self.emitter.close()
+
+    def close(self):
+        self.flush()
+        self.emitter.close()
+        super().close()
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    QueueListener that flushes its handlers at most flush_interval seconds after the oldest
+    record not yet flushed, so a half-filled batch is shipped even while logs keep trickling in.
+    """
+
+    def __init__(self, log_queue, *handlers, flush_interval=1.0):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+        self._deadline = None  # when the oldest pending record must be flushed
+
+    def dequeue(self, block):
+        while True:
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                self._flush()
+            timeout = None if self._deadline is None else max(0.0, self._deadline - time.monotonic())
+            try:
+                record = self.queue.get(block, timeout=timeout)
+            except queue.Empty:
+                if not block:
+                    raise
+                continue
+            if self._deadline is None and record is not self._sentinel:
+                self._deadline = time.monotonic() + self.flush_interval
+            return record
+
+    def _flush(self):
+        self._deadline = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def enqueue_sentinel(self):
+        # The queue may be full of dropped-on-overflow records, wait for room instead of raising
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+class LokiShipper:
+    """
+    Wires a DropCountingQueueHandler to a BatchingLokiHandler through a bounded queue.
+    """
+
+    def __init__(self, url, tags=None, auth=None, batch_size=100, flush_interval=1.0, queue_size=10000, timeout=5.0):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_handler = DropCountingQueueHandler(self.queue)
+        self.loki_handler = BatchingLokiHandler(url, tags=tags, auth=auth, batch_size=batch_size, timeout=timeout)
+        self.listener = BatchingQueueListener(self.queue, self.loki_handler, flush_interval=flush_interval)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        self.listener.stop()
+
+    def stats(self):
+        return {
+            "enqueued": self.queue_handler.enqueued,
+            "dropped": self.queue_handler.dropped,
+            "queued": self.queue.qsize(),
+            "sent": self.loki_handler.sent,
+            "failed": self.loki_handler.failed,
+        }
+
+
+def loki_config_from_env(env=None):
+    """
+    Read the Loki settings described in .env.example.
+    Returns None when LOKI_URL is not set, which disables Loki logging.
+    """
+    env = os.environ if env is None else env
+
+    url = env.get("LOKI_URL")
+    if not url:
+        return None
+
+    tags = DEFAULT_TAGS
+    if env.get("LOKI_TAGS"):
+        try:
+            tags = json.loads(env["LOKI_TAGS"])
+            if not isinstance(tags, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as e:
+            # A typo in the logging settings must not keep the app from starting
+            logger.warning("Ignoring LOKI_TAGS, expected a JSON object of labels: %s", e)
+            tags = {}
+
+    auth = None
+    if env.get("LOKI_USERNAME"):
+        auth = (env["LOKI_USERNAME"], env.get("LOKI_PASSWORD", ""))
+
+    return {
+        "url": url,
+        "tags": tags,
+        "auth": auth,
+        "batch_size": int(env.get("LOKI_BATCH_SIZE", 100)),
+        "flush_interval": float(env.get("LOKI_FLUSH_INTERVAL", 1.0)),
+        "queue_size": int(env.get("LOKI_QUEUE_SIZE", 10000)),
+        "timeout": float(env.get("LOKI_TIMEOUT", 5.0)),
+    }
+
+
+def configure_loki_logging(logger, env=None):
+    """
+    Attach non-blocking Loki shipping to a logger.
+    Returns the running LokiShipper, or None if Loki is not configured.
+    """
+    config = loki_config_from_env(env)
+    if config is None:
+        return None
+
+    shipper = LokiShipper(**config)
+    shipper.start()
+    logger.addHandler(shipper.queue_handler)
+    atexit.register(shipper.stop)
+    return shipper
+
+
+class StubLokiReceiver:
+    """
+    Minimal local stand-in for the Loki push API, for tests and local debugging.
+    Records every pushed payload and can simulate a slow or failing server.
+    """
+
+    def __init__(self, delay=0.0, status=204):
+        self.delay = delay
+        self.status = status
+        self.payloads = []
+        receiver = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if receiver.delay:
+                    time.sleep(receiver.delay)
+                receiver.payloads.append(json.loads(body))
+                self.send_response(receiver.status)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/loki/api/v1/push"
+
+    def lines(self):
+        """All log lines received so far, in arrival order."""
+        return [value[1] for payload in self.payloads for stream in payload["streams"] for value in stream["values"]]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,280 @@
+"""
+Cache of generated artifacts: preview meshes at several levels of detail and downloads.
+
+The viewer asks for the coarse mesh of a preview first (POST /api/preview_<part>?lod=coarse)
+and swaps in the medium and fine meshes from GET /api/mesh/<key>/<lod> once the coarse one
+is on screen. One generation writes every level (the fine one is the regular STL export),
+so the finer levels, and any repeated preview of the same part with the same settings, are
+served from this cache without touching geometry or tessellation. Downloads are kept too,
+the STL one being the same file as the fine mesh.
+
+The key is a hash of the canonical generator, params and settings (and ARTIFACT_VERSION),
+so it also serves as the ETag of every artifact and as its address: GET
+/artifacts/<key>.stl, /artifacts/<key>.<lod>.stl and /artifacts/<key>.step never change
+and can be cached by browsers, proxies and CDNs.
+
+An entry is a directory named by the key holding one file per variant (see VARIANTS) and
+the part's dimensions (dims.json, written last, refreshed on every hit). When the cache
+grows beyond MESH_CACHE_MAX_MB the least recently used entries are removed, and entries
+not used for MESH_CACHE_MAX_AGE seconds are removed whatever the size.
+
+With a shared backend (CACHE_BACKEND, see cache_backends.py) every file added is also
+published there, a local miss is looked up there before generating, and lease() keeps
+replicas from generating the same part at the same time.
+
+Configuration (environment):
+    MESH_CACHE_DIR      directory of the cache (default: SHAPE_STORE_DIR/meshes when the shape
+                        store is configured, else opengridgen_meshes in the temp directory)
+    MESH_CACHE_MAX_MB   size limit of the cache (default: 256, 0 disables progressive previews)
+    MESH_CACHE_MAX_AGE  seconds an unused entry is kept (default: 0, until evicted by size)
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import cache_backends
+from coalescing import flight_key, share_file
+from generators import ARTIFACT_VERSION
+
+LODS = ('coarse', 'medium', 'fine')
+# File of each variant of an artifact in its entry
+VARIANTS = {
+    'coarse': 'coarse.stl',
+    'medium': 'medium.stl',
+    'fine': 'fine.stl',
+    'step': 'part.step',
+}
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+DIMENSIONS = "dims.json"
+LEASE_POLL_INTERVAL = 0.25
+
+
+def mesh_key(generator, params, settings):
+    return hashlib.sha256(f"{ARTIFACT_VERSION}:{flight_key(generator, params, settings)}".encode()).hexdigest()
+
+
+class MeshCache:
+    def __init__(self, root, max_bytes=256 * 2**20, shared=None, node=None, lease_seconds=600.0, max_age=0.0,
+                 clock=time.time):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._clock = clock
+        self.shared = shared
+        # Lease owner: one per process, since processes do not share in-flight generations
+        self.owner = f"{node or cache_backends.node_name()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.lease_waits = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        root = env.get("MESH_CACHE_DIR")
+        if not root and env.get("SHAPE_STORE_DIR"):
+            root = os.path.join(env["SHAPE_STORE_DIR"], "meshes")
+        if not root:
+            root = os.path.join(tempfile.gettempdir(), "opengridgen_meshes")
+        return cls(root, max_bytes=int(float(env.get("MESH_CACHE_MAX_MB", 256)) * 2**20),
+                   shared=cache_backends.backend_from_env(env), node=cache_backends.node_name(env),
+                   lease_seconds=cache_backends.lease_seconds(env), max_age=float(env.get("MESH_CACHE_MAX_AGE", 0)))
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def entry_dir(self, key):
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid mesh key: {key!r}")
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, variant):
+        """(path of the cached file of variant, dimensions) or None."""
+        entry = self.entry_dir(key)
+        found = self._get_local(entry, variant)
+        if found is None and self.shared is not None and self.enabled:
+            found = self._get_shared(key, entry, variant)
+            if found is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                return found
+        with self._lock:
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return found
+
+    def _get_local(self, entry, variant):
+        path = os.path.join(entry, VARIANTS[variant])
+        try:
+            with open(os.path.join(entry, DIMENSIONS)) as f:
+                dims = json.load(f)
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            os.utime(os.path.join(entry, DIMENSIONS))
+        except (OSError, ValueError):
+            return None
+        return path, dims
+
+    def _get_shared(self, key, entry, variant):
+        """Copy variant of key from the shared backend into the local cache."""
+        dims = self.shared.get(f"artifact/{key}/dims")
+        data = self.shared.get(f"artifact/{key}/{variant}") if dims is not None else None
+        if data is None:
+            return None
+        path = os.path.join(entry, VARIANTS[variant])
+        try:
+            os.makedirs(entry, exist_ok=True)
+            self._add(entry, path, lambda tmp: _write_bytes(tmp, data))
+            self._add(entry, os.path.join(entry, DIMENSIONS), lambda tmp: _write_bytes(tmp, dims))
+        except OSError:
+            return None
+        self._enforce_limit()
+        return self._get_local(entry, variant)
+
+    @contextmanager
+    def lease(self, key):
+        """
+        Hold the shared lease of key while generating it. If another replica holds it,
+        wait until that one released it or the lease expired; yields whether it waited,
+        in which case the caller should look for the artifacts with get() again. Without
+        a shared backend this does nothing.
+        """
+        if self.shared is None:
+            yield False
+            return
+        name = f"artifact/{key}"
+        deadline = time.monotonic() + self.lease_seconds
+        waited = False
+        while not self.shared.acquire(name, self.owner, self.lease_seconds):
+            if not waited:
+                waited = True
+                with self._lock:
+                    self.lease_waits += 1
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(LEASE_POLL_INTERVAL)
+        try:
+            yield waited
+        finally:
+            self.shared.release(name, self.owner)
+
+    def put(self, key, files, dims):
+        """
+        Add the files ({variant: path}) of a generation to the cache; variants already cached
+        are kept, so a later generation can complete an entry. The source files are left in place.
+        """
+        if not self.enabled:
+            return
+        entry = self.entry_dir(key)
+        added = {}
+        try:
+            os.makedirs(entry, exist_ok=True)
+            for variant, source in files.items():
+                target = os.path.join(entry, VARIANTS[variant])
+                if not os.path.exists(target):
+                    self._add(entry, target, lambda tmp: share_file(source, tmp))
+                    added[variant] = source
+            self._add(entry, os.path.join(entry, DIMENSIONS), lambda tmp: _write_json(tmp, dims))
+        except OSError:
+            # Evicted by another process meanwhile: the entry is simply not cached
+            return
+        if self.shared is not None and added:
+            # Files already here were published by whoever added them (e.g. a worker
+            # daemon). Dimensions last: replicas only look for the files once they are there
+            for variant, source in added.items():
+                with open(source, "rb") as f:
+                    self.shared.publish(f"artifact/{key}/{variant}", f.read())
+            self.shared.publish(f"artifact/{key}/dims", json.dumps(dims).encode())
+        self._enforce_limit()
+
+    def _add(self, entry, target, write):
+        # Write under a temporary name and rename, so readers never see partial files
+        tmp = os.path.join(entry, f".{os.path.basename(target)}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            write(tmp)
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                size = 0
+                try:
+                    for file in os.scandir(entry.path):
+                        size += file.stat().st_size
+                except OSError:
+                    pass  # removed meanwhile
+                try:
+                    used = os.stat(os.path.join(entry.path, DIMENSIONS)).st_mtime
+                except OSError:
+                    # Incomplete: being written, or left by a process that died while writing
+                    try:
+                        used = entry.stat().st_mtime
+                    except OSError:
+                        used = 0
+                entries.append((used, size, entry.path))
+        return entries
+
+    def _enforce_limit(self):
+        self.collect()
+
+    def collect(self):
+        """Remove the entries unused for max_age, then the least recently used beyond max_bytes; returns how many."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        expired = self._clock() - self.max_age if self.max_age else None
+        removed = 0
+        for used, size, path in sorted(entries):
+            if total <= self.max_bytes and (expired is None or used >= expired):
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "max_age": self.max_age,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "shared": self.shared.stats() if self.shared is not None else None,
+                "shared_hits": self.shared_hits,
+                "lease_waits": self.lease_waits,
+            }
+
+
+def _write_bytes(path, value):
+    with open(path, "wb") as f:
+        f.write(value)
+
+
+def _write_json(path, value):
+    with open(path, "w") as f:
+        json.dump(value, f)
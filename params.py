@@ -0,0 +1,237 @@
+"""
+Typed parameters of each generator.
+
+Every request is parsed into an immutable Params before it is dispatched, whichever way
+it arrives: JSON numbers or strings from previews, form fields from downloads, plain
+dicts in tests and benchmarks. Parsing coerces each value to its type, fills in the
+default, checks bounds and choices, and rounds float values to PARAM_QUANTUM (lengths in
+mm, angles in degrees), so 2, "2" and 2.0 widths or a 1.00001 gear module are the same
+part, share one generation (coalescing) and hit the same cache entries (stage cache,
+shape store, mesh cache). Params.key is the canonical form of a part's parameters.
+
+Invalid values raise InvalidParams listing every offending field. This module has no
+dependencies, so the web process checks requests without importing the CAD stack.
+
+Configuration (environment):
+    PARAM_QUANTUM   step float parameters are rounded to (default: 0.01)
+"""
+import json
+import math
+import os
+from collections.abc import Mapping
+
+QUANTUM = 0.01
+
+TRUE = {"true", "1", "yes", "on"}
+FALSE = {"false", "0", "no", "off", ""}
+
+
+def configure_params(env=None):
+    global QUANTUM
+    env = os.environ if env is None else env
+    QUANTUM = float(env.get("PARAM_QUANTUM", 0.01))
+    if QUANTUM < 0:
+        raise ValueError(f"PARAM_QUANTUM must not be negative, got {QUANTUM}")
+
+
+class InvalidParams(ValueError):
+    """Parameters that do not describe a part; `errors` holds {"field", "error"} per problem."""
+    status = 400
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(f"{e['field']}: {e['error']}" for e in errors))
+
+    def __reduce__(self):
+        # Raised in worker processes and pickled back to the web server
+        return type(self), (self.errors,)
+
+
+class Field:
+    """
+    One parameter: its type (int, float, bool or str), default, inclusive bounds, allowed
+    choices (str) and rounding step (float; None uses PARAM_QUANTUM, 0 keeps the value).
+    """
+
+    def __init__(self, kind, default, minimum=None, maximum=None, choices=None, quantum=None):
+        self.kind = kind
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+        self.quantum = quantum
+
+    def parse(self, value):
+        if value is None or value == "":
+            # Missing, or an empty form field
+            return self.default
+        value = getattr(self, f"_parse_{self.kind.__name__}")(value)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"must be at least {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"must be at most {self.maximum}")
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(f"must be one of {', '.join(self.choices)}")
+        return value
+
+    def _parse_bool(self, value):
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in TRUE:
+            return True
+        if text in FALSE:
+            return False
+        raise ValueError("must be true or false")
+
+    def _number(self, value):
+        if isinstance(value, bool):
+            raise ValueError("must be a number")
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("must be a number") from None
+        if not math.isfinite(number):
+            raise ValueError("must be a finite number")
+        return number
+
+    def _parse_int(self, value):
+        number = self._number(value)
+        if not number.is_integer():
+            raise ValueError("must be a whole number")
+        return int(number)
+
+    def _parse_float(self, value):
+        number = self._number(value)
+        quantum = QUANTUM if self.quantum is None else self.quantum
+        if quantum:
+            # The second round drops the representation error of the multiplication
+            number = round(round(number / quantum) * quantum, 10)
+        return number + 0.0  # no -0.0
+
+    def _parse_str(self, value):
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        return value.strip().lower()
+
+
+class Params(Mapping):
+    """The parsed, immutable and hashable parameters of one part."""
+
+    __slots__ = ("generator", "_values", "_key")
+
+    def __init__(self, generator, values):
+        object.__setattr__(self, "generator", generator)
+        object.__setattr__(self, "_values", dict(values))
+        object.__setattr__(self, "_key", json.dumps([generator, sorted(self._values.items())], separators=(",", ":")))
+
+    @property
+    def key(self):
+        """Canonical form: equal for every request describing the same part."""
+        return self._key
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Params are immutable")
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if isinstance(other, Params):
+            return self._key == other._key
+        if isinstance(other, Mapping):
+            return self._values == dict(other)
+        return NotImplemented
+
+    def __reduce__(self):
+        return (Params, (self.generator, self._values))
+
+    def __repr__(self):
+        return f"Params({self.generator!r}, {self._values!r})"
+
+
+GRID_UNITS = Field(int, 1, minimum=1, maximum=50)
+
+MODELS = {
+    'box': {
+        'width': GRID_UNITS,
+        'length': GRID_UNITS,
+        'height': Field(int, 1, minimum=1, maximum=50),
+        'solid': Field(bool, False),
+    },
+    'lid': {
+        'width': GRID_UNITS,
+        'length': GRID_UNITS,
+        'height': Field(float, 0.5, minimum=0.1, maximum=50),
+        'handle_style': Field(str, 'none', choices=('none', 'simple', 'loop')),
+        'handle_height': Field(float, 5.0, minimum=1, maximum=100),
+    },
+    'baseplate': {
+        'width': GRID_UNITS,
+        'length': GRID_UNITS,
+        'padding_width': Field(float, 0.0, minimum=0, maximum=500),
+        'padding_length': Field(float, 0.0, minimum=0, maximum=500),
+        'corner_screws': Field(bool, False),
+    },
+    'gear': {
+        'teeth': Field(int, 20, minimum=4, maximum=500),
+        'module': Field(float, 1.0, minimum=0.1, maximum=50),
+        'width': Field(float, 5.0, minimum=0.1, maximum=1000),
+        'bore_d': Field(float, 5.0, minimum=0.1, maximum=1000),
+        'pressure_angle': Field(float, 20.0, minimum=0.1, maximum=45),
+        'shaft_type': Field(str, 'circle', choices=('circle', 'hex', 'd_cut')),
+        'helix_angle': Field(float, 0.0, minimum=-60, maximum=60),
+        'gear_type': Field(str, 'spur', choices=('spur', 'helical', 'herringbone')),
+        'backlash': Field(float, 0.0, minimum=0, maximum=10),
+    },
+    'tube_adapter': {
+        'side_a_id': Field(float, 4.0, minimum=0.1, maximum=1000),
+        'side_a_od': Field(float, 6.0, minimum=0.1, maximum=1000),
+        'side_a_barb': Field(bool, False),
+        'side_b_id': Field(float, 4.0, minimum=0.1, maximum=1000),
+        'side_b_od': Field(float, 6.0, minimum=0.1, maximum=1000),
+        'side_b_barb': Field(bool, False),
+        'length': Field(float, 30.0, minimum=1, maximum=2000),
+        'num_barbs': Field(int, 3, minimum=1, maximum=100),
+        'barb_height_percentage': Field(float, 10.0, minimum=0.1, maximum=100),
+        'barb_width': Field(float, 2.0, minimum=0.1, maximum=100),
+    },
+    'hinge': {
+        'length': Field(float, 40.0, minimum=5, maximum=2000),
+        'width': Field(float, 40.0, minimum=5, maximum=2000),
+        'height': Field(float, 5.0, minimum=1, maximum=500),
+        'pin_diam': Field(float, 3.0, minimum=1, maximum=500),
+        'clearance': Field(float, 0.4, minimum=0.05, maximum=10),
+    },
+}
+
+
+def parse_params(generator, data):
+    """
+    Parse request data (a dict, form or Params; None for all defaults) into the Params of
+    generator. Unknown keys are ignored. Raises InvalidParams.
+    """
+    if isinstance(data, Params) and data.generator == generator:
+        return data
+    if data is not None and not isinstance(data, Mapping):
+        raise InvalidParams([{"field": "params", "error": "must be an object"}])
+    data = data or {}
+    values = {}
+    errors = []
+    for name, field in MODELS[generator].items():
+        try:
+            values[name] = field.parse(data.get(name))
+        except ValueError as e:
+            errors.append({"field": name, "error": str(e)})
+    if errors:
+        raise InvalidParams(errors)
+    return Params(generator, values)
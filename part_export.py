@@ -0,0 +1,106 @@
+"""
+Byte-deterministic STEP and STL export.
+
+The exporters of CadQuery, cqkit and cqgridfinity write the same shape to different
+bytes every time: the STEP header carries the export time (and, from cqkit, the name of
+the temporary output file), OCCT numbers products from per-process counters, and the
+STEP options are process-wide statics each exporter sets differently, so the output
+also depends on which generator ran before in the worker. These exporters set every
+option and header field on each call, number the products in model order, write 0 for
+-0, and mesh a copy of the shape on one thread behind a fixed STL header, so one shape
+always gives the same bytes, which can be hashed, deduplicated and diffed. All
+generators' save_step_file()/save_stl_file() write through them.
+
+The shape itself can differ between processes: OCCT's boolean operations keep shapes in
+maps keyed by memory address, so e.g. the faces of a Gridfinity box may come out in
+another order in another worker. Every worker loads the same stored shape once
+SHAPE_STORE_DIR is set, which makes the files identical across workers and restarts.
+"""
+import re
+
+from OCP.APIHeaderSection import APIHeaderSection_MakeHeader
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from OCP.IFSelect import IFSelect_RetDone
+from OCP.Interface import Interface_Static
+from OCP.STEPControl import STEPControl_AsIs, STEPControl_Writer
+from OCP.StepBasic import StepBasic_Product
+from OCP.StepRepr import StepRepr_NextAssemblyUsageOccurrence
+from OCP.StlAPI import StlAPI_Writer
+from OCP.TCollection import TCollection_HAsciiString
+
+# Written in place of the export time
+TIMESTAMP = "1970-01-01T00:00:00"
+ORIGINATING_SYSTEM = "OpenGridGen"
+
+# Binary STL files start with an 80 byte free-form header
+STL_HEADER = b"Binary STL written by OpenGridGen".ljust(80, b"\0")
+
+# STEP writer statics, as cqkit's exporter sets them: no redundant p-curves (about half
+# the file size), maximum precision
+STEP_OPTIONS = {
+    "write.surfacecurve.mode": 0,
+    "write.precision.mode": 1,
+}
+
+# A -0 coordinate, which a shape loaded from BREP has as 0
+NEGATIVE_ZERO = re.compile(rb"(?<=[(,])-0\.(?=[,)])")
+
+
+def _text(value):
+    return TCollection_HAsciiString(value)
+
+
+def export_step(shape, path, name):
+    """Write shape (a cadquery Shape) to path as STEP, the part named `name`."""
+    # A new writer resets the statics to their defaults on first use in a process, so set
+    # them after creating it
+    writer = STEPControl_Writer()
+    for option, value in STEP_OPTIONS.items():
+        Interface_Static.SetIVal_s(option, value)
+    Interface_Static.SetCVal_s("xstep.cascade.unit", "MM")
+    Interface_Static.SetCVal_s("write.step.unit", "MM")
+    writer.Transfer(shape.wrapped, STEPControl_AsIs)
+
+    # OCCT numbers products and their assembly links (parts made of several solids) from
+    # process-wide counters: number them in model order instead
+    model = writer.Model()
+    entities = [model.Value(i) for i in range(1, model.NbEntities() + 1)]
+    products = [e for e in entities if isinstance(e, StepBasic_Product)]
+    for i, product in enumerate(products):
+        label = _text(name if i == 0 else f"{name}.{i}")
+        product.SetId(label)
+        product.SetName(label)
+    links = [e for e in entities if isinstance(e, StepRepr_NextAssemblyUsageOccurrence)]
+    for i, link in enumerate(links, 1):
+        link.SetId(_text(str(i)))
+    header = APIHeaderSection_MakeHeader(model)
+    header.SetName(_text(name))
+    header.SetTimeStamp(_text(TIMESTAMP))
+    header.SetAuthorValue(1, _text(""))
+    header.SetOrganizationValue(1, _text(""))
+    header.SetOriginatingSystem(_text(ORIGINATING_SYSTEM))
+    header.SetAuthorisation(_text(""))
+    if writer.Write(path) != IFSelect_RetDone:
+        raise OSError(f"Could not write STEP file {path}")
+
+    with open(path, "r+b") as f:
+        data = NEGATIVE_ZERO.sub(b"0.", f.read())
+        f.seek(0)
+        f.write(data)
+        f.truncate()
+
+
+def export_stl(shape, path, tolerance, angular_tolerance, relative=False):
+    """
+    Mesh a copy of shape (a shape keeps the triangulation of its last export, which
+    BRepMesh would reuse when it is finer than the requested one) on one thread and
+    write it to path as binary STL with STL_HEADER.
+    """
+    shape = shape.copy()
+    BRepMesh_IncrementalMesh(shape.wrapped, tolerance, relative, angular_tolerance, False)
+    writer = StlAPI_Writer()
+    writer.ASCIIMode = False
+    if not writer.Write(shape.wrapped, path):
+        raise OSError(f"Could not write STL file {path}")
+    with open(path, "r+b") as f:
+        f.write(STL_HEADER)
@@ -0,0 +1,183 @@
+"""
+Opt-in profiling of generation tasks.
+
+A request is profiled when it carries an `X-Profile: 1` header, when profiling is switched on
+from the admin endpoint, or when it is picked by 1-in-N sampling (PROFILE_SAMPLE_RATE=N).
+The task then runs under cProfile inside the worker while a sampler thread records
+py-spy style stacks. Both are written to PROFILE_DIR keyed by a profile id, which the
+response carries in X-Profile-Id:
+
+    <id>.pstats     cProfile stats (load with pstats / snakeviz)
+    <id>.collapsed  folded stacks (feed to flamegraph.pl / speedscope)
+    <id>.json       metadata (task, params, duration, timestamp)
+"""
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+PROFILE_FORMATS = ('pstats', 'collapsed')
+
+# Runtime switches, changed from the admin endpoint
+PROFILING = {
+    "enabled": False,
+    "sample_rate": 0,
+}
+
+_sample_counter = itertools.count(1)
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def profile_dir():
+    path = os.environ.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "opengridgen_profiles")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def configure_profiling(env=None):
+    env = os.environ if env is None else env
+    PROFILING["sample_rate"] = int(env.get("PROFILE_SAMPLE_RATE", 0))
+
+
+def should_profile(headers):
+    """
+    Decide whether the current request is profiled (header, admin flag or 1-in-N sampling).
+    """
+    if headers.get('X-Profile', '').lower() in ('1', 'true', 'yes'):
+        return True
+    if PROFILING["enabled"]:
+        return True
+    rate = PROFILING["sample_rate"]
+    return rate > 0 and next(_sample_counter) % rate == 0
+
+
+def activate(profile_id):
+    """Mark the current request as profiled. Returns a token for deactivate()."""
+    return _current_profile.set(profile_id)
+
+
+def deactivate(token):
+    _current_profile.reset(token)
+
+
+def current_profile():
+    """(profile_id, directory) for the current request, or None when it is not profiled."""
+    profile_id = _current_profile.get()
+    if profile_id is None:
+        return None
+    return profile_id, profile_dir()
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread at a fixed interval and folds it into
+    collapsed-stack lines ("outer;inner count"), the way py-spy does.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def profile_call(profile, func, args, kwargs):
+    """
+    Run func under cProfile and the stack sampler, writing the results for profile=(id, dir).
+    Used inside worker processes.
+    """
+    profile_id, directory = profile
+    profiler = cProfile.Profile()
+    start = time.time()
+    error = None
+    try:
+        with StackSampler(threading.get_ident()) as sampler:
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        base = os.path.join(directory, profile_id)
+        profiler.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w") as f:
+            f.write(sampler.collapsed())
+        meta = {
+            "id": profile_id,
+            "task": getattr(func, "__name__", repr(func)),
+            "params": kwargs.get("params"),
+            "created": start,
+            "duration": time.time() - start,
+            "error": error,
+        }
+        with open(base + ".json", "w") as f:
+            json.dump(meta, f, default=str)
+
+
+def list_profiles(limit=50):
+    """Metadata of the most recent profiles, newest first."""
+    directory = profile_dir()
+    profiles = []
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda p: p.get("created", 0), reverse=True)
+    return profiles[:limit]
+
+
+def prune_profiles(keep=None):
+    """Delete all but the `keep` most recent profiles (PROFILE_KEEP, default 200)."""
+    keep = int(os.environ.get("PROFILE_KEEP", 200)) if keep is None else keep
+    directory = profile_dir()
+    for meta in list_profiles(limit=None)[keep:]:
+        for ext in PROFILE_FORMATS + ('json',):
+            try:
+                os.remove(os.path.join(directory, f"{meta['id']}.{ext}"))
+            except OSError:
+                pass
+
+
+def profile_path(profile_id, fmt):
+    """Path of a stored profile file, or None if it doesn't exist."""
+    if fmt not in PROFILE_FORMATS or os.path.basename(profile_id) != profile_id:
+        return None
+    path = os.path.join(profile_dir(), f"{profile_id}.{fmt}")
+    return path if os.path.exists(path) else None
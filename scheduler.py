@@ -0,0 +1,192 @@
+"""
+Cost-aware scheduling of generation jobs.
+
+Each job's cost is estimated from its params (grid cells for boxes and baseplates, teeth x
+gear type for gears, knuckles for hinges, barbs for tube adapters). A per-generator
+seconds-per-unit rate, seeded from benchmark runs and refined from every finished job,
+turns that cost into an expected duration, which decides:
+
+- the lane: interactive requests (previews, info) get their own slots so heavy downloads
+  can never block them; downloads and very heavy previews go to the batch lane. With a
+  single generation slot there is only the interactive lane, which every job shares;
+- the timeout: a multiple of the expected duration instead of fixed 30/60/120 s values.
+
+Configuration (environment):
+    SCHEDULER_BATCH_SHARE       fraction of the generation slots reserved for the batch lane, at least
+                                one and leaving one for the interactive lane (default: 0.34)
+    SCHEDULER_HEAVY_SECONDS     previews expected to take longer than this use the batch lane (default: 20)
+    SCHEDULER_TIMEOUT_FACTOR    timeout = factor x expected duration (default: 4)
+    SCHEDULER_MIN_TIMEOUT       lower bound for timeouts in seconds (default: 30)
+    SCHEDULER_MAX_TIMEOUT       upper bound for timeouts in seconds (default: 600)
+    SCHEDULER_STARTUP_SECONDS   worker process start-up overhead (default: 3)
+"""
+import os
+import threading
+
+from admission import AdmissionController, default_concurrency
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Seconds per cost unit, measured with benchmarks.py; refined at runtime from real jobs
+DEFAULT_RATES = {
+    "box": 1.3,
+    "baseplate": 0.5,
+    "lid": 0.2,
+    "gear": 0.15,
+    "hinge": 0.05,
+    "tube_adapter": 0.04,
+}
+
+GEAR_TYPE_FACTOR = {"spur": 1.0, "helical": 2.0, "herringbone": 40.0}
+
+# Info requests skip the export step
+INFO_FACTOR = 0.6
+
+
+def _num(params, key, default):
+    try:
+        return float(params.get(key, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def _flag(params, key):
+    value = params.get(key, False)
+    return value is True or str(value).lower() == "true"
+
+
+def estimate_cost(generator, params):
+    """
+    Relative cost of a job in generator specific units, from its normalized params
+    (see params.py); missing values fall back to the generator defaults.
+    """
+    params = params or {}
+    if generator == "box":
+        cells = _num(params, "width", 1) * _num(params, "length", 1)
+        return 2 + cells * (1 + 0.1 * _num(params, "height", 1))
+    if generator == "baseplate":
+        return 1 + _num(params, "width", 1) * _num(params, "length", 1) + (1 if _flag(params, "corner_screws") else 0)
+    if generator == "lid":
+        return 1 + _num(params, "width", 1) * _num(params, "length", 1) + (0 if params.get("handle_style", "none") == "none" else 1)
+    if generator == "gear":
+        factor = GEAR_TYPE_FACTOR.get(str(params.get("gear_type", "spur")).lower(), 1.0)
+        return max(1.0, _num(params, "teeth", 20)) * factor
+    if generator == "hinge":
+        knuckles = max(3, int(_num(params, "length", 40.0) / 10))
+        return knuckles + (1 - knuckles % 2)
+    if generator == "tube_adapter":
+        barbed_sides = _flag(params, "side_a_barb") + _flag(params, "side_b_barb")
+        return 1 + barbed_sides * max(0, _num(params, "num_barbs", 3))
+    return 1.0
+
+
+class Job:
+    def __init__(self, generator, kind, cost, estimate, timeout, lane):
+        self.generator = generator
+        self.kind = kind
+        self.cost = cost
+        self.estimate = estimate
+        self.timeout = timeout
+        self.lane = lane
+
+    def attributes(self):
+        return {"job.cost": self.cost, "job.estimate": round(self.estimate, 2),
+                "job.timeout": self.timeout, "job.lane": self.lane}
+
+
+class CostModel:
+    """
+    Turns job cost into expected seconds using per-generator rates learned with an EWMA.
+    """
+
+    def __init__(self, rates=None, startup=3.0, alpha=0.2):
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.startup = startup
+        self.alpha = alpha
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def expected_seconds(self, generator, cost, kind="preview"):
+        seconds = cost * self.rates.get(generator, 1.0)
+        if kind == "info":
+            seconds *= INFO_FACTOR
+        return self.startup + seconds
+
+    def record(self, generator, cost, kind, seconds):
+        """Learn from a finished job. Timed out jobs only say the job takes longer: skip them."""
+        work = max(0.0, seconds - self.startup)
+        if kind == "info":
+            work /= INFO_FACTOR
+        observed_rate = work / max(cost, 1e-6)
+        with self._lock:
+            rate = self.rates.get(generator, observed_rate)
+            self.rates[generator] = (1 - self.alpha) * rate + self.alpha * observed_rate
+            self.samples[generator] = self.samples.get(generator, 0) + 1
+
+
+class Scheduler:
+    def __init__(self, interactive_slots, batch_slots, max_queue=None, max_per_client=4, queue_timeout=30.0,
+                 heavy_seconds=20.0, timeout_factor=4.0, min_timeout=30, max_timeout=600, cost_model=None):
+        slots = {INTERACTIVE: interactive_slots, BATCH: batch_slots}
+        # Without batch slots every job runs in the interactive lane
+        self.lanes = {
+            lane: AdmissionController(n, 4 * n if max_queue is None else max_queue, max_per_client, queue_timeout)
+            for lane, n in slots.items() if n > 0
+        }
+        self.heavy_seconds = heavy_seconds
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.costs = cost_model or CostModel()
+
+    @classmethod
+    def from_env(cls, env=None, total=None, cost_model=None):
+        """The scheduler of this host's generation slots, or of `total` slots elsewhere (see job_queue.py)."""
+        env = os.environ if env is None else env
+        job_memory = int(env.get("ADMISSION_JOB_MEMORY_MB", 1024))
+        total = total or int(env.get("ADMISSION_MAX_CONCURRENT", 0)) or default_concurrency(job_memory)
+        # Both lanes need a slot of their own; a single slot is shared (no batch lane)
+        batch = min(total - 1, max(1, int(total * float(env.get("SCHEDULER_BATCH_SHARE", 0.34)))))
+        interactive = total - batch
+        max_queue = env.get("ADMISSION_MAX_QUEUE")
+        return cls(
+            interactive_slots=interactive,
+            batch_slots=batch,
+            max_queue=int(max_queue) if max_queue else None,
+            max_per_client=int(env.get("ADMISSION_MAX_PER_CLIENT", 4)),
+            queue_timeout=float(env.get("ADMISSION_QUEUE_TIMEOUT", 30)),
+            heavy_seconds=float(env.get("SCHEDULER_HEAVY_SECONDS", 20)),
+            timeout_factor=float(env.get("SCHEDULER_TIMEOUT_FACTOR", 4)),
+            min_timeout=int(env.get("SCHEDULER_MIN_TIMEOUT", 30)),
+            max_timeout=int(env.get("SCHEDULER_MAX_TIMEOUT", 600)),
+            cost_model=cost_model or CostModel(startup=float(env.get("SCHEDULER_STARTUP_SECONDS", 3))),
+        )
+
+    def plan(self, generator, params, kind):
+        """
+        Estimate a job and pick its lane and timeout. kind is 'info', 'preview' or 'download'.
+        """
+        cost = estimate_cost(generator, params)
+        estimate = self.costs.expected_seconds(generator, cost, kind)
+        timeout = int(min(self.max_timeout, max(self.min_timeout, self.timeout_factor * estimate)))
+        if BATCH in self.lanes and (kind == "download" or estimate > self.heavy_seconds):
+            lane = BATCH
+        else:
+            lane = INTERACTIVE
+        return Job(generator, kind, cost, estimate, timeout, lane)
+
+    def acquire(self, job, client, cancel=None):
+        self.lanes[job.lane].acquire(client, cancel)
+
+    def release(self, job, client, duration=None, timed_out=False):
+        self.lanes[job.lane].release(client, duration)
+        if duration is not None and not timed_out:
+            self.costs.record(job.generator, job.cost, job.kind, duration)
+
+    def stats(self):
+        return {
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+            "rates": dict(self.costs.rates),
+            "samples": dict(self.costs.samples),
+        }
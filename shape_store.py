@@ -0,0 +1,218 @@
+"""
+On-disk store of shapes shared by every worker process.
+
+The stage cache lives inside one worker process; this store is its second tier. A shape
+built by any worker (an intermediate stage or a finished part) is written as binary
+BREP to SHAPE_STORE_DIR, so other workers, and the same worker after a restart, load it
+instead of rebuilding it. A STEP download after an STL preview of the same part then
+skips the build entirely.
+
+Files are addressed by the SHA-256 of ARTIFACT_VERSION (see generators.py), the stage name
+and key, so shapes built by older generator code are never loaded, and start with the SHA-256
+of their payload. Loading memory-maps the file, verifies the digest and reads the BREP
+straight from the mapping; a corrupt or unreadable file is removed and rebuilt. Files
+are written atomically (temp file + rename), so concurrent writers of the same shape
+are harmless. When the store grows beyond SHAPE_STORE_MAX_MB the least recently used
+files (by modification time, refreshed on every hit) are removed.
+
+With a shared backend (CACHE_BACKEND, see cache_backends.py) stored files are also
+published there and a local miss is fetched from it, so shapes are shared between
+replicas too; the digest is verified either way.
+
+Configuration (environment):
+    SHAPE_STORE_DIR      directory of the store (default: unset, store disabled unless
+                         CACHE_BACKEND is set, then opengridgen_shapes in the temp directory)
+    SHAPE_STORE_MAX_MB   size limit of the store (default: 512)
+"""
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+import cache_backends
+from generators import ARTIFACT_VERSION
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"OGSHAPE1"
+HEADER_SIZE = len(MAGIC) + hashlib.sha256().digest_size
+SUFFIX = ".brep"
+
+
+def shape_digest(stage, key):
+    return hashlib.sha256(repr((ARTIFACT_VERSION, stage, key)).encode()).hexdigest()
+
+
+class ShapeStore:
+    def __init__(self, root, max_bytes=512 * 2**20, shared=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.writes = 0
+        self.evictions = 0
+        self.corrupt = 0
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, env=None):
+        """The configured store, or None when neither SHAPE_STORE_DIR nor CACHE_BACKEND is set."""
+        env = os.environ if env is None else env
+        shared = cache_backends.backend_from_env(env)
+        root = env.get("SHAPE_STORE_DIR")
+        if not root and shared is not None:
+            root = os.path.join(tempfile.gettempdir(), "opengridgen_shapes")
+        if not root:
+            return None
+        return cls(root, max_bytes=int(float(env.get("SHAPE_STORE_MAX_MB", 512)) * 2**20), shared=shared)
+
+    def path_for(self, stage, key):
+        digest = shape_digest(stage, key)
+        return os.path.join(self.root, digest[:2], digest + SUFFIX)
+
+    def get(self, stage, key):
+        """The stored shape for (stage, key), or None."""
+        path = self.path_for(stage, key)
+        if not os.path.exists(path) and not self._fetch(stage, key, path):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                shape = self._load(data)
+        except FileNotFoundError:
+            shape = None
+        except Exception:
+            # Empty (mmap refuses zero-length files), unreadable or not a BREP
+            shape = None
+            self._discard(path)
+        else:
+            if shape is None:
+                self._discard(path)
+        if shape is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return shape
+
+    def _fetch(self, stage, key, path):
+        """Copy the file of (stage, key) from the shared backend; True if it was there."""
+        if self.shared is None:
+            return False
+        data = self.shared.get(f"shape/{shape_digest(stage, key)}")
+        if data is None:
+            return False
+        try:
+            self._write(path, data)
+        except OSError as e:
+            logger.warning("Could not store shape %s: %s", path, e)
+            return False
+        with self._lock:
+            self.shared_hits += 1
+        return True
+
+    def _write(self, path, data):
+        # Atomically: concurrent readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _load(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            return None
+        with memoryview(data) as view:
+            intact = hashlib.sha256(view[HEADER_SIZE:]).digest() == data[len(MAGIC):HEADER_SIZE]
+        if not intact:
+            return None
+        # Only worker processes load shapes; the web process never imports cadquery
+        import cadquery as cq
+        data.seek(HEADER_SIZE)
+        return cq.Shape.importBin(data)
+
+    def _discard(self, path):
+        logger.warning("Removing corrupt shape %s", path)
+        with self._lock:
+            self.corrupt += 1
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def put(self, stage, key, shape):
+        """Store shape for (stage, key). Failures are logged, never raised: the store is only a cache."""
+        buffer = BytesIO()
+        shape.exportBin(buffer)
+        payload = buffer.getvalue()
+        data = MAGIC + hashlib.sha256(payload).digest() + payload
+        path = self.path_for(stage, key)
+        try:
+            self._write(path, data)
+        except OSError as e:
+            logger.warning("Could not store shape %s: %s", path, e)
+            return
+        with self._lock:
+            self.writes += 1
+        if self.shared is not None:
+            self.shared.publish(f"shape/{shape_digest(stage, key)}", data)
+        self._enforce_limit()
+
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            for file in os.scandir(entry.path):
+                if file.name.endswith(SUFFIX):
+                    try:
+                        st = file.stat()
+                    except OSError:
+                        continue  # removed by another worker
+                    files.append((st.st_mtime, st.st_size, file.path))
+        return files
+
+    def _enforce_limit(self):
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        files = self._files()
+        with self._lock:
+            return {
+                "entries": len(files),
+                "bytes": sum(size for _, size, _ in files),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "corrupt": self.corrupt,
+                "shared_hits": self.shared_hits,
+            }
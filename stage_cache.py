@@ -0,0 +1,82 @@
+"""
+In-process cache of intermediate shapes.
+
+Generators split their build into stages (e.g. the gear profile wire, the extruded gear
+body, the bore cut) and memoize each stage on the params it depends on. In a warm live
+preview worker a small parameter change then only rebuilds the stages downstream of the
+changed parameter; in a one-shot worker the cache simply starts empty.
+
+Cached values must be OCC shapes (cq.Shape subclasses), which are never modified in
+place. Workplanes are not safe to share: chained operations consume the pending wires
+of their shared context. Wrap a cached shape with cq.Workplane("XY").add(shape) instead.
+
+With SHAPE_STORE_DIR set, a miss is looked up in the on-disk shape store shared by all
+workers before building, and every built shape is written to it (see shape_store.py).
+Stage keys must therefore have a stable repr() across processes.
+
+Configuration (environment):
+    STAGE_CACHE_ENTRIES   shapes kept per worker process (default: 32)
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import tracing
+from shape_store import ShapeStore
+
+
+class StageCache:
+    def __init__(self, max_entries=32, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, stage, key, build):
+        """Return the cached value for (stage, key), building and storing it on a miss."""
+        cache_key = (stage, key)
+        with tracing.span("generate.stage", {"stage": stage}) as span:
+            with self._lock:
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+                    span.set_attribute("stage.cached", True)
+                    return self._entries[cache_key]
+                self.misses += 1
+            span.set_attribute("stage.cached", False)
+            value = self.store.get(stage, key) if self.store is not None else None
+            span.set_attribute("stage.stored", value is not None)
+            if value is None:
+                value = build()
+                if self.store is not None:
+                    self.store.put(stage, key, value)
+            with self._lock:
+                self._entries[cache_key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def configure_stage_cache(env=None):
+    """Recreate the process-wide cache from the environment (e.g. after loading .env)."""
+    global STAGES
+    env = os.environ if env is None else env
+    STAGES = StageCache(int(env.get("STAGE_CACHE_ENTRIES", 32)), store=ShapeStore.from_env(env))
+    return STAGES
+
+
+STAGES = configure_stage_cache()
+
+
+def memo(stage, key, build):
+    return STAGES.get_or_build(stage, key, build)
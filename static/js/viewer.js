@@ -1,10 +1,58 @@
 let currentRenderer = null;
 let currentAnimationId = null;
+let currentViewer = null;
 
-function initViewer(containerId, blob) {
+function loadMesh(blob, onLoad, onError) {
+    const loader = new THREE.STLLoader();
+    const url = URL.createObjectURL(blob);
+    loader.load(url, function (geometry) {
+        const material = new THREE.MeshPhongMaterial({ color: 0x007bff, specular: 0x111111, shininess: 200 });
+        const mesh = new THREE.Mesh(geometry, material);
+
+        // Center the model
+        geometry.computeBoundingBox();
+        const center = new THREE.Vector3();
+        geometry.boundingBox.getCenter(center);
+        mesh.position.sub(center);
+
+        URL.revokeObjectURL(url);
+        onLoad(mesh, geometry);
+    }, undefined, function (error) {
+        URL.revokeObjectURL(url);
+        console.error(error);
+        if (onError) onError(error);
+    });
+}
+
+// options.keepView: swap the model of the existing viewer and keep the camera where the
+// user left it (used by live preview and to refine a coarse preview), instead of building
+// a new viewer. options.signal: drop the model if the signal was aborted meanwhile.
+// Resolves once the model is displayed.
+function initViewer(containerId, blob, options = {}) {
     const container = document.getElementById(containerId);
     container.style.display = 'block';
 
+    if (options.keepView && currentViewer && currentViewer.containerId === containerId) {
+        const viewer = currentViewer;
+        return new Promise(function (resolve) {
+            loadMesh(blob, function (mesh) {
+                if (currentViewer !== viewer || (options.signal && options.signal.aborted)) {
+                    mesh.geometry.dispose();
+                    mesh.material.dispose();
+                    return resolve();
+                }
+                if (viewer.mesh) {
+                    viewer.scene.remove(viewer.mesh);
+                    viewer.mesh.geometry.dispose();
+                    viewer.mesh.material.dispose();
+                }
+                viewer.mesh = mesh;
+                viewer.scene.add(mesh);
+                resolve();
+            }, resolve);
+        });
+    }
+
     // Cleanup previous renderer and animation
     if (currentRenderer) {
         currentRenderer.dispose();
@@ -39,30 +87,23 @@ function initViewer(containerId, blob) {
     directionalLight.position.set(1, 1, 1);
     scene.add(directionalLight);
 
-    const loader = new THREE.STLLoader();
-    const url = URL.createObjectURL(blob);
-
-    loader.load(url, function (geometry) {
-        const material = new THREE.MeshPhongMaterial({ color: 0x007bff, specular: 0x111111, shininess: 200 });
-        const mesh = new THREE.Mesh(geometry, material);
-
-        // Center the model
-        geometry.computeBoundingBox();
-        const center = new THREE.Vector3();
-        geometry.boundingBox.getCenter(center);
-        mesh.position.sub(center);
-
-        scene.add(mesh);
-
-        // Adjust camera to fit the model
-        const size = new THREE.Vector3();
-        geometry.boundingBox.getSize(size);
-        const maxDim = Math.max(size.x, size.y, size.z);
-        camera.position.set(maxDim * 1.5, maxDim * 1.5, maxDim * 1.5);
-        camera.lookAt(0, 0, 0);
-        controls.update();
-
-        URL.revokeObjectURL(url);
+    const viewer = { containerId: containerId, scene: scene, mesh: null };
+    currentViewer = viewer;
+
+    const loaded = new Promise(function (resolve) {
+        loadMesh(blob, function (mesh, geometry) {
+            viewer.mesh = mesh;
+            scene.add(mesh);
+
+            // Adjust camera to fit the model
+            const size = new THREE.Vector3();
+            geometry.boundingBox.getSize(size);
+            const maxDim = Math.max(size.x, size.y, size.z);
+            camera.position.set(maxDim * 1.5, maxDim * 1.5, maxDim * 1.5);
+            camera.lookAt(0, 0, 0);
+            controls.update();
+            resolve();
+        }, resolve);
     });
 
     function animate() {
@@ -84,4 +125,5 @@ function initViewer(containerId, blob) {
         camera.updateProjectionMatrix();
     };
     window.addEventListener('resize', onWindowResize);
+    return loaded;
 }
@@ -1,72 +1,355 @@
+"""
+Runs generation tasks in worker processes.
+
+Workers are started with an explicit multiprocessing start method instead of the
+platform default, which differs between Python versions and operating systems:
+
+    forkserver  (default where available) children are forked from a server process
+                that preloaded the CAD stack, so a task starts in milliseconds without
+                inheriting the threads and locks of the web server. Recommended for
+                Linux and Docker deployments.
+    fork        children inherit every thread and lock of the web server (log shipping,
+                tracing exporters, admission control) and can deadlock on one held at
+                fork time. The web process does not import the CAD stack (see
+                generators.py), so each task imports it again. Not recommended.
+    spawn       each task starts a fresh interpreter and imports cadquery/OCP again,
+                which costs seconds per task. The only choice on Windows.
+
+self_test() measures how long starting a worker and importing the CAD stack in it
+takes; the app runs it in the background at startup and logs the result.
+
+Configuration (environment):
+    WORKER_START_METHOD   forkserver, fork or spawn (default: forkserver, else spawn)
+    WORKER_PRELOAD        comma separated modules the fork server imports up front
+                          (default: cadquery,OCP,cqkit,cqgridfinity,generation_utils)
+"""
+import importlib
 import multiprocessing
+import os
 import queue
+import threading
 import time
 
-def worker_wrapper(func, args, kwargs, result_queue):
+import profiling
+import tracing
+from cancellation import Cancelled
+
+# How often a running task checks whether it was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+
+DEFAULT_PRELOAD = ["cadquery", "OCP", "cqkit", "cqgridfinity", "generation_utils"]
+
+_context = None
+_context_lock = threading.Lock()
+
+def start_method(env=None):
+    env = os.environ if env is None else env
+    available = multiprocessing.get_all_start_methods()
+    method = env.get("WORKER_START_METHOD") or ("forkserver" if "forkserver" in available else "spawn")
+    if method not in available:
+        raise ValueError(f"WORKER_START_METHOD must be one of {', '.join(available)}, got {method!r}")
+    return method
+
+def preload_modules(env=None):
+    env = os.environ if env is None else env
+    if "WORKER_PRELOAD" not in env:
+        return list(DEFAULT_PRELOAD)
+    return [name.strip() for name in env["WORKER_PRELOAD"].split(",") if name.strip()]
+
+def mp_context():
+    """The multiprocessing context workers are started with, configured on first use."""
+    global _context
+    with _context_lock:
+        if _context is None:
+            context = multiprocessing.get_context(start_method())
+            if context.get_start_method() == "forkserver":
+                context.set_forkserver_preload(preload_modules())
+            _context = context
+        return _context
+
+def task_name(func):
+    if isinstance(func, str):
+        return func.rpartition(":")[2]
+    return getattr(func, "__name__", repr(func))
+
+class TaskTimeout(TimeoutError):
+    """
+    The task ran past its timeout in a worker process of its own. Unlike a TimeoutError
+    from waiting for a busy worker, it says the part takes too long to build.
+    """
+
+class WorkerExited(RuntimeError):
+    """The SessionWorker given for a task is no longer running."""
+
+def resolve_task(func):
+    """
+    A task given as "module:function" is imported in the worker, so the process that
+    dispatches it never has to import the module (and the CAD stack behind it).
+    """
+    if isinstance(func, str):
+        module, _, name = func.partition(":")
+        return getattr(importlib.import_module(module), name)
+    return func
+
+def execute_task(func, args, kwargs, trace_context=None, dispatched_ns=None, profile=None):
+    """
+    Run the task inside a worker process and build the message for the parent.
+    Catches all exceptions and puts them in the message.
+    Spans recorded in the worker are sent back with the result, since only the parent exports.
+    If profile=(id, dir) is given the task runs under the profiler.
+    """
+    with tracing.collect_spans() as spans:
+        with tracing.span("worker.run", {"task": task_name(func)}, traceparent=trace_context) as run_span:
+            if dispatched_ns:
+                # Time from dispatch in the parent until the child got here (fork/spawn + imports)
+                tracing.start_span("worker.startup", start_ns=dispatched_ns).end(run_span.start_ns)
+            try:
+                func = resolve_task(func)
+                if profile:
+                    run_span.set_attribute("profile_id", profile[0])
+                    result = profiling.profile_call(profile, func, args, kwargs)
+                else:
+                    result = func(*args, **kwargs)
+                message = {'success': True, 'result': result}
+            except Exception as e:
+                # Put the exception in the queue
+                # Note: Exception must be picklable. Custom exceptions in generation_utils are picklable.
+                run_span.set_error(f"{type(e).__name__}: {e}")
+                message = {'success': False, 'error': e}
+    message['spans'] = spans
+    return message
+
+def worker_wrapper(func, args, kwargs, result_queue, trace_context=None, dispatched_ns=None, profile=None):
     """
     Wrapper function to run the task and put the result in a queue.
-    Catches all exceptions and puts them in the queue.
     """
-    try:
-        result = func(*args, **kwargs)
-        result_queue.put({'success': True, 'result': result})
-    except Exception as e:
-        # Put the exception in the queue
-        # Note: Exception must be picklable. Custom exceptions in generation_utils are picklable.
-        result_queue.put({'success': False, 'error': e})
+    result_queue.put(execute_task(func, args, kwargs, trace_context, dispatched_ns, profile))
+
+def session_worker_loop(task_queue, result_queue):
+    """
+    Main loop of a warm worker: runs tasks one after the other until it receives None.
+    Module state such as the stage cache survives between tasks.
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        result_queue.put(execute_task(*task))
 
-def run_task_with_timeout(func, args=(), kwargs=None, timeout=60):
+class SessionWorker:
+    """
+    A long-lived worker process that runs one task at a time, used for live previews so
+    successive previews of a session reuse the intermediate shapes of the previous one.
+    """
+
+    def __init__(self, start=True):
+        context = mp_context()
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.process = context.Process(target=session_worker_loop, args=(self.task_queue, self.result_queue), daemon=True)
+        self.lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self.tasks_run = 0
+        self.last_used = time.monotonic()
+        if start:
+            self.start()
+
+    def start(self):
+        """Start the process; safe to call from several threads, only the first one starts it."""
+        with self._start_lock:
+            if not self.started():
+                self.process.start()
+
+    def started(self):
+        return self.process.pid is not None
+
+    def alive(self):
+        # A worker that is about to start counts as alive: tasks queued meanwhile wait for it
+        return not self.started() or self.process.is_alive()
+
+    def busy(self):
+        return self.lock.locked()
+
+    def run(self, func, args, kwargs, timeout, dispatch_span, cancel=None):
+        """
+        Run a task and return the worker's message. A cancelled task is left to finish in the
+        background, since the shapes it builds are usually what the next preview needs; the
+        next task waits for it. A task that times out kills the worker.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.lock.acquire(timeout=CANCEL_POLL_INTERVAL):
+            if cancel is not None and cancel.is_set():
+                raise Cancelled(cancel.reason)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Generation timed out after {timeout} seconds")
+
+        draining = False
+        try:
+            if not self.alive():
+                raise WorkerExited("Live preview worker exited")
+            dispatch_span.set_attribute("worker.warm", self.tasks_run > 0)
+            self.tasks_run += 1
+            self.task_queue.put((func, args, kwargs, dispatch_span.traceparent, time.time_ns(), profiling.current_profile()))
+            try:
+                result_data = _wait_for_result(self.result_queue, deadline - time.monotonic(), cancel)
+            except Cancelled:
+                draining = True
+                threading.Thread(target=self._drain, args=(deadline,), daemon=True).start()
+                raise
+            if result_data is None:
+                self.stop()
+                raise TimeoutError(f"Generation timed out after {timeout} seconds")
+            return result_data
+        finally:
+            self.last_used = time.monotonic()
+            if not draining:
+                self.lock.release()
+
+    def _drain(self, deadline):
+        # Discard the result of a cancelled task, then hand the worker to the next task
+        try:
+            self.result_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            self.stop()
+        finally:
+            self.last_used = time.monotonic()
+            self.lock.release()
+
+    def stop(self):
+        if self.started() and self.process.is_alive():
+            self.task_queue.put(None)
+            self.process.join(timeout=1)
+        _terminate(self.process)
+
+def run_task_with_timeout(func, args=(), kwargs=None, timeout=60, cancel=None, worker=None):
     """
     Run a function in a separate process with a timeout.
 
-    :param func: The function to run. Must be picklable (top-level function).
+    :param func: The function to run. Must be picklable (top-level function), or "module:function".
     :param args: Tuple of positional arguments.
     :param kwargs: Dictionary of keyword arguments.
     :param timeout: Timeout in seconds.
+    :param cancel: Optional token with is_set() and reason; the process is terminated once it is set.
+    :param worker: Optional SessionWorker to run the task on instead of a fresh process;
+        if it has exited meanwhile, the task runs in a fresh process after all.
     :return: The result of the function.
-    :raises TimeoutError: If the task exceeds the timeout.
+    :raises TaskTimeout: If the task exceeds the timeout in a process of its own.
+    :raises TimeoutError: If the task on `worker` does not finish in time, waiting included.
+    :raises Cancelled: If the task was cancelled.
     :raises Exception: Any exception raised by the task.
     """
     if kwargs is None:
         kwargs = {}
 
+    with tracing.span("worker.dispatch", {"task": task_name(func), "timeout": timeout}) as dispatch_span:
+        try:
+            if worker is not None:
+                try:
+                    result_data = worker.run(func, args, kwargs, timeout, dispatch_span, cancel)
+                except WorkerExited:
+                    # Stopped since it was handed out (evicted, idle or killed): run the task on its own
+                    dispatch_span.set_attribute("worker.exited", True)
+                    result_data = _run_in_process(func, args, kwargs, timeout, dispatch_span, cancel)
+            else:
+                result_data = _run_in_process(func, args, kwargs, timeout, dispatch_span, cancel)
+        except TimeoutError:
+            dispatch_span.set_attribute("timed_out", True)
+            raise
+        except Cancelled as e:
+            dispatch_span.set_attribute("cancelled", e.reason)
+            raise
+
+        tracing.export_collected(result_data.get('spans', []))
+
+        # Check result
+        if result_data['success']:
+            return result_data['result']
+        else:
+            # Re-raise the exception from the worker
+            raise result_data['error']
+
+def _terminate(process):
+    if process.is_alive():
+        process.terminate()
+        # Give it a moment to terminate gracefully
+        process.join(timeout=1)
+        # Force kill if still alive
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+def _wait_for_result(result_queue, timeout, cancel):
+    """
+    Wait for the worker's message, checking the cancel token in between.
+    Returns None on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            return result_queue.get(timeout=min(remaining, CANCEL_POLL_INTERVAL) if cancel is not None else remaining)
+        except queue.Empty:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled(cancel.reason)
+
+def _run_in_process(func, args, kwargs, timeout, dispatch_span, cancel=None):
     # Create a Queue to communicate with the worker process
-    result_queue = multiprocessing.Queue()
+    context = mp_context()
+    result_queue = context.Queue()
 
     # Create and start the process
-    process = multiprocessing.Process(target=worker_wrapper, args=(func, args, kwargs, result_queue))
+    process = context.Process(
+        target=worker_wrapper,
+        args=(func, args, kwargs, result_queue, dispatch_span.traceparent, time.time_ns(), profiling.current_profile())
+    )
     process.start()
 
     try:
         # Wait for the result with a timeout
-        try:
-            result_data = result_queue.get(timeout=timeout)
-        except queue.Empty:
+        result_data = _wait_for_result(result_queue, timeout, cancel)
+        if result_data is None:
             # Timeout occurred
-            if process.is_alive():
-                process.terminate()
-                # Give it a moment to terminate gracefully
-                process.join(timeout=1)
-                # Force kill if still alive
-                if process.is_alive():
-                    process.kill()
-                    process.join()
-
-            raise TimeoutError(f"Generation timed out after {timeout} seconds")
+            _terminate(process)
+            raise TaskTimeout(f"Generation timed out after {timeout} seconds")
 
         # Wait for the process to finish
         process.join()
-
-        # Check result
-        if result_data['success']:
-            return result_data['result']
-        else:
-            # Re-raise the exception from the worker
-            raise result_data['error']
+        return result_data
 
     except Exception as e:
-        # Ensure cleanup if an exception occurs (e.g. KeyboardInterrupt)
-        if process.is_alive():
-            process.terminate()
-            process.join()
+        # Ensure cleanup if an exception occurs (e.g. cancellation or KeyboardInterrupt)
+        _terminate(process)
         raise e
+
+def import_timings(modules):
+    """Self-test task: seconds spent importing each module in the worker (None if missing)."""
+    timings = {}
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            timings[name] = None
+            continue
+        timings[name] = round(time.perf_counter() - start, 3)
+    return timings
+
+def self_test(modules=None, timeout=120):
+    """
+    Start workers the way tasks are started and report how long that takes. The first
+    start includes starting the fork server and its preloading; the second one is what
+    every task pays. import_seconds is the time to import each CAD module in a worker:
+    about zero when it was preloaded (forkserver) or inherited (fork).
+    """
+    modules = preload_modules() if modules is None else modules
+    report = {"start_method": mp_context().get_start_method()}
+    if report["start_method"] == "forkserver":
+        report["preload"] = preload_modules()
+    for name, probe in (("first_start_seconds", []), ("task_start_seconds", [])):
+        start = time.monotonic()
+        run_task_with_timeout(import_timings, args=(probe,), timeout=timeout)
+        report[name] = round(time.monotonic() - start, 3)
+    report["import_seconds"] = run_task_with_timeout(import_timings, args=(modules,), timeout=timeout)
+    return report
@@ -0,0 +1,102 @@
+import unittest
+import json
+import threading
+import time
+from unittest.mock import patch
+
+from admission import AdmissionController, AdmissionRejected
+from scheduler import Scheduler, INTERACTIVE, BATCH
+from failure_cache import FailureCache
+import app as app_module
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    def test_admits_up_to_limit(self):
+        ctrl = AdmissionController(max_concurrent=2, max_queue=0)
+        ctrl.acquire('a')
+        ctrl.acquire('b')
+        with self.assertRaises(AdmissionRejected) as cm:
+            ctrl.acquire('c')
+        self.assertEqual(cm.exception.status, 503)
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        ctrl.release('a')
+        ctrl.acquire('c')
+        self.assertEqual(ctrl.stats()['running'], 2)
+
+    def test_per_client_limit(self):
+        ctrl = AdmissionController(max_concurrent=4, max_queue=4, max_per_client=2)
+        ctrl.acquire('a')
+        ctrl.acquire('a')
+        with self.assertRaises(AdmissionRejected) as cm:
+            ctrl.acquire('a')
+        self.assertEqual(cm.exception.status, 429)
+        ctrl.acquire('b')
+
+    def test_queue_timeout(self):
+        ctrl = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.1)
+        ctrl.acquire('a')
+        with self.assertRaises(AdmissionRejected) as cm:
+            ctrl.acquire('b')
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(ctrl.stats()['waiting'], 0)
+        self.assertEqual(ctrl.stats()['clients'], 1)
+
+    def test_round_robin_between_clients(self):
+        ctrl = AdmissionController(max_concurrent=1, max_queue=10, max_per_client=10, queue_timeout=5)
+        ctrl.acquire('holder')
+        order = []
+
+        def worker(client):
+            with ctrl.admit(client):
+                order.append(client)
+
+        threads = []
+        # The spammer queues three requests before the quiet client queues one
+        for client in ['spam', 'spam', 'spam', 'quiet']:
+            t = threading.Thread(target=worker, args=(client,))
+            t.start()
+            threads.append(t)
+            time.sleep(0.05)
+
+        ctrl.release('holder')
+        for t in threads:
+            t.join()
+        self.assertEqual(order[:2], ['spam', 'quiet'])
+        self.assertEqual(ctrl.stats()['running'], 0)
+
+class AdmissionRouteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app_module.app.test_client()
+        self.scheduler = Scheduler(interactive_slots=1, batch_slots=1, max_queue=0)
+        self.patcher = patch.object(app_module, 'scheduler', self.scheduler)
+        self.patcher.start()
+        # Keep the timeouts these tests inject out of the app's failure cache
+        failures = patch.object(app_module, 'failures', FailureCache())
+        failures.start()
+        self.addCleanup(failures.stop)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_busy_server_returns_503_with_retry_after(self):
+        self.scheduler.lanes[INTERACTIVE].acquire('someone-else')
+        self.scheduler.lanes[BATCH].acquire('someone-else')
+        with patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            response = self.app.post('/api/preview_box', json={'width': 1})
+            self.assertFalse(mock_run.called)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertFalse(json.loads(response.data)['success'])
+
+        response = self.app.post('/api/download_box', data={'width': 1})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_slot_released_after_generation(self):
+        with patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            mock_run.side_effect = TimeoutError()
+            response = self.app.post('/api/generate_box_info', json={'width': 1})
+        self.assertEqual(response.status_code, 408)
+        self.assertEqual(self.scheduler.lanes[INTERACTIVE].stats()['running'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
 import json
+import tempfile
+from unittest.mock import patch
 from app import app
+import app as app_module
+from mesh_cache import MeshCache
 
 import logging_loki
 
@@ -12,6 +16,12 @@ class OpenGridGenTestCase(unittest.TestCase):
                 app.logger.removeHandler(h)
         self.app = app.test_client()
         self.app.testing = True
+        # Generate for real instead of serving artifacts cached by earlier runs
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = patch.object(app_module, 'mesh_cache', MeshCache(tmp.name))
+        cache.start()
+        self.addCleanup(cache.stop)
 
     def test_index(self):
         response = self.app.get('/')
@@ -0,0 +1,158 @@
+import unittest
+import asyncio
+import json
+import threading
+import time
+from unittest.mock import patch
+
+import app as app_module
+import asgi
+from asgi import ASGIApp
+
+def fake_run(task, kwargs, timeout, cancel=None, worker=None):
+    time.sleep(0.05)
+    if kwargs.get('output_path'):
+        with open(kwargs['output_path'], 'wb') as f:
+            f.write(b'solid mesh\n' * 100000)
+    return {'x': 1, 'y': 2, 'z': 3}
+
+class Client:
+    """Sends one request to an ASGI app the way an ASGI server would."""
+
+    def __init__(self, application):
+        self.application = application
+
+    async def request(self, method, path, body=b'', headers=(), disconnect=None):
+        query = path.partition('?')[2].encode()
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+                 'path': path.partition('?')[0], 'root_path': '', 'query_string': query,
+                 'headers': [(b'host', b'testserver'), (b'content-length', str(len(body)).encode()),
+                             *((name.encode(), value.encode()) for name, value in headers)],
+                 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        gone = disconnect or asyncio.Event()
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.application(scope, receive, send)
+        gone.set()
+        if not sent:
+            return None
+        start = sent[0]
+        return (start['status'], {name.decode(): value.decode() for name, value in start['headers']},
+                b''.join(message.get('body', b'') for message in sent[1:]))
+
+class ASGITestCase(unittest.TestCase):
+    def setUp(self):
+        self.application = ASGIApp(app_module.app, threads=4, generation_threads=2)
+        self.client = Client(self.application)
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_pages_are_served(self):
+        status, headers, body = self.run_async(self.client.request('GET', '/box'))
+        self.assertEqual(status, 200)
+        self.assertIn('text/html', headers['content-type'])
+        self.assertEqual(body, app_module.app.test_client().get('/box').data)
+
+    def test_preview_is_streamed(self):
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run):
+            status, headers, body = self.run_async(self.client.request(
+                'POST', '/api/preview_box', json.dumps({'width': 2}).encode(), [('content-type', 'application/json')]))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'solid mesh\n' * 100000)
+        self.assertEqual(headers['content-length'], str(len(body)))
+
+    def test_files_are_not_read_on_the_event_loop(self):
+        readers = set()
+
+        class RecordingWrapper(asgi.FileWrapper):
+            def __init__(self, file, buffer_size=asgi.FILE_CHUNK):
+                read = file.read
+                file.read = lambda size: readers.add(threading.current_thread()) or read(size)
+                super().__init__(file, buffer_size)
+
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run), \
+             patch.object(asgi, 'FileWrapper', RecordingWrapper):
+            status, headers, body = self.run_async(self.client.request(
+                'POST', '/api/preview_box', json.dumps({'width': 3}).encode(), [('content-type', 'application/json')]))
+        self.assertEqual((status, len(body)), (200, len(b'solid mesh\n' * 100000)))
+        self.assertTrue(readers)
+        self.assertNotIn(threading.main_thread(), readers)
+
+    def test_waiting_requests_do_not_hold_threads(self):
+        async def many():
+            requests = [self.client.request('POST', '/api/generate_box_info', json.dumps({'width': i % 3 + 1}).encode(),
+                                            [('content-type', 'application/json'), ('x-forwarded-for', str(i))])
+                        for i in range(60)]
+            return await asyncio.gather(*requests)
+
+        threads = threading.active_count()
+        peak = [0]
+        stop = threading.Event()
+
+        def sample():
+            while not stop.is_set():
+                peak[0] = max(peak[0], threading.active_count())
+                time.sleep(0.005)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run), \
+             patch.object(app_module, 'client_id', side_effect=lambda: app_module.request.headers['X-Forwarded-For']):
+            responses = self.run_async(many())
+        stop.set()
+        sampler.join()
+        self.assertEqual([status for status, _, _ in responses], [200] * 60)
+        # Two generation threads (and the sampler), not one per request
+        self.assertLessEqual(peak[0] - threads, 3)
+        self.assertEqual(self.application.stats()['generation']['waiting'], 0)
+
+    def test_client_leaving_while_waiting_is_dropped(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_run(task, kwargs, timeout, cancel=None, worker=None):
+            started.set()
+            release.wait(5)
+            return {'x': 1, 'y': 2, 'z': 3}
+
+        async def scenario():
+            busy = [asyncio.ensure_future(self.client.request('POST', '/api/generate_box_info', b'{"width": %d}' % i,
+                                                              [('content-type', 'application/json')]))
+                    for i in (1, 2)]
+            gone = asyncio.Event()
+            waiting = asyncio.ensure_future(self.client.request('POST', '/api/generate_box_info', b'{"width": 3}',
+                                                                [('content-type', 'application/json')], gone))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            await asyncio.sleep(0.1)
+            gone.set()
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.gather(*busy), await waiting
+
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=blocking_run) as mock_run:
+            busy, waiting = self.run_async(scenario())
+        self.assertEqual([status for status, _, _ in busy], [200, 200])
+        self.assertIsNone(waiting)
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertEqual(self.application.stats()['generation']['dropped'], 1)
+
+    def test_too_many_waiting_generations_are_rejected(self):
+        self.application.pools['generation'].max_waiting = 0
+        status, headers, body = self.run_async(self.client.request('POST', '/api/preview_box', b'{}'))
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '5')
+        self.assertEqual(self.run_async(self.client.request('GET', '/box'))[0], 200)
+
+if __name__ == '__main__':
+    unittest.main()
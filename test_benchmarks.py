@@ -0,0 +1,39 @@
+import unittest
+
+import benchmarks
+
+class BenchmarksTestCase(unittest.TestCase):
+    def test_full_suite_covers_every_generator(self):
+        generators = {generator for generator, _ in benchmarks.SUITES['full']}
+        self.assertEqual(generators, {'box', 'baseplate', 'lid', 'gear', 'hinge', 'tube_adapter'})
+        gear_types = {p['gear_type'] for g, p in benchmarks.SUITES['full'] if g == 'gear'}
+        self.assertEqual(gear_types, {'spur', 'helical', 'herringbone'})
+
+    def test_case_id_is_stable(self):
+        self.assertEqual(benchmarks.case_id('box', {'width': 1, 'height': 2}),
+                         benchmarks.case_id('box', {'height': 2, 'width': 1}))
+
+    def test_compare_flags_regressions(self):
+        baseline = {
+            'a': {'task_time': 1.0, 'peak_rss_mb': 100, 'output_bytes': 1000},
+            'b': {'task_time': 0.01, 'peak_rss_mb': 100, 'output_bytes': 1000},
+            'c': {'task_time': 1.0, 'peak_rss_mb': 100, 'output_bytes': 1000},
+        }
+        current = {
+            'a': {'task_time': 1.5, 'peak_rss_mb': 105, 'output_bytes': 1000},
+            'b': {'task_time': 0.03, 'peak_rss_mb': 100, 'output_bytes': 1000},
+            'c': {'error': 'GenerationError: boom'},
+            'new': {'task_time': 9.0},
+        }
+        regressions = benchmarks.compare(baseline, current, threshold=0.25)
+        self.assertEqual([(r[0], r[1]) for r in regressions], [('a', 'task_time'), ('c', 'error')])
+
+    def test_run_case_reports_stages(self):
+        results = benchmarks.benchmark([('hinge', {'length': 20.0})], log=lambda line: None)
+        result = results[benchmarks.case_id('hinge', {'length': 20.0})]
+        self.assertEqual(set(result['stages']), set(benchmarks.STAGES))
+        self.assertGreater(result['output_bytes'], 0)
+        self.assertGreater(result['peak_rss_mb'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import cadquery as cq
+
+import cache_backends
+from cache_backends import CacheBackend, DiskBackend, HashRing, RedisBackend, backend_from_env
+from mesh_cache import MeshCache, mesh_key
+from shape_store import ShapeStore
+import app as app_module
+
+class FakeRedis:
+    """The commands RedisBackend uses, with the semantics of a Redis server."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def _live(self, name):
+        if name in self.expires and self.expires[name] <= time.monotonic():
+            self.values.pop(name, None)
+            self.expires.pop(name)
+        return name in self.values
+
+    def get(self, name):
+        return self.values[name] if self._live(name) else None
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        if nx and self._live(name):
+            return None
+        self.values[name] = value.encode() if isinstance(value, str) else value
+        self.expires.pop(name, None)
+        if ex or px:
+            self.expires[name] = time.monotonic() + (ex or px / 1000)
+        return True
+
+    def pexpire(self, name, milliseconds):
+        self.expires[name] = time.monotonic() + milliseconds / 1000
+
+    def eval(self, script, numkeys, name, owner):
+        assert script == RedisBackend.RELEASE
+        if self.get(name) == owner.encode():
+            del self.values[name]
+            return 1
+        return 0
+
+class BackendContract:
+    """Behaviour every backend shares; subclasses set self.backend and self.clock."""
+
+    def test_publish_and_get(self):
+        self.assertIsNone(self.backend.get('artifact/abc/fine'))
+        self.backend.publish('artifact/abc/fine', b'mesh')
+        self.backend.publish('artifact/abc/fine', b'mesh 2')
+        self.assertEqual(self.backend.get('artifact/abc/fine'), b'mesh 2')
+        self.assertEqual(self.backend.stats()['publishes'], 2)
+        with self.assertRaises(ValueError):
+            self.backend.get('artifact/../../etc/passwd')
+
+    def test_lease_is_exclusive_until_released(self):
+        self.assertTrue(self.backend.acquire('artifact/abc', 'node-a:1', 60))
+        self.assertTrue(self.backend.acquire('artifact/abc', 'node-a:1', 60))  # renewed
+        self.assertFalse(self.backend.acquire('artifact/abc', 'node-b:1', 60))
+        self.backend.release('artifact/abc', 'node-b:1')  # not the owner: no effect
+        self.assertFalse(self.backend.acquire('artifact/abc', 'node-b:1', 60))
+        self.backend.release('artifact/abc', 'node-a:1')
+        self.assertTrue(self.backend.acquire('artifact/abc', 'node-b:1', 60))
+
+    def test_lease_expires(self):
+        self.assertTrue(self.backend.acquire('artifact/abc', 'node-a:1', 0.05))
+        self.advance(0.1)
+        self.assertTrue(self.backend.acquire('artifact/abc', 'node-b:1', 60))
+        self.assertFalse(self.backend.acquire('artifact/abc', 'node-a:1', 60))
+
+class DiskBackendTestCase(BackendContract, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.now = 1000.0
+        self.backend = DiskBackend(self.tmp.name, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_backends_implement_the_whole_interface(self):
+        with self.assertRaises(TypeError):
+            CacheBackend()
+
+    def test_publish_leaves_no_partial_files(self):
+        self.backend.publish('shape/abc', b'x' * 1000)
+        names = [name for _, _, files in os.walk(self.tmp.name) for name in files]
+        self.assertEqual(names, ['abc'])
+
+    def test_least_recently_used_values_are_evicted(self):
+        backend = DiskBackend(self.tmp.name, max_bytes=2500)
+        for i in range(3):
+            backend.publish(f'shape/{i}', b'x' * 1000)
+            os.utime(backend.path_for(f'shape/{i}'), (i, i))
+        backend.publish('shape/3', b'x' * 1000)
+        self.assertIsNone(backend.get('shape/0'))
+        self.assertIsNone(backend.get('shape/1'))
+        self.assertIsNotNone(backend.get('shape/3'))
+        self.assertEqual(backend.stats()['evictions'], 2)
+
+    def test_values_unused_for_ttl_are_removed(self):
+        backend = DiskBackend(self.tmp.name, ttl=3600)
+        backend.publish('shape/old', b'x')
+        os.utime(backend.path_for('shape/old'), (time.time() - 7200,) * 2)
+        backend.publish('shape/new', b'x')
+        self.assertIsNone(backend.get('shape/old'))
+        self.assertEqual(backend.get('shape/new'), b'x')
+
+class RedisBackendTestCase(BackendContract, unittest.TestCase):
+    def setUp(self):
+        self.backend = RedisBackend(FakeRedis())
+
+    def advance(self, seconds):
+        time.sleep(seconds)
+
+    def test_errors_mean_generating_again(self):
+        backend = RedisBackend(object())  # no commands at all: every call fails
+        self.assertIsNone(backend.get('artifact/abc/fine'))
+        backend.publish('artifact/abc/fine', b'mesh')
+        self.assertTrue(backend.acquire('artifact/abc', 'node-a:1', 60))
+        self.assertEqual(backend.stats()['errors'], 3)
+
+class ConfigurationTestCase(unittest.TestCase):
+    def test_backend_from_env(self):
+        self.assertIsNone(backend_from_env({}))
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = backend_from_env({'CACHE_BACKEND': f'dir://{tmp}', 'CACHE_BACKEND_MAX_MB': '1'})
+            self.assertIsInstance(backend, DiskBackend)
+            self.assertEqual((backend.root, backend.max_bytes), (tmp, 2**20))
+            self.assertEqual(backend_from_env({'CACHE_BACKEND': tmp}).root, tmp)
+
+    def test_hash_ring(self):
+        self.assertIsNone(HashRing.from_env({}))
+        ring = HashRing.from_env({'CACHE_NODES': 'a, b,c'})
+        self.assertEqual(ring.nodes, ['a', 'b', 'c'])
+        keys = [f'part-{i}' for i in range(2000)]
+        owners = {key: ring.node_for(key) for key in keys}
+        self.assertEqual(owners, {key: HashRing(['c', 'b', 'a']).node_for(key) for key in keys})
+        for node in ring.nodes:
+            self.assertGreater(list(owners.values()).count(node), 400)
+        # A new node only takes over keys: none move between the old ones
+        bigger = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if bigger.node_for(key) != owners[key]]
+        self.assertTrue(all(bigger.node_for(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+class SharedCacheTestCase(unittest.TestCase):
+    """Two replicas, each with its own local disk, sharing one backend."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.shared = DiskBackend(os.path.join(self.tmp.name, 'shared'))
+        self.key = mesh_key('box', {'width': 2}, {'GRU': 42.0})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def replica(self, name, **kwargs):
+        return MeshCache(os.path.join(self.tmp.name, name), shared=self.shared, node=name, **kwargs)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_artifacts_are_shared_between_replicas(self):
+        a, b = self.replica('a'), self.replica('b')
+        a.put(self.key, {'fine': self.write('fine.stl', 'fine')}, {'x': 1})
+        path, dims = b.get(self.key, 'fine')
+        self.assertEqual(dims, {'x': 1})
+        with open(path) as f:
+            self.assertEqual(f.read(), 'fine')
+        self.assertTrue(path.startswith(b.root))
+        self.assertIsNone(b.get(self.key, 'step'))
+        self.assertEqual((b.stats()['shared_hits'], b.stats()['misses']), (1, 1))
+        b.get(self.key, 'fine')
+        self.assertEqual(b.stats()['hits'], 1)  # now on b's own disk
+
+    def test_replica_waits_for_the_lease_holder(self):
+        a, b = self.replica('a'), self.replica('b', lease_seconds=30)
+        generated = threading.Event()
+
+        def generate_on_a():
+            with a.lease(self.key) as waited:
+                self.assertFalse(waited)
+                generated.set()
+                time.sleep(0.3)
+                a.put(self.key, {'fine': self.write('fine.stl', 'fine')}, {'x': 1})
+
+        thread = threading.Thread(target=generate_on_a)
+        thread.start()
+        generated.wait()
+        with b.lease(self.key) as waited:
+            self.assertTrue(waited)
+            self.assertIsNotNone(b.get(self.key, 'fine'))
+        thread.join()
+        self.assertEqual(b.stats()['lease_waits'], 1)
+
+    def test_expired_lease_stops_the_wait(self):
+        self.shared.acquire(f'artifact/{self.key}', 'dead-replica:1', 0.2)
+        b = self.replica('b', lease_seconds=30)
+        start = time.monotonic()
+        with b.lease(self.key) as waited:
+            self.assertTrue(waited)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_shapes_are_shared_between_replicas(self):
+        shape = cq.Workplane('XY').box(10, 10, 10).val()
+        ShapeStore(os.path.join(self.tmp.name, 'a'), shared=self.shared).put('box', 10, shape)
+        store = ShapeStore(os.path.join(self.tmp.name, 'b'), shared=self.shared)
+        self.assertAlmostEqual(store.get('box', 10).Volume(), 1000)
+        self.assertEqual(store.stats()['shared_hits'], 1)
+        self.assertIsNone(store.get('box', 11))
+
+    def test_preview_waits_for_other_replica(self):
+        """A replica asked for a part another replica is generating serves that one's meshes."""
+        other = self.replica('other')
+        cache = self.replica('this', lease_seconds=30)
+        client = app_module.app.test_client()
+        key = mesh_key('box', app_module.checked_params('box', {'width': 3}), app_module.SETTINGS)
+        leased = threading.Event()
+
+        def generate_elsewhere():
+            with other.lease(key):
+                leased.set()
+                time.sleep(0.3)
+                meshes = {lod: self.write(f'{lod}.stl', lod) for lod in ('coarse', 'medium', 'fine')}
+                other.put(key, meshes, {'x': 1, 'y': 2, 'z': 3})
+
+        thread = threading.Thread(target=generate_elsewhere)
+        thread.start()
+        leased.wait()
+        with patch.object(app_module, 'mesh_cache', cache), \
+             patch.object(app_module, 'cache_ring', HashRing(['this', 'other'])), \
+             patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            response = client.post('/api/preview_box?lod=coarse', json={'width': 3})
+        thread.join()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'coarse')
+        self.assertEqual(mock_run.call_count, 0)
+        self.assertEqual(response.headers['X-Cache-Node'], HashRing(['this', 'other']).node_for(key))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import socket
+import threading
+import time
+from unittest.mock import patch
+
+from admission import AdmissionController
+from cancellation import CancelToken, Cancelled, PreviewSessions, client_disconnected, SUPERSEDED, DISCONNECTED
+from coalescing import Coalescer
+from task_runner import run_task_with_timeout
+import app as app_module
+
+class CancelTokenTestCase(unittest.TestCase):
+    def test_client_disconnected(self):
+        server, client = socket.socketpair()
+        try:
+            self.assertFalse(client_disconnected(server))
+            # A pipelined request is not a disconnect
+            client.sendall(b'GET / HTTP/1.1\r\n')
+            self.assertFalse(client_disconnected(server))
+            client.close()
+            server.recv(100)
+            self.assertTrue(client_disconnected(server))
+        finally:
+            server.close()
+
+    def test_token_notices_disconnect(self):
+        server, client = socket.socketpair()
+        token = CancelToken(server)
+        self.assertFalse(token.is_set())
+        client.close()
+        self.assertTrue(token.is_set())
+        self.assertEqual(token.reason, DISCONNECTED)
+        self.assertEqual(Cancelled(token.reason).status, 499)
+        server.close()
+
+    def test_token_notices_disconnect_signalled_by_server(self):
+        disconnected = threading.Event()
+        token = CancelToken(disconnected=disconnected)
+        self.assertFalse(token.is_set())
+        disconnected.set()
+        self.assertTrue(token.is_set())
+        self.assertEqual(token.reason, DISCONNECTED)
+
+    def test_newer_preview_supersedes(self):
+        sessions = PreviewSessions()
+        first, second = CancelToken(), CancelToken()
+        sessions.begin('s1', first)
+        sessions.begin('s1', second)
+        self.assertTrue(first.is_set())
+        self.assertEqual(first.reason, SUPERSEDED)
+        self.assertFalse(second.is_set())
+        # The superseded request finishing must not drop the newer one
+        sessions.end('s1', first)
+        self.assertEqual(sessions.stats(), {'sessions': 1, 'superseded': 1})
+        sessions.end('s1', second)
+        self.assertEqual(sessions.stats()['sessions'], 0)
+
+class CancelExecutionTestCase(unittest.TestCase):
+    def test_cancel_terminates_worker(self):
+        token = CancelToken()
+        threading.Timer(0.5, token.cancel, args=(SUPERSEDED,)).start()
+        start = time.monotonic()
+        with self.assertRaises(Cancelled) as cm:
+            run_task_with_timeout(time.sleep, args=(30,), timeout=30, cancel=token)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(cm.exception.status, 409)
+
+    def test_cancel_while_queued(self):
+        ctrl = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=10)
+        ctrl.acquire('a')
+        token = CancelToken()
+        threading.Timer(0.2, token.cancel, args=(DISCONNECTED,)).start()
+        with self.assertRaises(Cancelled):
+            ctrl.acquire('b', token)
+        self.assertEqual(ctrl.stats()['waiting'], 0)
+        self.assertEqual(ctrl.stats()['rejected_timeout'], 0)
+
+    def test_shared_generation_runs_until_everyone_cancelled(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+        flights = []
+
+        def generate(flight):
+            flights.append(flight)
+            started.set()
+            while not flight.is_set():
+                time.sleep(0.01)
+            raise Cancelled(flight.reason)
+
+        leader, follower = CancelToken(), CancelToken()
+        errors = []
+
+        def call(token):
+            try:
+                coalescer.run('key', generate, cancel=token)
+            except Cancelled as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(leader,))]
+        threads[0].start()
+        started.wait()
+        threads.append(threading.Thread(target=call, args=(follower,)))
+        threads[1].start()
+        while coalescer.stats()['waiting'] < 1:
+            time.sleep(0.01)
+
+        leader.cancel(DISCONNECTED)
+        time.sleep(0.2)
+        self.assertFalse(flights[0].is_set())
+        follower.cancel(DISCONNECTED)
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(len(flights), 1)
+
+class SupersedeRouteTestCase(unittest.TestCase):
+    def test_newer_preview_cancels_older(self):
+        running = threading.Event()
+
+        def fake_run(task, kwargs, timeout, cancel, worker=None):
+            if kwargs['params']['width'] == 1:
+                running.set()
+                while not cancel.is_set():
+                    time.sleep(0.01)
+                raise Cancelled(cancel.reason)
+            with open(kwargs['output_path'], 'w') as f:
+                f.write('solid box')
+            return {'x': 84, 'y': 42, 'z': 21}
+
+        responses = {}
+
+        def request(width):
+            response = app_module.app.test_client().post(
+                '/api/preview_box', json={'width': width}, headers={'X-Preview-Session': 'page-1'})
+            responses[width] = response.status_code
+
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run):
+            first = threading.Thread(target=request, args=(1,))
+            first.start()
+            running.wait(5)
+            request(2)
+            first.join(5)
+
+        self.assertEqual(responses, {1: 409, 2: 200})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from admission import AdmissionRejected
+from coalescing import Coalescer, flight_key
+import app as app_module
+
+class FlightKeyTestCase(unittest.TestCase):
+    def test_key_is_canonical(self):
+        self.assertEqual(flight_key('box', {'width': 1, 'length': 2}, {'GRU': 25.0}, 'stl'),
+                         flight_key('box', {'length': 2, 'width': 1}, {'GRU': 25.0}, 'stl'))
+        self.assertNotEqual(flight_key('box', {'width': 1}, {}, 'stl'), flight_key('box', {'width': 1}, {}, 'step'))
+        self.assertNotEqual(flight_key('box', {'width': 1}, {}), flight_key('lid', {'width': 1}, {}))
+
+class CoalescerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = Coalescer()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def start(self, fn, count):
+        """Run count concurrent callers, the first one becomes the leader."""
+        results, errors = {}, {}
+
+        def call(i):
+            try:
+                results[i] = self.coalescer.run('key', lambda cancel: fn(self.path(f'out{i}')), self.path(f'out{i}'))
+            except Exception as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        threads[0].start()
+        while not self.coalescer.stats()['in_flight']:
+            time.sleep(0.01)
+        for t in threads[1:]:
+            t.start()
+        while self.coalescer.stats()['waiting'] < count - 1:
+            time.sleep(0.01)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return results, errors
+
+    def generate(self, output_path):
+        self.calls += 1
+        self.release.wait()
+        with open(output_path, 'w') as f:
+            f.write('solid')
+        return {'x': 1}
+
+    def test_identical_requests_share_one_generation(self):
+        results, errors = self.start(self.generate, 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(errors, {})
+        self.assertEqual(list(results.values()), [{'x': 1}] * 4)
+        for i in range(4):
+            with open(self.path(f'out{i}')) as f:
+                self.assertEqual(f.read(), 'solid')
+        self.assertEqual(self.coalescer.stats()['coalesced'], 3)
+        self.assertEqual(self.coalescer.stats()['in_flight'], 0)
+
+    def test_leader_timeout_is_shared(self):
+        def timeout(output_path):
+            self.calls += 1
+            self.release.wait()
+            raise TimeoutError()
+
+        results, errors = self.start(timeout, 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(e, TimeoutError) for e in errors.values()))
+
+    def test_followers_retry_when_leader_is_rejected(self):
+        def rejected_once(output_path):
+            self.calls += 1
+            if self.calls == 1:
+                self.release.wait()
+                raise AdmissionRejected("Too many concurrent requests from this client", 429, 1)
+            return self.generate(output_path)
+
+        results, errors = self.start(rejected_once, 3)
+        # Only the rejected leader fails, its followers start a new flight
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(list(results.values()), [{'x': 1}] * 2)
+
+    def test_sequential_requests_are_not_coalesced(self):
+        self.release.set()
+        self.coalescer.run('key', lambda cancel: self.generate(self.path('a')), self.path('a'))
+        self.coalescer.run('key', lambda cancel: self.generate(self.path('b')), self.path('b'))
+        self.assertEqual(self.calls, 2)
+
+class CoalescingRouteTestCase(unittest.TestCase):
+    def test_concurrent_previews_run_once(self):
+        release = threading.Event()
+
+        def fake_run(task, kwargs, timeout, cancel=None, worker=None):
+            release.wait()
+            with open(kwargs['output_path'], 'w') as f:
+                f.write('solid box')
+            return {'x': 42, 'y': 42, 'z': 21}
+
+        coalescer = Coalescer()
+        responses = []
+
+        def request():
+            response = app_module.app.test_client().post('/api/preview_box', json={'width': 1, 'length': 1})
+            responses.append((response.status_code, response.get_data()))
+
+        with patch.object(app_module, 'coalescer', coalescer), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run) as mock_run:
+            threads = [threading.Thread(target=request) for _ in range(3)]
+            for t in threads:
+                t.start()
+            deadline = time.monotonic() + 10
+            while coalescer.stats()['waiting'] < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(responses, [(200, b'solid box')] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
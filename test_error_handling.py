@@ -3,12 +3,16 @@ import json
 import time
 from unittest.mock import patch, MagicMock
 from app import app
+import app as app_module
 from generation_utils import GeometryValidationError
 
 import logging_loki
 
 class ErrorHandlingTestCase(unittest.TestCase):
     def setUp(self):
+        # The failures these tests inject must not be remembered for other tests
+        app_module.failures.clear()
+        self.addCleanup(app_module.failures.clear)
         # Remove LokiHandler to avoid network calls
         for h in app.logger.handlers[:]:
             if isinstance(h, logging_loki.LokiHandler):
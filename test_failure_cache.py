@@ -0,0 +1,115 @@
+import unittest
+from unittest.mock import patch
+
+from failure_cache import FailureCache
+from generators import GeometryValidationError, GenerationError
+from cancellation import Cancelled
+from task_runner import TaskTimeout
+from mesh_cache import MeshCache
+import app as app_module
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FailureCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = FailureCache(ttl=60, timeout_ttl=10, max_entries=3, clock=self.clock)
+
+    def test_failures_expire_after_their_ttl(self):
+        self.cache.record('a', 'box', {'width': 1}, GeometryValidationError('bad faces'))
+        self.cache.record('b', 'box', {'width': 2}, TaskTimeout('slow'))
+        error = self.cache.get('a')
+        self.assertIsInstance(error, GeometryValidationError)
+        self.assertEqual(str(error), 'bad faces')
+        self.assertIsInstance(self.cache.get('b'), TaskTimeout)
+
+        self.clock.now = 30
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.clock.now = 61
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_only_repeatable_failures_are_remembered(self):
+        for i, error in enumerate([GenerationError('x'), Cancelled('superseded'), ValueError('y')]):
+            self.cache.record(i, 'box', {}, error)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_timeouts_are_remembered_per_request_kind(self):
+        self.cache.record('a', 'box', {}, TaskTimeout('slow'), 'preview')
+        self.assertIsInstance(self.cache.get('a', 'preview'), TaskTimeout)
+        self.assertIsNone(self.cache.get('a', 'info'))
+        self.cache.record('a', 'box', {}, GeometryValidationError('bad faces'), 'preview')
+        self.assertIsInstance(self.cache.get('a', 'info'), GeometryValidationError)
+
+    def test_waiting_for_a_busy_worker_is_not_remembered(self):
+        self.cache.record('a', 'box', {}, TimeoutError('Job 1 timed out waiting for a worker'), 'info')
+        self.assertIsNone(self.cache.get('a', 'info'))
+
+    def test_top_lists_most_common_failures(self):
+        self.cache.record('b', 'hinge', {}, TaskTimeout('slow'))
+        for _ in range(2):
+            self.cache.record('a', 'gear', {'teeth': 5}, GeometryValidationError('invalid'))
+        self.cache.get('a')
+        for key in 'cd':
+            self.cache.record(key, 'box', {}, TaskTimeout('slow'))
+
+        top = self.cache.top()
+        self.assertEqual(len(top), 3)  # 'b' was evicted
+        self.assertEqual((top[0]['generator'], top[0]['kind'], top[0]['failures'], top[0]['hits']),
+                         ('gear', 'validation', 2, 1))
+        self.assertEqual(top[0]['params'], {'teeth': 5})
+
+class FailureCacheEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app_module.app.test_client()
+        self.cache = FailureCache()
+
+    def test_repeated_failure_is_answered_from_cache(self):
+        with patch.object(app_module, 'failures', self.cache), \
+             patch.object(app_module, 'mesh_cache', MeshCache('unused', max_bytes=0)), \
+             patch.object(app_module, 'ADMIN_TOKEN', 'secret'), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=GeometryValidationError('Invalid shape')) as mock_run:
+            first = self.client.post('/api/generate_box_info', json={'width': 9, 'length': 9})
+            # Same part: params are canonical and the format does not matter
+            again = self.client.post('/api/download_box', data={'width': '9', 'length': '9.0', 'format': 'stl'})
+            self.assertEqual(first.status_code, 422)
+            self.assertEqual(again.status_code, 422)
+            self.assertEqual(again.headers.get('X-Failure-Cached'), '1')
+            self.assertNotIn('X-Failure-Cached', first.headers)
+            self.assertEqual(mock_run.call_count, 1)
+
+            response = self.client.get('/admin/failures', headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(response.get_json()['failures'][0]['hits'], 1)
+            for limit in ('ten', '-1', '0'):
+                response = self.client.get(f'/admin/failures?limit={limit}', headers={'X-Admin-Token': 'secret'})
+                self.assertEqual(response.status_code, 400)
+            # Nothing is forgotten by a rejected request
+            response = self.client.delete('/admin/failures?limit=ten', headers={'X-Admin-Token': 'secret'})
+            self.assertEqual((response.status_code, self.cache.stats()['entries']), (400, 1))
+            self.client.delete('/admin/failures', headers={'X-Admin-Token': 'secret'})
+            self.client.post('/api/generate_box_info', json={'width': 9, 'length': 9})
+            self.assertEqual(mock_run.call_count, 2)
+
+    def test_only_task_timeouts_are_remembered(self):
+        with patch.object(app_module, 'failures', self.cache), \
+             patch.object(app_module, 'mesh_cache', MeshCache('unused', max_bytes=0)), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=TimeoutError('Generation timed out')) as mock_run:
+            self.assertEqual(self.client.post('/api/generate_box_info', json={'width': 8}).status_code, 408)
+            self.assertEqual(self.client.post('/api/generate_box_info', json={'width': 8}).status_code, 408)
+            self.assertEqual(mock_run.call_count, 2)
+            mock_run.side_effect = TaskTimeout('Generation timed out')
+            self.client.post('/api/generate_box_info', json={'width': 8})
+            again = self.client.post('/api/generate_box_info', json={'width': 8})
+            self.assertEqual(again.headers.get('X-Failure-Cached'), '1')
+            self.assertEqual(mock_run.call_count, 3)
+            # A preview builds more than an info request
+            self.client.post('/api/preview_box', json={'width': 8})
+            self.assertEqual(mock_run.call_count, 4)
+
+if __name__ == '__main__':
+    unittest.main()
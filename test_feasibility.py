@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch
+
+from feasibility import Infeasible, checked_params
+from params import InvalidParams, MODELS
+import app as app_module
+import task_runner
+
+class FeasibilityTestCase(unittest.TestCase):
+    def assertInfeasible(self, generator, data, fields):
+        with self.assertRaises(Infeasible) as ctx:
+            checked_params(generator, data)
+        self.assertEqual([e['field'] for e in ctx.exception.errors], fields)
+
+    def test_defaults_are_feasible(self):
+        for generator in MODELS:
+            checked_params(generator, {})
+
+    def test_tube_adapter(self):
+        self.assertInfeasible('tube_adapter', {'side_a_id': 6, 'side_b_id': 7, 'side_b_od': 6.5}, ['side_a_id', 'side_b_id'])
+        self.assertInfeasible('tube_adapter', {'side_b_barb': True, 'length': 10, 'num_barbs': 3}, ['num_barbs'])
+        # Barbs only need room when a side has them
+        checked_params('tube_adapter', {'length': 10, 'num_barbs': 3})
+
+    def test_hinge(self):
+        self.assertInfeasible('hinge', {'height': 4, 'pin_diam': 3.2}, ['pin_diam'])
+        self.assertInfeasible('hinge', {'length': 5, 'height': 10, 'clearance': 2.5}, ['clearance'])
+        checked_params('hinge', {'height': 4, 'pin_diam': 3.1})
+
+    def test_gear(self):
+        self.assertInfeasible('gear', {'teeth': 10, 'bore_d': 7.5}, ['bore_d'])
+        self.assertInfeasible('gear', {'backlash': 1.6}, ['backlash'])
+        self.assertInfeasible('gear', {'gear_type': 'herringbone'}, ['helix_angle'])
+        checked_params('gear', {'teeth': 10, 'bore_d': 7.4, 'gear_type': 'herringbone', 'helix_angle': 20})
+
+    def test_invalid_values_are_reported_before_feasibility(self):
+        with self.assertRaises(InvalidParams) as ctx:
+            checked_params('gear', {'teeth': 'many', 'bore_d': 100})
+        self.assertNotIsInstance(ctx.exception, Infeasible)
+
+    def test_errors_raised_in_a_worker_keep_their_type(self):
+        with self.assertRaises(Infeasible) as ctx:
+            task_runner.run_task_with_timeout('generation_utils:generate_gear_task',
+                                              kwargs={'params': {'teeth': 10, 'bore_d': 20}, 'settings': {}}, timeout=60)
+        self.assertEqual((ctx.exception.status, ctx.exception.errors[0]['field']), (422, 'bore_d'))
+        with self.assertRaises(InvalidParams) as ctx:
+            task_runner.run_task_with_timeout('generation_utils:generate_gear_task',
+                                              kwargs={'params': {'teeth': 'many'}, 'settings': {}}, timeout=60)
+        self.assertEqual((ctx.exception.status, ctx.exception.errors[0]['field']), (400, 'teeth'))
+
+    def test_endpoints_reject_without_dispatch(self):
+        client = app_module.app.test_client()
+        with patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            response = client.post('/api/preview_gear', json={'teeth': 10, 'bore_d': 20})
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(response.get_json()['errors'][0]['field'], 'bore_d')
+            response = client.post('/api/download_tube_adapter', data={'side_a_id': '8', 'format': 'stl'})
+            self.assertEqual(response.status_code, 422)
+            self.assertIn(b'Side A ID', response.data)
+            mock_run.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
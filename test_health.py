@@ -0,0 +1,105 @@
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+
+import task_runner
+from mesh_cache import MeshCache
+from scheduler import Scheduler
+import app as app_module
+
+class HealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app_module.app.test_client()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, value in (('mesh_cache', MeshCache(tmp.name)), ('scheduler', Scheduler(2, 1))):
+            p = patch.object(app_module, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_healthz(self):
+        with patch.dict(app_module.worker_self_test, {'warm': False}):
+            response = self.client.get('/healthz')
+        self.assertEqual((response.status_code, response.get_json()), (200, {'status': 'ok'}))
+
+    def test_not_ready_until_warm(self):
+        with patch.dict(app_module.worker_self_test, {'warm': False}):
+            response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json()['checks'], {'warm': False, 'capacity': True})
+
+        with patch.dict(app_module.worker_self_test, {'warm': True, 'warmup_seconds': 4.2}):
+            response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual((report['ready'], report['warmup_seconds']), (True, 4.2))
+        self.assertEqual((report['queue_depth'], report['busy_workers'], report['workers']), (0, 0, 3))
+        self.assertEqual(report['cache'], {'enabled': True, 'entries': 0, 'bytes': 0,
+                                           'max_bytes': 256 * 2**20, 'shared': None})
+
+    def test_not_ready_when_saturated(self):
+        scheduler = Scheduler(1, 1, max_queue=0)
+        scheduler.lanes['interactive'].acquire('a')
+        with patch.object(app_module, 'scheduler', scheduler), \
+             patch.dict(app_module.worker_self_test, {'warm': True}):
+            self.assertEqual(self.client.get('/readyz').status_code, 200)
+            scheduler.lanes['batch'].acquire('b')
+            response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json()['busy_workers'], 2)
+        self.assertFalse(response.get_json()['checks']['capacity'])
+
+    def test_not_ready_without_job_queue(self):
+        class BrokenQueue:
+            def stats(self):
+                raise ConnectionError('Connection refused')
+
+        with patch.object(app_module, 'job_queue', BrokenQueue()), \
+             patch.dict(app_module.worker_self_test, {'warm': True}):
+            response = self.client.get('/readyz')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['checks']['job_queue'])
+
+    def test_warm_up_renders_a_box(self):
+        rendered = []
+
+        def run(task, kwargs, timeout):
+            with open(kwargs['output_path'], 'w') as f:
+                f.write('mesh')
+            rendered.append((task, kwargs))
+            return {'x': 1, 'y': 1, 'z': 1}
+
+        with patch.dict(app_module.worker_self_test, {'warm': False}), \
+             patch.object(task_runner, 'self_test', return_value={'task_start_seconds': 0.1}):
+            app_module.run_worker_self_test(run)
+            self.assertTrue(app_module.worker_self_test['warm'])
+            self.assertGreaterEqual(app_module.worker_self_test['warmup_seconds'], 0)
+        task, kwargs = rendered[0]
+        self.assertEqual((task, kwargs['format']), (app_module.TASKS['box'], 'stl'))
+        self.assertFalse(os.path.exists(kwargs['output_path']))
+
+    def test_failed_warm_up_is_retried(self):
+        attempts = []
+        waits = []
+
+        def run(task, kwargs, timeout):
+            attempts.append(task)
+            if len(attempts) < 3:
+                raise TimeoutError('Generation timed out after 300 seconds')
+            return {'x': 1, 'y': 1, 'z': 1}
+
+        def wait(seconds):
+            waits.append(seconds)
+            self.assertEqual(app_module.worker_self_test['error'], 'Generation timed out after 300 seconds')
+            self.assertEqual(self.client.get('/readyz').status_code, 503)
+
+        with patch.dict(app_module.worker_self_test, {'warm': False}), \
+             patch.object(task_runner, 'self_test', return_value={'task_start_seconds': 0.1}):
+            app_module.run_worker_self_test(run, wait)
+            self.assertNotIn('error', app_module.worker_self_test)
+            self.assertEqual(self.client.get('/readyz').status_code, 200)
+        self.assertEqual(waits, [app_module.SELF_TEST_RETRY_SECONDS, 2 * app_module.SELF_TEST_RETRY_SECONDS])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,445 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import task_runner
+from cancellation import Cancelled, CancelToken
+from feasibility import Infeasible
+from generators import GeometryValidationError, lod_path
+from job_queue import (CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobQueue, RedisQueue, SQLiteQueue, WorkerLost,
+                       queue_from_env)
+from mesh_cache import MeshCache, mesh_key
+from scheduler import Scheduler
+from worker import Worker
+import app as app_module
+
+class FakeRedis:
+    """The commands RedisQueue uses, with decoded responses, as a Redis server runs them."""
+
+    def __init__(self):
+        self.data = {}
+
+    def _text(self, value):
+        return value if isinstance(value, str) else str(value)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    # Strings
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+
+    # Hashes
+    def hset(self, name, key=None, value=None, mapping=None):
+        fields = self.data.setdefault(name, {})
+        fields.update({self._text(k): self._text(v) for k, v in (mapping or {key: value}).items()})
+
+    def hsetnx(self, name, key, value):
+        self.data.setdefault(name, {}).setdefault(key, self._text(value))
+
+    def hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    def hmget(self, name, *keys):
+        return [self.hget(name, key) for key in keys]
+
+    def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def hincrby(self, name, key, amount):
+        fields = self.data.setdefault(name, {})
+        fields[key] = str(int(fields.get(key, 0)) + amount)
+        return int(fields[key])
+
+    def hdel(self, name, key):
+        self.data.get(name, {}).pop(key, None)
+
+    def expire(self, name, seconds):
+        pass
+
+    # Lists
+    def lpush(self, name, value):
+        self.data.setdefault(name, []).insert(0, value)
+
+    def rpush(self, name, value):
+        self.data.setdefault(name, []).append(value)
+
+    def rpoplpush(self, source, destination):
+        if not self.data.get(source):
+            return None
+        value = self.data[source].pop()
+        self.lpush(destination, value)
+        return value
+
+    def lrem(self, name, count, value):
+        items = self.data.get(name, [])
+        removed = items.count(value)
+        self.data[name] = [item for item in items if item != value]
+        return removed
+
+    def lrange(self, name, start, end):
+        return list(self.data.get(name, []))
+
+    def ltrim(self, name, start, end):
+        self.data[name] = self.data.get(name, [])[start:end + 1]
+
+    def llen(self, name):
+        return len(self.data.get(name, []))
+
+    # Sorted sets
+    def zadd(self, name, mapping):
+        self.data.setdefault(name, {}).update(mapping)
+
+    def zrem(self, name, member):
+        return 1 if self.data.get(name, {}).pop(member, None) is not None else 0
+
+    def zrangebyscore(self, name, low, high):
+        return [member for member, score in sorted(self.data.get(name, {}).items(), key=lambda item: item[1])
+                if low <= score <= high]
+
+    def zcard(self, name):
+        return len(self.data.get(name, {}))
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, command):
+        return lambda *args, **kwargs: self.commands.append((command, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, command)(*args, **kwargs) for command, args, kwargs in self.commands]
+
+class QueueContract:
+    """Behaviour of every queue; subclasses set self.queue with a clock at self.now."""
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_claim_and_finish(self):
+        first = self.queue.submit('generation_utils:generate_box_task', {'params': {'width': 1}})
+        second = self.queue.submit('generation_utils:generate_box_task', {'params': {'width': 2}})
+        job = self.queue.claim('w1')
+        self.assertEqual((job.id, job.state, job.worker, job.attempts), (first, RUNNING, 'w1', 1))
+        self.assertEqual(job.kwargs, {'params': {'width': 1}})
+        self.assertEqual(self.queue.claim('w2').id, second)
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertTrue(self.queue.heartbeat(first, 'w1'))
+        self.assertFalse(self.queue.heartbeat(first, 'w2'))
+
+        self.queue.finish(first, 'w1', result={'x': 1})
+        self.queue.finish(second, 'w2', error=GeometryValidationError('too thin'))
+        self.assertEqual((self.queue.get(first).state, self.queue.get(first).result), (DONE, {'x': 1}))
+        failed = self.queue.get(second)
+        self.assertEqual(failed.state, FAILED)
+        with self.assertRaisesRegex(GeometryValidationError, 'too thin'):
+            failed.raise_error()
+
+    def test_cancelled_job_stops_its_worker(self):
+        running = self.queue.submit('task:a', {})
+        queued = self.queue.submit('task:b', {})
+        self.queue.claim('w1')
+        self.queue.cancel(running, 'client left')
+        self.queue.cancel(queued)
+        self.assertFalse(self.queue.heartbeat(running, 'w1'))
+        self.assertIsNone(self.queue.claim('w2'))
+        self.queue.finish(running, 'w1', result={})
+        job = self.queue.get(running)
+        self.assertEqual(job.state, CANCELLED)
+        with self.assertRaisesRegex(Cancelled, 'client left'):
+            job.raise_error()
+
+    def test_resubmitted_job_is_joined(self):
+        first = self.queue.submit('task:a', {}, key='part.stl')
+        self.assertEqual(self.queue.submit('task:a', {}, key='part.stl'), first)
+        self.assertNotEqual(self.queue.submit('task:a', {}, key='part.step'), first)
+        self.assertEqual(self.queue.get(first).waiters, 2)
+        # Running on a worker: still joined; cancelled only once every submission gave up
+        self.queue.claim('w1')
+        self.assertEqual(self.queue.submit('task:a', {}, key='part.stl'), first)
+        self.queue.cancel(first)
+        self.queue.cancel(first)
+        self.assertTrue(self.queue.heartbeat(first, 'w1'))
+        self.queue.cancel(first)
+        self.assertEqual(self.queue.get(first).state, CANCELLED)
+        # A finished job is not: the next submission generates again
+        self.assertNotEqual(self.queue.submit('task:a', {}, key='part.stl'), first)
+
+    def test_job_records_timings_and_artifact(self):
+        job_id = self.queue.submit('task:a', {'params': {'width': 2}}, key='part.stl')
+        self.advance(2)
+        self.queue.claim('w1')
+        self.advance(5)
+        self.queue.finish(job_id, 'w1', result={'x': 1}, artifact='/artifacts/abc.stl')
+        self.queue.submit('task:b', {})
+        jobs = [job.as_dict() for job in self.queue.recent(limit=5)]
+        self.assertEqual([job['task'] for job in jobs], ['task:b', 'task:a'])
+        self.assertEqual({name: jobs[1][name] for name in ('key', 'params', 'worker', 'artifact', 'wait_seconds',
+                                                            'run_seconds')},
+                         {'key': 'part.stl', 'params': {'width': 2}, 'worker': 'w1', 'artifact': '/artifacts/abc.stl',
+                          'wait_seconds': 2, 'run_seconds': 5})
+
+    def test_job_of_dead_worker_is_retried(self):
+        job_id = self.queue.submit('task:a', {})
+        for attempt in range(1, 4):
+            job = self.queue.claim(f'w{attempt}')
+            self.assertEqual((job.id, job.attempts), (job_id, attempt))
+            self.advance(10)
+            self.assertEqual(self.queue.requeue_stale(), 0)
+            self.advance(30)
+        self.assertEqual(self.queue.requeue_stale(), 1)
+        self.assertIsNone(self.queue.claim('w4'))
+        job = self.queue.get(job_id)
+        self.assertEqual(job.state, FAILED)
+        with self.assertRaises(WorkerLost):
+            job.raise_error()
+        # The late worker can no longer report on it
+        self.assertFalse(self.queue.heartbeat(job_id, 'w3'))
+
+    def test_invalid_params_come_back_with_their_fields(self):
+        job_id = self.queue.submit('task:a', {})
+        self.queue.claim('w1')
+        self.queue.finish(job_id, 'w1', error=Infeasible([{'field': 'bore_d', 'error': 'Bore too wide'}]))
+        with self.assertRaises(Infeasible) as ctx:
+            self.queue.get(job_id).raise_error()
+        self.assertEqual((ctx.exception.status, ctx.exception.errors), (422, [{'field': 'bore_d', 'error': 'Bore too wide'}]))
+
+    def test_run_times_out_without_workers(self):
+        self.queue.queue_timeout = 0.3
+        start = time.monotonic()
+        with self.assertRaisesRegex(TimeoutError, 'waiting for a worker'):
+            self.queue.run('task:a', {}, timeout=30)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.queue.stats()[QUEUED], 0)
+
+    def test_run_waits_for_the_result(self):
+        def work():
+            while (job := self.queue.claim('w1')) is None:
+                time.sleep(0.01)
+            self.assertEqual(job.kwargs, {'params': {}, 'timeout': 30})
+            self.queue.finish(job.id, 'w1', result={'x': 3})
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        self.assertEqual(self.queue.run('task:a', {'params': {}}, timeout=30), {'x': 3})
+        thread.join()
+
+    def test_run_cancels_the_job(self):
+        cancel = CancelToken()
+        threading.Timer(0.2, cancel.cancel, ('superseded',)).start()
+        with self.assertRaises(Cancelled):
+            self.queue.run('task:a', {}, timeout=30, cancel=cancel)
+        self.assertEqual(self.queue.stats()[QUEUED], 0)
+        self.assertIsNone(self.queue.claim('w1'))
+
+class SQLiteQueueTestCase(QueueContract, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.now = 1000.0
+        self.queue = SQLiteQueue(os.path.join(self.tmp.name, 'jobs.db'), clock=lambda: self.now)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_finished_jobs_are_removed(self):
+        job_id = self.queue.submit('task:a', {})
+        self.queue.cancel(job_id)
+        self.advance(86401)
+        self.queue.requeue_stale()
+        self.assertIsNone(self.queue.get(job_id))
+
+    def test_jobs_survive_a_restart(self):
+        running = self.queue.submit('task:b', {})
+        self.queue.claim('w1')  # the process running it dies
+        queued = self.queue.submit('task:a', {'params': {}}, key='part.stl')
+        restarted = SQLiteQueue(self.queue.path, clock=lambda: self.now)
+        self.assertEqual(restarted.submit('task:a', {'params': {}}, key='part.stl'), queued)
+        self.assertEqual(restarted.claim('w2').id, queued)
+        self.advance(31)
+        self.assertEqual(restarted.claim('w2').id, running)
+
+    def test_older_database_is_upgraded(self):
+        path = os.path.join(self.tmp.name, 'old.db')
+        db = sqlite3.connect(path)
+        db.executescript(SQLiteQueue.SCHEMA.replace(',\n            key TEXT,\n            waiters INTEGER NOT NULL '
+                                                    'DEFAULT 1,\n            artifact TEXT', ''))
+        db.execute("INSERT INTO jobs (id, task, kwargs, state, created) VALUES ('old', 'task:a', '{}', 'queued', 1)")
+        db.commit()
+        db.close()
+        queue = SQLiteQueue(path)
+        self.assertEqual((queue.get('old').waiters, queue.get('old').key), (1, None))
+        self.assertEqual(queue.submit('task:a', {}, key='k'), queue.submit('task:a', {}, key='k'))
+
+    def test_queue_from_env(self):
+        self.assertIsNone(queue_from_env({}))
+        path = os.path.join(self.tmp.name, 'other.db')
+        queue = queue_from_env({'JOB_QUEUE': f'sqlite:///{path}', 'JOB_MAX_ATTEMPTS': '5'})
+        self.assertIsInstance(queue, SQLiteQueue)
+        self.assertEqual((queue.path, queue.max_attempts, queue.stale_seconds), (path, 5, 30))
+
+    def test_backends_implement_the_whole_queue(self):
+        with self.assertRaises(TypeError):
+            JobQueue()
+
+class RedisQueueTestCase(QueueContract, unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.queue = RedisQueue(FakeRedis(), clock=lambda: self.now)
+
+    def test_job_of_worker_dying_while_claiming_is_retried(self):
+        job_id = self.queue.submit('task:a', {})
+        # A worker died between taking the id and marking the job running
+        self.queue.client.rpoplpush(self.queue._name('queue'), self.queue._name('claimed'))
+        self.assertIsNone(self.queue.claim('w1'))
+        self.advance(31)
+        self.assertEqual(self.queue.claim('w1').id, job_id)
+
+def fake_generation(task, kwargs, timeout, cancel=None, worker=None):
+    """Writes the files of a generation like generation_utils tasks do."""
+    if kwargs['params']['width'] == 13:
+        raise GeometryValidationError('Walls too thin')
+    for path in [kwargs['output_path']] + [lod_path(kwargs['output_path'], lod) for lod in kwargs.get('lods', ())]:
+        with open(path, 'w') as f:
+            f.write(os.path.basename(path).split('.')[-2] if path != kwargs['output_path'] else 'fine')
+    return {'x': 1, 'y': 2, 'z': 3}
+
+class WorkerTestCase(unittest.TestCase):
+    """The web server and a worker daemon sharing a queue and an artifact store."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = SQLiteQueue(os.path.join(self.tmp.name, 'jobs.db'), heartbeat_seconds=0.1)
+        self.web_cache = MeshCache(os.path.join(self.tmp.name, 'web'))
+        self.worker = Worker(self.queue, MeshCache(self.web_cache.root), worker_id='w1', concurrency=2,
+                             poll_seconds=0.05)
+        self.client = app_module.app.test_client()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def serve(self):
+        thread = threading.Thread(target=self.worker.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.worker.stop)
+
+    def patched(self):
+        stack = [patch.object(app_module, 'job_queue', self.queue), patch.object(app_module, 'mesh_cache', self.web_cache),
+                 patch.object(task_runner, 'run_task_with_timeout', fake_generation),
+                 patch.object(app_module, 'run_task_with_timeout', side_effect=AssertionError('ran locally')),
+                 patch.object(app_module, 'ADMIN_TOKEN', 'secret')]
+        for p in stack:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_preview_and_download_run_on_worker(self):
+        self.patched()
+        self.serve()
+        response = self.client.post('/api/preview_box?lod=coarse', json={'width': 3})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data, b'coarse')
+        key = mesh_key('box', app_module.checked_params('box', {'width': 3}), app_module.SETTINGS)
+        self.assertEqual(self.client.get(f'/api/mesh/{key}/medium').data, b'medium')
+
+        response = self.client.post('/api/download_box', data={'width': 4, 'format': 'stl'})
+        self.assertEqual((response.status_code, response.data), (200, b'fine'))
+        self.assertEqual(self.worker.completed, 2)
+        self.assertEqual(self.queue.stats()[DONE], 2)
+        self.assertEqual(self.client.get('/admin/scheduler', headers={'X-Admin-Token': 'secret'}).get_json()['job_queue'][DONE], 2)
+        download_key = mesh_key('box', app_module.checked_params('box', {'width': 4}), app_module.SETTINGS)
+        jobs = self.client.get('/admin/jobs', headers={'X-Admin-Token': 'secret'}).get_json()['jobs']
+        self.assertEqual(self.client.get('/admin/jobs?limit=1.5', headers={'X-Admin-Token': 'secret'}).status_code, 400)
+        self.assertEqual([job['artifact'] for job in jobs], [f'/artifacts/{download_key}.stl', f'/artifacts/{key}.stl'])
+
+    def test_generation_error_comes_back(self):
+        self.patched()
+        self.serve()
+        with patch.object(app_module, 'failures') as failures:
+            failures.get.return_value = None
+            response = self.client.post('/api/preview_box', json={'width': 13})
+        self.assertEqual(response.status_code, 422, response.data)
+        self.assertIn('Walls too thin', response.get_json()['error'])
+        self.assertEqual(self.worker.failed, 1)
+
+    def test_scheduler_learns_the_run_time_not_the_wait(self):
+        self.patched()
+        scheduler = Scheduler(2, 1)
+        durations = []
+        release = scheduler.release
+        threading.Timer(0.5, self.serve).start()
+
+        def record(job, client, duration=None, timed_out=False):
+            durations.append(duration)
+            release(job, client, duration, timed_out)
+
+        with patch.object(app_module, 'job_scheduler', scheduler), patch.object(scheduler, 'release', side_effect=record):
+            response = self.client.post('/api/preview_box', json={'width': 5})
+        self.assertEqual(response.status_code, 200, response.data)
+        job = self.queue.recent(limit=1)[0]
+        self.assertGreaterEqual(job.started - job.created, 0.4)
+        self.assertEqual(durations, [job.finished - job.started])
+
+    def test_queued_jobs_are_not_bound_by_the_local_slots(self):
+        self.patched()
+        self.serve()
+        local = Scheduler(1, 0, queue_timeout=0.5)
+        local.acquire(local.plan('box', {'width': 2}, 'preview'), 'someone else')  # this host is full
+        with patch.object(app_module, 'scheduler', local), patch.object(app_module, 'job_scheduler', Scheduler(3, 1)):
+            response = self.client.post('/api/preview_box?lod=coarse', json={'width': 6})
+            ready = self.client.get('/readyz').get_json()
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((ready['workers'], ready['busy_workers']), (5, 1))
+
+    def test_worker_survives_an_unreachable_queue(self):
+        finish = self.queue.finish
+        calls = []
+
+        def flaky_finish(*args, **kwargs):
+            calls.append(args[0])
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return finish(*args, **kwargs)
+
+        self.worker.concurrency = 1
+        first = self.queue.submit('task:a', {'params': {'width': 13}, 'timeout': 30})
+        second = self.queue.submit('task:a', {'params': {'width': 13}, 'timeout': 30})
+        with patch.object(task_runner, 'run_task_with_timeout', fake_generation), \
+             patch.object(self.queue, 'finish', side_effect=flaky_finish):
+            self.serve()
+            deadline = time.monotonic() + 5
+            while self.queue.get(second).state != FAILED and time.monotonic() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(calls, [first, second])
+        self.assertEqual(self.queue.get(first).state, RUNNING)
+        self.assertEqual(self.worker.failed, 1)
+
+    def test_worker_stops_cancelled_job(self):
+        started = threading.Event()
+
+        def slow_generation(task, kwargs, timeout, cancel=None, worker=None):
+            started.set()
+            while not cancel.is_set():
+                time.sleep(0.01)
+            raise Cancelled(cancel.reason)
+
+        job_id = self.queue.submit('task:a', {'params': {}, 'timeout': 30})
+        with patch.object(task_runner, 'run_task_with_timeout', slow_generation):
+            self.serve()
+            started.wait(5)
+            self.queue.cancel(job_id)
+            deadline = time.monotonic() + 5
+            while self.worker._running and time.monotonic() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(self.worker._running, {})
+        self.assertEqual(self.queue.get(job_id).state, CANCELLED)
+
+if __name__ == '__main__':
+    unittest.main()
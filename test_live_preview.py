@@ -0,0 +1,220 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import cqgridfinity
+import generation_utils
+import live_preview
+import stage_cache
+from cancellation import CancelToken, Cancelled, SUPERSEDED
+from gears import Gear
+from live_preview import LivePreviewPool
+from stage_cache import StageCache
+from scheduler import Scheduler
+from task_runner import SessionWorker, run_task_with_timeout
+import app as app_module
+
+CALLS = 0
+
+def count_calls():
+    # Module state survives between tasks only in a warm worker
+    global CALLS
+    CALLS += 1
+    return CALLS, os.getpid()
+
+def slow_task(seconds):
+    time.sleep(seconds)
+    return 'done'
+
+class StageCacheTestCase(unittest.TestCase):
+    def test_hits_and_eviction(self):
+        cache = StageCache(max_entries=2)
+        builds = []
+        build = lambda name: (lambda: builds.append(name) or name)
+        self.assertEqual(cache.get_or_build('s', 1, build('a')), 'a')
+        self.assertEqual(cache.get_or_build('s', 1, build('b')), 'a')
+        cache.get_or_build('s', 2, build('c'))
+        cache.get_or_build('s', 3, build('d'))
+        cache.get_or_build('s', 1, build('e'))
+        self.assertEqual(builds, ['a', 'c', 'd', 'e'])
+        self.assertEqual(cache.stats(), {'entries': 2, 'hits': 1, 'misses': 4})
+
+    def test_gear_reuses_body_when_only_bore_changes(self):
+        cache = StageCache()
+        with patch.object(stage_cache, 'STAGES', cache):
+            first = Gear(teeth=10, bore_d=3.0).render().val()
+            second = Gear(teeth=10, bore_d=4.0, shaft_type='hex').render().val()
+            self.assertEqual(cache.stats()['hits'], 2)
+            fresh = StageCache()
+            with patch.object(stage_cache, 'STAGES', fresh):
+                expected = Gear(teeth=10, bore_d=4.0, shaft_type='hex').render().val()
+        self.assertNotAlmostEqual(first.Volume(), second.Volume(), places=2)
+        self.assertAlmostEqual(second.Volume(), expected.Volume(), places=4)
+
+class GridfinityBlocksTestCase(unittest.TestCase):
+    SETTINGS = {"GRU": 42.0, "GRHU": 7.0}
+
+    def test_baseplate_reuses_cells(self):
+        cache = StageCache()
+        generation_utils.update_constants(self.SETTINGS)
+        with patch.object(stage_cache, 'STAGES', cache):
+            plain = generation_utils.CustomGridfinityBaseplate(2, 1).render().val()
+            generation_utils.CustomGridfinityBaseplate(2, 1, length_padding=4).render()
+        self.assertEqual(cache.stats(), {'entries': 2, 'hits': 1, 'misses': 2})
+        expected = cqgridfinity.GridfinityBaseplate(2, 1).render().val()
+        self.assertAlmostEqual(plain.Volume(), expected.Volume(), places=4)
+
+    def test_box_is_rendered_once_per_task(self):
+        cache = StageCache()
+        with patch.object(stage_cache, 'STAGES', cache), tempfile.TemporaryDirectory() as tmp:
+            generation_utils.generate_box_task({'width': 1, 'length': 1, 'height': 2}, self.SETTINGS,
+                                               os.path.join(tmp, 'box.stl'), 'stl')
+            # Part, shell, feet and foot are each built once: validation and export reuse the render
+            self.assertEqual(cache.stats(), {'entries': 4, 'hits': 0, 'misses': 4})
+            generation_utils.generate_box_task({'width': 1, 'length': 1, 'height': 3}, self.SETTINGS)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+class SessionWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.worker = SessionWorker()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_worker_stays_warm(self):
+        first = run_task_with_timeout(count_calls, timeout=30, worker=self.worker)
+        second = run_task_with_timeout(count_calls, timeout=30, worker=self.worker)
+        self.assertEqual(second[0], first[0] + 1)
+        self.assertEqual(first[1], second[1])
+        self.assertNotEqual(first[1], os.getpid())
+
+    def test_cancelled_task_finishes_in_background(self):
+        token = CancelToken()
+        threading.Timer(0.2, token.cancel, args=(SUPERSEDED,)).start()
+        with self.assertRaises(Cancelled):
+            run_task_with_timeout(slow_task, args=(1,), timeout=30, cancel=token, worker=self.worker)
+        self.assertTrue(self.worker.busy())
+        # The next task waits for the superseded one instead of killing the warm worker
+        self.assertEqual(run_task_with_timeout(slow_task, args=(0,), timeout=30, worker=self.worker), 'done')
+        self.assertTrue(self.worker.alive())
+
+    def test_exited_worker_falls_back_to_one_shot(self):
+        self.worker.stop()
+        calls, pid = run_task_with_timeout(count_calls, timeout=30, worker=self.worker)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertFalse(self.worker.alive())
+
+    def test_timeout_stops_worker(self):
+        with self.assertRaises(TimeoutError):
+            run_task_with_timeout(slow_task, args=(30,), timeout=0.5, worker=self.worker)
+        self.assertFalse(self.worker.alive())
+
+class LivePreviewPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = LivePreviewPool(max_workers=1, idle_seconds=120)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_session_keeps_its_worker(self):
+        worker = self.pool.worker_for('a')
+        self.assertIs(self.pool.worker_for('a'), worker)
+        self.assertEqual(self.pool.stats()['reused'], 1)
+
+    def test_idle_worker_is_handed_over(self):
+        worker = self.pool.worker_for('a')
+        with patch.object(live_preview, 'MIN_IDLE_BEFORE_EVICTION', 0):
+            other = self.pool.worker_for('b')
+        self.assertIsNot(other, worker)
+        self.assertFalse(worker.alive())
+        self.assertEqual(self.pool.stats()['workers'], 1)
+
+    def test_busy_workers_fall_back_to_one_shot(self):
+        worker = self.pool.worker_for('a')
+        with worker.lock, patch.object(live_preview, 'MIN_IDLE_BEFORE_EVICTION', 0):
+            self.assertIsNone(self.pool.worker_for('b'))
+        self.assertEqual(self.pool.stats()['fallbacks'], 1)
+
+    def test_workers_start_and_stop_outside_the_lock(self):
+        locked = []
+        start, stop = SessionWorker.start, SessionWorker.stop
+
+        def check(method):
+            def wrapper(worker):
+                locked.append(self.pool._lock.locked())
+                return method(worker)
+            return wrapper
+
+        with patch.object(SessionWorker, 'start', check(start)), patch.object(SessionWorker, 'stop', check(stop)), \
+             patch.object(live_preview, 'MIN_IDLE_BEFORE_EVICTION', 0):
+            self.pool.worker_for('a')
+            self.pool.worker_for('b')
+            self.pool.shutdown()
+        self.assertEqual(locked, [False] * 4)
+
+    def test_concurrent_requests_start_a_new_worker_once(self):
+        barrier = threading.Barrier(2)
+        start = SessionWorker.start
+        errors = []
+
+        def slow_start(worker):
+            barrier.wait(5)  # both requests got the worker before either started it
+            start(worker)
+
+        def request():
+            try:
+                self.pool.worker_for('a')
+            except Exception as e:
+                errors.append(e)
+
+        with patch.object(SessionWorker, 'start', slow_start):
+            threads = [threading.Thread(target=request) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(self.pool.worker_for('a').alive())
+        self.assertEqual(self.pool.stats()['started'], 1)
+
+    def test_disabled(self):
+        self.assertIsNone(LivePreviewPool(max_workers=0).worker_for('a'))
+
+class LivePreviewRouteTestCase(unittest.TestCase):
+    def test_live_previews_use_the_session_worker(self):
+        pool = LivePreviewPool(max_workers=1)
+        client = app_module.app.test_client()
+        try:
+            with patch.object(app_module, 'live_previews', pool), \
+                 patch.object(app_module, 'run_task_with_timeout') as mock_run:
+                mock_run.return_value = {'x': 1, 'y': 1, 'z': 1}
+                client.post('/api/preview_gear', json={'teeth': 10},
+                            headers={'X-Preview-Session': 'p1', 'X-Live-Preview': '1'})
+                self.assertIsNotNone(mock_run.call_args.kwargs['worker'])
+                client.post('/api/preview_gear', json={'teeth': 11}, headers={'X-Preview-Session': 'p1'})
+                self.assertIsNone(mock_run.call_args.kwargs['worker'])
+        finally:
+            pool.shutdown()
+
+    def test_worker_is_taken_once_admitted(self):
+        pool = LivePreviewPool(max_workers=1)
+        scheduler = Scheduler(1, 1)
+        events = []
+        acquire, worker_for = scheduler.acquire, pool.worker_for
+        client = app_module.app.test_client()
+        try:
+            with patch.object(app_module, 'live_previews', pool), patch.object(app_module, 'scheduler', scheduler), \
+                 patch.object(scheduler, 'acquire', side_effect=lambda *a: events.append('admitted') or acquire(*a)), \
+                 patch.object(pool, 'worker_for', side_effect=lambda s: events.append('worker') or worker_for(s)), \
+                 patch.object(app_module, 'run_task_with_timeout', return_value={'x': 1, 'y': 1, 'z': 1}):
+                client.post('/api/preview_gear', json={'teeth': 12},
+                            headers={'X-Preview-Session': 'p2', 'X-Live-Preview': '1'})
+            self.assertEqual(events, ['admitted', 'worker'])
+        finally:
+            pool.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import random
+import threading
+from unittest.mock import patch
+
+from werkzeug.serving import make_server
+
+import loadtest
+from feasibility import checked_params
+import app as app_module
+
+class LoadTestTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_capacity(self):
+        levels = [
+            {'concurrency': 1, 'p95': 1.0, 'error_rate': 0.0},
+            {'concurrency': 4, 'p95': 5.0, 'error_rate': 0.0},
+            {'concurrency': 8, 'p95': 30.0, 'error_rate': 0.2},
+        ]
+        self.assertEqual(loadtest.capacity(levels, p95_slo=10.0, max_error_rate=0.01), 4)
+
+    def test_varied_params_stay_feasible(self):
+        rng = random.Random(0)
+        for _, path, _, params in loadtest.DEFAULT_MIX:
+            generator = loadtest.generator_of(path)
+            drawn = {checked_params(generator, loadtest.vary(generator, params, rng)).key for _ in range(50)}
+            self.assertGreater(len(drawn), 1, path)
+        self.assertEqual(loadtest.generator_of('/api/generate_box_info'), 'box')
+        self.assertEqual(loadtest.vary('box', {'width': 2, 'format': 'stl'}, random.Random(1)),
+                         loadtest.vary('box', {'width': 2, 'format': 'stl'}, random.Random(1)))
+
+    def test_run_level_against_local_instance(self):
+        server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        mix = [(1, '/api/generate_box_info', 'json', {'width': 1}),
+               (1, '/api/generate_baseplate_info', 'json', {'width': 1})]
+        try:
+            # Every request must reach the (mocked) worker, so identical requests are not coalesced here
+            with patch.object(app_module.coalescer, 'run', lambda key, fn, output_path=None, cancel=None: fn(cancel)), \
+                 patch.object(app_module, 'run_task_with_timeout') as mock_run:
+                mock_run.side_effect = [{'x': 1, 'y': 1, 'z': 1}] * 7 + [TimeoutError()] * 3
+                level = loadtest.run_level(f'http://127.0.0.1:{server.port}', 2, 10, mix=mix)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(level['requests'], 10)
+        self.assertAlmostEqual(level['timeout_rate'], 0.3)
+        self.assertEqual(level['status_counts'], {'200': 7, '408': 3})
+        self.assertIn('| 2 |', loadtest.markdown({'url': 'x', 'capacity': 2, 'p95_slo': 10.0,
+                                                   'max_error_rate': 0.01, 'levels': [level]}))
+
+if __name__ == '__main__':
+    unittest.main()
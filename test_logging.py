@@ -4,10 +4,14 @@ import json
 import logging
 from unittest.mock import patch
 from app import app
+import app as app_module
 from generation_utils import GeometryValidationError
 
 class LoggingTestCase(unittest.TestCase):
     def setUp(self):
+        # The failures these tests inject must not be remembered for other tests
+        app_module.failures.clear()
+        self.addCleanup(app_module.failures.clear)
         self.app = app.test_client()
         self.app.testing = True
         self.log_file = 'errors.log'
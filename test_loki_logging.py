@@ -1,8 +1,11 @@
 import unittest
 import sys
 import logging
+import time
 from unittest.mock import patch
 
+from loki_logging import LokiShipper, DropCountingQueueHandler, StubLokiReceiver, loki_config_from_env
+
 class LokiLoggingTestCase(unittest.TestCase):
     def setUp(self):
         # Remove app from sys.modules to force re-import and re-execution of configuration
@@ -11,29 +14,95 @@ class LokiLoggingTestCase(unittest.TestCase):
 
     def tearDown(self):
         if 'app' in sys.modules:
+            app = sys.modules['app']
+            if app.loki_shipper:
+                app.app.logger.removeHandler(app.loki_shipper.queue_handler)
+                app.loki_shipper.stop()
             del sys.modules['app']
 
-    def test_loki_handler_configured(self):
-        with patch('logging_loki.LokiHandler') as MockLokiHandler:
+    def test_loki_handler_configured_from_env(self):
+        env = {'LOKI_URL': 'http://127.0.0.1:9/loki/api/v1/push', 'LOKI_TAGS': '{"application": "test"}'}
+        with patch.dict('os.environ', env):
             import app
 
-            # Check if LokiHandler was initialized with expected values
-            MockLokiHandler.assert_called_with(
-                url="http://192.168.1.223:3100/loki/api/v1/push",
-                tags={"application": "opengridgen"},
-                version="1"
-            )
+        self.assertIsNotNone(app.loki_shipper)
+        self.assertEqual(app.loki_shipper.loki_handler.emitter.url, env['LOKI_URL'])
+        self.assertEqual(app.loki_shipper.loki_handler.emitter.tags, {"application": "test"})
+        self.assertIn(app.loki_shipper.queue_handler, app.app.logger.handlers)
+        self.assertEqual(app.app.logger.level, logging.INFO)
+
+    def test_invalid_tags_are_ignored(self):
+        for tags in ('{application: test}', '["test"]'):
+            with self.assertLogs('loki_logging', logging.WARNING):
+                config = loki_config_from_env({'LOKI_URL': 'http://127.0.0.1:9/loki/api/v1/push', 'LOKI_TAGS': tags})
+            self.assertEqual(config['tags'], {})
+
+    def test_loki_disabled_without_url(self):
+        self.assertIsNone(loki_config_from_env({}))
+
+    def test_logs_are_batched(self):
+        with StubLokiReceiver() as receiver:
+            shipper = LokiShipper(receiver.url, tags={"application": "test"}, batch_size=10, flush_interval=0.1)
+            logger = logging.getLogger('test_loki_batched')
+            logger.addHandler(shipper.queue_handler)
+            shipper.start()
+            try:
+                for i in range(25):
+                    logger.warning(f"message {i}")
+            finally:
+                shipper.stop()
+                logger.removeHandler(shipper.queue_handler)
+
+            self.assertEqual(receiver.lines(), [f"message {i}" for i in range(25)])
+            self.assertEqual(len(receiver.payloads), 3)
+            self.assertEqual(shipper.stats()['sent'], 25)
+
+    def test_steady_trickle_is_flushed_on_time(self):
+        with StubLokiReceiver() as receiver:
+            shipper = LokiShipper(receiver.url, batch_size=1000, flush_interval=0.2)
+            logger = logging.getLogger('test_loki_trickle')
+            logger.addHandler(shipper.queue_handler)
+            shipper.start()
+            try:
+                # A record every 50 ms: the queue never stays idle for flush_interval
+                for i in range(12):
+                    logger.warning(f"message {i}")
+                    time.sleep(0.05)
+                shipped = len(receiver.lines())
+            finally:
+                shipper.stop()
+                logger.removeHandler(shipper.queue_handler)
+
+            self.assertGreater(shipped, 0)
+            self.assertEqual(len(receiver.lines()), 12)
 
-            # Check if handler was added to app.logger
-            # Since MockLokiHandler() returns a mock instance, we check if that instance is in handlers
-            # However, app.py instantiates it at module level.
-            # MockLokiHandler is the class (mocked).
-            # The instance created is MockLokiHandler.return_value.
+    def test_slow_loki_does_not_block_logging(self):
+        with StubLokiReceiver(delay=1.0) as receiver:
+            shipper = LokiShipper(receiver.url, batch_size=1, queue_size=5, flush_interval=0.1)
+            logger = logging.getLogger('test_loki_slow')
+            logger.addHandler(shipper.queue_handler)
+            shipper.start()
+            try:
+                start = time.monotonic()
+                for i in range(50):
+                    logger.warning(f"message {i}")
+                elapsed = time.monotonic() - start
+            finally:
+                logger.removeHandler(shipper.queue_handler)
 
-            self.assertTrue(any(h == MockLokiHandler.return_value for h in app.app.logger.handlers))
+            self.assertLess(elapsed, 0.5)
+            self.assertGreater(shipper.stats()['dropped'], 0)
+            receiver.delay = 0
+            shipper.stop()
 
-            # Check logger level
-            self.assertEqual(app.app.logger.level, logging.INFO)
+    def test_queue_handler_counts_drops(self):
+        import queue
+        handler = DropCountingQueueHandler(queue.Queue(maxsize=1))
+        record = logging.LogRecord('x', logging.INFO, __file__, 1, 'msg', None, None)
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.enqueued, 1)
+        self.assertEqual(handler.dropped, 1)
 
 if __name__ == '__main__':
     unittest.main()
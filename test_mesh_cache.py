@@ -0,0 +1,187 @@
+import unittest
+import glob
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from generation_utils import generate_lid_task, lod_path
+from mesh_cache import MeshCache, mesh_key
+import app as app_module
+
+class MeshCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = MeshCache(os.path.join(self.tmp.name, 'meshes'))
+        self.key = mesh_key('box', {'width': 2}, {'GRU': 42.0})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_entry_is_completed_by_later_generations(self):
+        self.assertIsNone(self.cache.get(self.key, 'fine'))
+        self.cache.put(self.key, {'fine': self.write('a.stl', 'fine')}, {'x': 1})
+        self.assertIsNone(self.cache.get(self.key, 'coarse'))
+        self.cache.put(self.key, {'fine': self.write('b.stl', 'other'), 'coarse': self.write('c.stl', 'coarse')}, {'x': 1})
+
+        path, dims = self.cache.get(self.key, 'coarse')
+        self.assertEqual(dims, {'x': 1})
+        with open(path) as f:
+            self.assertEqual(f.read(), 'coarse')
+        with open(self.cache.get(self.key, 'fine')[0]) as f:
+            self.assertEqual(f.read(), 'fine')
+        # Sources stay in place for the response
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'c.stl')))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        keys = [mesh_key('box', {'width': w}, {}) for w in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, {'fine': self.write('m.stl', 'x' * 1000)}, {})
+            os.utime(os.path.join(self.cache.entry_dir(key), 'dims.json'), (i, i))
+        self.cache.get(keys[0], 'fine')
+        self.cache.max_bytes = 2500
+        self.cache.put(mesh_key('box', {'width': 3}, {}), {'fine': self.write('m.stl', 'x' * 1000)}, {})
+
+        self.assertIsNotNone(self.cache.get(keys[0], 'fine'))
+        self.assertIsNone(self.cache.get(keys[1], 'fine'))
+        self.assertIsNone(self.cache.get(keys[2], 'fine'))
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+
+    def test_entries_unused_for_max_age_are_collected(self):
+        old, recent = mesh_key('box', {'width': 1}, {}), mesh_key('box', {'width': 2}, {})
+        for key in (old, recent):
+            self.cache.put(key, {'fine': self.write('m.stl', 'x')}, {})
+        os.utime(os.path.join(self.cache.entry_dir(old), 'dims.json'), (time.time() - 7200,) * 2)
+        self.cache.max_age = 3600
+        self.assertEqual(self.cache.collect(), 1)
+        self.assertIsNone(self.cache.get(old, 'fine'))
+        self.assertIsNotNone(self.cache.get(recent, 'fine'))
+
+    def test_rejects_invalid_keys(self):
+        with self.assertRaises(ValueError):
+            self.cache.get('../../etc', 'fine')
+
+    def test_task_writes_levels_of_detail(self):
+        output = os.path.join(self.tmp.name, 'lid.stl')
+        generate_lid_task({'width': 1, 'length': 1}, {'GRU': 42.0, 'GRHU': 7.0}, output, 'stl', ['coarse', 'medium'])
+        sizes = [os.path.getsize(lod_path(output, lod)) for lod in ('coarse', 'medium')] + [os.path.getsize(output)]
+        self.assertEqual(sizes, sorted(sizes))
+        with open(lod_path(output, 'coarse'), 'rb') as f:
+            self.assertFalse(f.read(5) == b'solid')  # binary STL
+
+class ProgressivePreviewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = MeshCache(self.tmp.name)
+        self.client = app_module.app.test_client()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fake_run(self, task, kwargs, timeout, cancel=None, worker=None):
+        with open(kwargs['output_path'], 'w') as f:
+            f.write('fine')
+        for lod in kwargs.get('lods', []):
+            with open(lod_path(kwargs['output_path'], lod), 'w') as f:
+                f.write(lod)
+        return {'x': 42, 'y': 42, 'z': 7}
+
+    def test_coarse_first_then_finer_levels_from_cache(self):
+        with patch.object(app_module, 'mesh_cache', self.cache), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=self.fake_run) as mock_run:
+            response = self.client.post('/api/preview_box?lod=coarse', json={'width': 3})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'coarse')
+            self.assertEqual(response.headers['X-Mesh-Lods'], 'coarse,medium,fine')
+            key = response.headers['X-Mesh-Key']
+
+            fine = self.client.get(f'/api/mesh/{key}/fine')
+            self.assertEqual(fine.data, b'fine')
+            self.assertEqual(fine.headers['X-Dimensions'], response.headers['X-Dimensions'])
+
+            again = self.client.post('/api/preview_box?lod=medium', json={'width': 3})
+            self.assertEqual(again.data, b'medium')
+            self.assertEqual(mock_run.call_count, 1)
+
+        self.assertEqual(self.client.get(f'/api/mesh/{"0" * 64}/fine').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/mesh/{key}/huge').status_code, 404)
+        self.assertEqual(glob.glob(os.path.join(tempfile.gettempdir(), 'preview_box_*')), [])
+
+    def test_plain_preview_bypasses_cache(self):
+        with patch.object(app_module, 'mesh_cache', self.cache), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=self.fake_run) as mock_run:
+            response = self.client.post('/api/preview_box', json={'width': 4})
+            self.assertEqual(response.data, b'fine')
+            self.assertNotIn('X-Mesh-Key', response.headers)
+            self.assertNotIn('lods', mock_run.call_args.kwargs['kwargs'])
+            self.assertEqual(self.cache.stats()['entries'], 0)
+
+            self.assertEqual(self.client.post('/api/preview_box?lod=huge', json={'width': 4}).status_code, 400)
+
+class ArtifactCachingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = MeshCache(self.tmp.name)
+        self.client = app_module.app.test_client()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fake_run(self, task, kwargs, timeout, cancel=None, worker=None):
+        with open(kwargs['output_path'], 'w') as f:
+            f.write(kwargs['format'])
+        return {'x': 42, 'y': 42, 'z': 7}
+
+    def test_conditional_requests_skip_generation(self):
+        with patch.object(app_module, 'mesh_cache', self.cache), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=self.fake_run) as mock_run:
+            first = self.client.post('/api/preview_box', json={'width': 2})
+            again = self.client.post('/api/preview_box', json={'width': '2.0', 'height': 1})
+            self.assertEqual(first.headers['ETag'], again.headers['ETag'])
+            self.assertEqual(mock_run.call_count, 2)
+
+            # A POST with a matching If-None-Match fails its precondition (304 is for GET and HEAD)
+            response = self.client.post('/api/preview_box', json={'width': 2}, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(response.status_code, 412)
+            self.assertEqual(response.headers['ETag'], first.headers['ETag'])
+            self.assertEqual(mock_run.call_count, 2)
+            other = self.client.post('/api/preview_box', json={'width': 3}, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(other.status_code, 200)
+
+    def test_downloads_are_addressable_artifacts(self):
+        with patch.object(app_module, 'mesh_cache', self.cache), \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=self.fake_run) as mock_run:
+            first = self.client.post('/api/download_box', data={'width': '2', 'format': 'step'})
+            again = self.client.post('/api/download_box', data={'width': '2', 'format': 'step'})
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertEqual(again.data, b'step')
+            self.assertIn('attachment', again.headers['Content-Disposition'])
+            self.assertEqual(first.headers['ETag'], again.headers['ETag'])
+            location = first.headers['Content-Location']
+            self.assertRegex(location, r'^/artifacts/[0-9a-f]{64}\.step$')
+
+            artifact = self.client.get(location)
+            self.assertEqual(artifact.data, b'step')
+            self.assertEqual(artifact.headers['ETag'], first.headers['ETag'])
+            self.assertTrue(artifact.cache_control.immutable)
+            self.assertEqual(artifact.cache_control.max_age, app_module.ARTIFACT_MAX_AGE)
+            self.assertEqual(self.client.get(location, headers={'If-None-Match': artifact.headers['ETag']}).status_code, 304)
+
+            # The STL download and the fine preview mesh are the same artifact
+            stl = self.client.post('/api/download_box', data={'width': '2', 'format': 'stl'})
+            self.assertEqual(self.client.get(stl.headers['Content-Location']).data, b'stl')
+
+            missing = self.client.get(location.replace('.step', '.coarse.step'))
+            self.assertEqual(missing.status_code, 404)
+            self.assertEqual(missing.headers['Cache-Control'], 'no-store')
+            self.assertEqual(self.client.get(f'/artifacts/{"0" * 64}.stl').status_code, 404)
+            self.assertEqual(self.client.post('/api/download_box', data={'format': 'obj'}).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
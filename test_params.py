@@ -0,0 +1,82 @@
+import unittest
+import pickle
+from unittest.mock import patch
+
+import params
+from params import InvalidParams, Params, parse_params
+from coalescing import flight_key
+from mesh_cache import MeshCache
+import app as app_module
+
+class ParamsTestCase(unittest.TestCase):
+    def test_equivalent_requests_have_one_key(self):
+        variants = [
+            {'width': 2, 'length': '3', 'solid': False},
+            {'width': '2', 'length': 3.0, 'solid': 'false', 'unknown': 1},
+            {'width': 2.0, 'length': 3, 'height': '', 'solid': ''},
+        ]
+        parsed = [parse_params('box', v) for v in variants]
+        self.assertEqual(len({p.key for p in parsed}), 1)
+        self.assertEqual(len(set(parsed)), 1)
+        self.assertEqual(dict(parsed[0]), {'width': 2, 'length': 3, 'height': 1, 'solid': False})
+        self.assertEqual(len({flight_key('box', p, {}, 'stl') for p in parsed}), 1)
+
+    def test_floats_are_quantized(self):
+        a = parse_params('gear', {'module': 1.00001, 'gear_type': 'Helical', 'helix_angle': 14.999})
+        b = parse_params('gear', {'module': '1', 'gear_type': 'helical', 'helix_angle': 15})
+        self.assertEqual(a.key, b.key)
+        self.assertEqual(a['helix_angle'], 15.0)
+        with patch.object(params, 'QUANTUM', 0):
+            self.assertEqual(parse_params('gear', {'module': 1.00001})['module'], 1.00001)
+        params.configure_params({'PARAM_QUANTUM': '0.5'})
+        try:
+            self.assertEqual(parse_params('hinge', {'clearance': 0.7})['clearance'], 0.5)
+        finally:
+            params.configure_params({})
+
+    def test_invalid_values_are_reported_per_field(self):
+        with self.assertRaises(InvalidParams) as ctx:
+            parse_params('box', {'width': 2.5, 'length': 0, 'height': 'tall', 'solid': 'maybe'})
+        self.assertEqual([e['field'] for e in ctx.exception.errors], ['width', 'length', 'height', 'solid'])
+        with self.assertRaises(InvalidParams):
+            parse_params('gear', {'shaft_type': 'square'})
+        with self.assertRaises(InvalidParams):
+            parse_params('hinge', {'length': float('nan')})
+        with self.assertRaises(InvalidParams):
+            parse_params('hinge', [1, 2])
+
+    def test_params_are_immutable_and_picklable(self):
+        p = parse_params('hinge', {'length': 50})
+        with self.assertRaises(AttributeError):
+            p.generator = 'gear'
+        with self.assertRaises(TypeError):
+            p['length'] = 60
+        self.assertEqual(pickle.loads(pickle.dumps(p)), p)
+        self.assertIs(parse_params('hinge', p), p)
+        self.assertIsInstance(p, Params)
+
+class ParamsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app_module.app.test_client()
+
+    def test_preview_and_download_share_params(self):
+        with patch.object(app_module, 'mesh_cache', MeshCache('unused', max_bytes=0)), \
+             patch.object(app_module, 'run_task_with_timeout', return_value={'x': 1, 'y': 1, 'z': 1}) as mock_run:
+            self.client.post('/api/generate_box_info', json={'width': '2', 'length': 1, 'solid': 'true'})
+            self.client.post('/api/download_box', data={'width': '2', 'length': '1', 'solid': 'true'})
+        info, download = (call.kwargs['kwargs']['params'] for call in mock_run.call_args_list)
+        self.assertEqual(info.key, download.key)
+        self.assertIs(info['solid'], True)
+
+    def test_invalid_params_are_rejected_before_dispatch(self):
+        with patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            response = self.client.post('/api/preview_gear', json={'teeth': 2, 'gear_type': 'worm'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual({e['field'] for e in response.get_json()['errors']}, {'teeth', 'gear_type'})
+            response = self.client.post('/api/download_hinge', data={'pin_diam': 'wide'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(b'pin_diam', response.data)
+            mock_run.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+
+import cadquery as cq
+
+from part_export import STL_HEADER, TIMESTAMP, export_step, export_stl
+from shape_store import ShapeStore
+
+def make_part():
+    return cq.Workplane("XY").box(20, 10, 5).edges("|Z").fillet(2).faces(">Z").hole(3).val()
+
+# Exports a hinge (three solids, so an assembly of products) in a fresh process
+EXPORT_HINGE = """
+import sys
+import generation_utils
+generation_utils.generate_hinge_task({}, {}, sys.argv[1], 'step')
+generation_utils.generate_hinge_task({}, {}, sys.argv[2], 'stl')
+"""
+
+class PartExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_step_is_identical_across_exports(self):
+        shape = make_part()
+        export_step(shape, self.path('a.step'), 'part')
+        # Another exporter changing the process-wide STEP settings in between
+        shape.exportStep(self.path('other.step'))
+        export_step(shape, self.path('b.step'), 'part')
+        self.assertEqual(self.read('a.step'), self.read('b.step'))
+
+        step = self.read('a.step').decode()
+        self.assertIn(f"FILE_NAME('part','{TIMESTAMP}'", step)
+        self.assertIn("PRODUCT('part','part'", step)
+        self.assertNotIn('-0.,', step)
+
+    def test_step_of_stored_shape_matches_built_shape(self):
+        shape = make_part()
+        store = ShapeStore(self.tmp.name)
+        store.put('part', 1, shape)
+        export_step(shape, self.path('built.step'), 'part')
+        export_step(ShapeStore(self.tmp.name).get('part', 1), self.path('loaded.step'), 'part')
+        self.assertEqual(self.read('built.step'), self.read('loaded.step'))
+
+    def test_stl_is_identical_across_exports(self):
+        shape = make_part()
+        export_stl(shape, self.path('a.stl'), 0.01, 0.1)
+        # A finer triangulation left on the shape by an earlier export is not reused
+        shape.exportStl(self.path('fine.stl'), 0.001)
+        export_stl(shape, self.path('b.stl'), 0.01, 0.1)
+        self.assertEqual(self.read('a.stl'), self.read('b.stl'))
+        self.assertEqual(self.read('a.stl')[:80], STL_HEADER)
+
+    def test_generator_output_is_identical_across_processes(self):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        for run in ('a', 'b'):
+            subprocess.run([sys.executable, '-c', EXPORT_HINGE, self.path(f'{run}.step'), self.path(f'{run}.stl')],
+                           env=env, check=True, capture_output=True)
+        self.assertEqual(self.read('a.step'), self.read('b.step'))
+        self.assertEqual(self.read('a.stl'), self.read('b.stl'))
+        step = self.read('a.step').decode()
+        self.assertIn("PRODUCT('hinge.1','hinge.1'", step)
+        self.assertIn("NEXT_ASSEMBLY_USAGE_OCCURRENCE('1'", step)
+
+if __name__ == '__main__':
+    unittest.main()
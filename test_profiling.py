@@ -0,0 +1,119 @@
+import unittest
+import os
+import json
+import pstats
+import tempfile
+from unittest.mock import patch
+
+import profiling
+from task_runner import run_task_with_timeout
+import app as app_module
+
+def busy_task(params):
+    return sum(i * i for i in range(200000))
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = patch.dict('os.environ', {'PROFILE_DIR': self.tmpdir.name})
+        self.env.start()
+        token = patch.object(app_module, 'ADMIN_TOKEN', 'secret')
+        token.start()
+        self.addCleanup(token.stop)
+        self.admin = {'X-Admin-Token': 'secret'}
+        self.app = app_module.app.test_client()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmpdir.cleanup()
+        profiling.PROFILING.update(enabled=False, sample_rate=0)
+
+    def test_worker_writes_profile(self):
+        token = profiling.activate('req123')
+        try:
+            run_task_with_timeout(busy_task, kwargs={'params': {'teeth': 20}}, timeout=30)
+        finally:
+            profiling.deactivate(token)
+
+        stats = pstats.Stats(profiling.profile_path('req123', 'pstats'))
+        self.assertTrue(any(func[2] == 'busy_task' for func in stats.stats))
+        with open(profiling.profile_path('req123', 'collapsed')) as f:
+            self.assertIn('busy_task', f.read())
+
+        meta = profiling.list_profiles()[0]
+        self.assertEqual(meta['id'], 'req123')
+        self.assertEqual(meta['task'], 'busy_task')
+        self.assertEqual(meta['params'], {'teeth': 20})
+
+    def test_unprofiled_task_writes_nothing(self):
+        run_task_with_timeout(busy_task, kwargs={'params': {}}, timeout=30)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_header_enables_profiling(self):
+        seen = []
+        def fake_run(*args, **kwargs):
+            seen.append(profiling.current_profile())
+            return {'x': 1, 'y': 1, 'z': 1}
+
+        with patch.object(app_module, 'run_task_with_timeout', side_effect=fake_run):
+            response = self.app.post('/api/generate_box_info', json={'width': 1},
+                                     headers={'X-Profile': '1', 'X-Request-ID': 'abc-1'})
+            self.app.post('/api/generate_box_info', json={'width': 1})
+
+        # The id is the server's own, never the client's request id
+        profile_id = response.headers['X-Profile-Id']
+        self.assertNotEqual(profile_id, 'abc-1')
+        self.assertEqual(response.headers['X-Request-ID'], 'abc-1')
+        self.assertEqual(seen, [(profile_id, self.tmpdir.name), None])
+
+    def test_coalesced_followers_have_no_profile(self):
+        with patch.object(app_module, 'coalescer') as coalescer:
+            coalescer.run.return_value = {'x': 1, 'y': 1, 'z': 1}
+            response = self.app.post('/api/generate_box_info', json={'width': 1}, headers={'X-Profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+    def test_sampling(self):
+        profiling.PROFILING['sample_rate'] = 3
+        picked = [profiling.should_profile({}) for _ in range(9)]
+        self.assertEqual(picked.count(True), 3)
+
+    def test_admin_endpoints(self):
+        response = self.app.post('/admin/profiling', json={'enabled': True}, headers=self.admin)
+        self.assertTrue(json.loads(response.data)['profiling']['enabled'])
+        for rate in ('abc', None, [1], 1.5, True):
+            response = self.app.post('/admin/profiling', json={'sample_rate': rate}, headers=self.admin)
+            self.assertEqual(response.status_code, 400, rate)
+            self.assertIn('sample_rate', response.get_json()['error'])
+        response = self.app.post('/admin/profiling', json={'sample_rate': '4'}, headers=self.admin)
+        self.assertEqual(response.get_json()['profiling']['sample_rate'], 4)
+
+        token = profiling.activate('req456')
+        try:
+            run_task_with_timeout(busy_task, kwargs={'params': {}}, timeout=30)
+        finally:
+            profiling.deactivate(token)
+
+        self.assertEqual(self.app.get('/admin/profiles?limit=all', headers=self.admin).status_code, 400)
+        data = json.loads(self.app.get('/admin/profiles?limit=5', headers=self.admin).data)
+        self.assertEqual([p['id'] for p in data['profiles']], ['req456'])
+
+        response = self.app.get(data['profiles'][0]['files']['collapsed'], headers=self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.get('/admin/profiles/nope.pstats', headers=self.admin).status_code, 404)
+
+    def test_admin_endpoints_are_closed_without_a_token(self):
+        self.assertEqual(self.app.get('/admin/profiles', headers={'X-Admin-Token': 'guess'}).status_code, 403)
+        with patch.object(app_module, 'ADMIN_TOKEN', None):
+            self.assertEqual(self.app.get('/admin/profiles').status_code, 403)
+            self.assertEqual(self.app.get('/admin/profiles', headers={'X-Admin-Token': ''}).status_code, 403)
+
+    def test_prune_keeps_most_recent(self):
+        for i in range(3):
+            with open(os.path.join(self.tmpdir.name, f'p{i}.json'), 'w') as f:
+                json.dump({'id': f'p{i}', 'created': i}, f)
+        profiling.prune_profiles(keep=1)
+        self.assertEqual([p['id'] for p in profiling.list_profiles()], ['p2'])
+
+if __name__ == '__main__':
+    unittest.main()
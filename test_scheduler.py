@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch
+
+from scheduler import Scheduler, CostModel, estimate_cost, INTERACTIVE, BATCH
+import app as app_module
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(interactive_slots=2, batch_slots=1, heavy_seconds=20.0,
+                                   timeout_factor=4.0, min_timeout=30, max_timeout=600)
+
+    def test_cost_grows_with_params(self):
+        self.assertGreater(estimate_cost('baseplate', {'width': 10, 'length': 10}),
+                           estimate_cost('baseplate', {'width': 1, 'length': 1}))
+        self.assertGreater(estimate_cost('gear', {'teeth': 20, 'gear_type': 'herringbone'}),
+                           estimate_cost('gear', {'teeth': 20, 'gear_type': 'spur'}))
+        self.assertGreater(estimate_cost('hinge', {'length': 200}), estimate_cost('hinge', {'length': 40}))
+        # Raw JSON params may be strings or garbage
+        self.assertEqual(estimate_cost('box', {'width': '2', 'length': 2, 'height': 'x'}),
+                         estimate_cost('box', {'width': 2, 'length': 2, 'height': 1}))
+
+    def test_lanes(self):
+        self.assertEqual(self.scheduler.plan('box', {'width': 1, 'length': 1}, 'preview').lane, INTERACTIVE)
+        self.assertEqual(self.scheduler.plan('box', {'width': 1, 'length': 1}, 'download').lane, BATCH)
+        self.assertEqual(self.scheduler.plan('baseplate', {'width': 10, 'length': 10}, 'preview').lane, BATCH)
+
+    def test_timeout_scales_with_cost(self):
+        small = self.scheduler.plan('baseplate', {'width': 1, 'length': 1}, 'preview')
+        large = self.scheduler.plan('baseplate', {'width': 10, 'length': 10}, 'preview')
+        huge = self.scheduler.plan('gear', {'teeth': 200, 'gear_type': 'herringbone'}, 'download')
+        self.assertEqual(small.timeout, 30)
+        self.assertGreater(large.timeout, small.timeout)
+        self.assertEqual(huge.timeout, 600)
+
+    def test_learns_from_timings(self):
+        model = CostModel(rates={'hinge': 0.05}, startup=3.0, alpha=0.5)
+        model.record('hinge', 10, 'preview', 3.0 + 10 * 0.25)
+        self.assertAlmostEqual(model.rates['hinge'], 0.15)
+        self.assertEqual(model.samples['hinge'], 1)
+
+    def test_release_records_duration(self):
+        job = self.scheduler.plan('hinge', {'length': 40}, 'preview')
+        before = self.scheduler.costs.rates['hinge']
+        self.scheduler.acquire(job, 'c')
+        self.scheduler.release(job, 'c', duration=60.0)
+        self.assertGreater(self.scheduler.costs.rates['hinge'], before)
+        self.assertEqual(self.scheduler.lanes[INTERACTIVE].stats()['running'], 0)
+
+    def test_timed_out_jobs_are_not_learned_from(self):
+        job = self.scheduler.plan('hinge', {'length': 40}, 'preview')
+        before = self.scheduler.costs.rates['hinge']
+        self.scheduler.acquire(job, 'c')
+        self.scheduler.release(job, 'c', duration=job.timeout, timed_out=True)
+        self.assertEqual(self.scheduler.costs.rates['hinge'], before)
+        self.assertNotIn('hinge', self.scheduler.costs.samples)
+
+    def test_slots_never_exceed_the_total(self):
+        for total in (1, 2, 3, 8):
+            scheduler = Scheduler.from_env({'ADMISSION_MAX_CONCURRENT': str(total), 'SCHEDULER_BATCH_SHARE': '0.9'})
+            self.assertEqual(sum(lane.max_concurrent for lane in scheduler.lanes.values()), total)
+            self.assertGreaterEqual(scheduler.lanes[INTERACTIVE].max_concurrent, 1)
+        # One slot: downloads share it with previews
+        single = Scheduler.from_env({'ADMISSION_MAX_CONCURRENT': '1'})
+        self.assertEqual(list(single.lanes), [INTERACTIVE])
+        self.assertEqual(single.plan('box', {'width': 1, 'length': 1}, 'download').lane, INTERACTIVE)
+
+    def test_route_uses_planned_timeout(self):
+        expected = self.scheduler.plan('baseplate', {'width': 10, 'length': 10}, 'info').timeout
+        with patch.object(app_module, 'scheduler', self.scheduler), \
+             patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            mock_run.return_value = {'x': 1, 'y': 1, 'z': 1}
+            app_module.app.test_client().post('/api/generate_baseplate_info', json={'width': 10, 'length': 10})
+        self.assertEqual(mock_run.call_args.kwargs['timeout'], expected)
+
+    def test_failed_generations_are_not_learned_from(self):
+        client = app_module.app.test_client()
+        with patch.object(app_module, 'scheduler', self.scheduler), \
+             patch.object(app_module, 'failures') as failures, \
+             patch.object(app_module, 'run_task_with_timeout', side_effect=ValueError('Walls too thin')):
+            failures.get.return_value = None
+            response = client.post('/api/generate_baseplate_info', json={'width': 9, 'length': 9})
+            self.assertGreaterEqual(response.status_code, 400)
+            with patch.object(app_module, 'run_task_with_timeout', side_effect=TimeoutError('too slow')):
+                client.post('/api/generate_baseplate_info', json={'width': 9, 'length': 9})
+        self.assertNotIn('baseplate', self.scheduler.costs.samples)
+        self.assertEqual(self.scheduler.lanes[BATCH].stats()['running'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+
+import cadquery as cq
+
+import shape_store
+from shape_store import ShapeStore
+from stage_cache import StageCache
+
+def make_box(size):
+    return cq.Workplane("XY").box(size, size, size).edges("|Z").fillet(size / 4).val()
+
+class ShapeStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ShapeStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip_between_stores(self):
+        shape = make_box(10)
+        self.store.put('box', (10, 'mm'), shape)
+        # Another worker process opens the same directory
+        loaded = ShapeStore(self.tmp.name).get('box', (10, 'mm'))
+        self.assertAlmostEqual(loaded.Volume(), shape.Volume(), places=6)
+        self.assertEqual(loaded.ShapeType(), shape.ShapeType())
+        self.assertIsNone(self.store.get('box', (11, 'mm')))
+
+    def test_new_generator_version_misses(self):
+        self.store.put('box', 10, make_box(10))
+        with patch.object(shape_store, 'ARTIFACT_VERSION', shape_store.ARTIFACT_VERSION + 1):
+            self.assertIsNone(self.store.get('box', 10))
+        self.assertIsNotNone(self.store.get('box', 10))
+
+    def test_corrupt_file_is_removed(self):
+        self.store.put('box', 10, make_box(10))
+        path = self.store.path_for('box', 10)
+        with open(path, 'r+b') as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b'garbage!!!')
+        self.assertIsNone(self.store.get('box', 10))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.store.stats()['corrupt'], 1)
+
+        open(path, 'wb').close()
+        self.assertIsNone(self.store.get('box', 10))
+        self.assertEqual(self.store.stats()['corrupt'], 2)
+
+    def test_least_recently_used_files_are_evicted(self):
+        for size in (10, 11, 12):
+            self.store.put('box', size, make_box(size))
+            os.utime(self.store.path_for('box', size), (size, size))
+        self.store.get('box', 10)  # refreshes its mtime
+        self.store.max_bytes = os.path.getsize(self.store.path_for('box', 10)) * 2 + 100
+        self.store.put('box', 13, make_box(13))
+
+        self.assertIsNotNone(self.store.get('box', 10))
+        self.assertIsNone(self.store.get('box', 11))
+        self.assertIsNone(self.store.get('box', 12))
+        self.assertEqual(self.store.stats()['evictions'], 2)
+        self.assertEqual(self.store.stats()['entries'], 2)
+
+    def test_stage_cache_falls_back_to_store(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return make_box(10)
+
+        StageCache(store=self.store).get_or_build('box', 10, build)
+        shape = StageCache(store=self.store).get_or_build('box', 10, build)
+        self.assertEqual(len(builds), 1)
+        self.assertAlmostEqual(shape.Volume(), make_box(10).Volume(), places=6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import multiprocessing
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import task_runner
+import app as app_module
+
+class StartMethodTestCase(unittest.TestCase):
+    def test_start_method_from_env(self):
+        self.assertEqual(task_runner.start_method({'WORKER_START_METHOD': 'spawn'}), 'spawn')
+        default = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.assertEqual(task_runner.start_method({}), default)
+        with self.assertRaises(ValueError):
+            task_runner.start_method({'WORKER_START_METHOD': 'thread'})
+
+    def test_preload_modules_from_env(self):
+        self.assertEqual(task_runner.preload_modules({}), task_runner.DEFAULT_PRELOAD)
+        self.assertEqual(task_runner.preload_modules({'WORKER_PRELOAD': 'cadquery, OCP,'}), ['cadquery', 'OCP'])
+        self.assertEqual(task_runner.preload_modules({'WORKER_PRELOAD': ''}), [])
+
+    def test_self_test_reports_worker_start(self):
+        report = task_runner.self_test(modules=['json', 'no_such_module'])
+        self.assertEqual(report['start_method'], task_runner.mp_context().get_start_method())
+        self.assertGreaterEqual(report['task_start_seconds'], 0)
+        self.assertIsNone(report['import_seconds']['no_such_module'])
+        self.assertGreaterEqual(report['import_seconds']['json'], 0)
+
+    def test_admin_shows_worker_report(self):
+        with patch.dict(app_module.worker_self_test, {'task_start_seconds': 0.05}), \
+             patch.object(app_module, 'ADMIN_TOKEN', 'secret'):
+            response = app_module.app.test_client().get('/admin/scheduler', headers={'X-Admin-Token': 'secret'})
+        workers = response.get_json()['workers']
+        self.assertEqual(workers['start_method'], task_runner.mp_context().get_start_method())
+        self.assertEqual(workers['task_start_seconds'], 0.05)
+
+class TaskReferenceTestCase(unittest.TestCase):
+    def test_task_by_reference(self):
+        self.assertEqual(task_runner.run_task_with_timeout('json:dumps', args=([1],), timeout=30), '[1]')
+        with self.assertRaises(ImportError):
+            task_runner.run_task_with_timeout('no_such_module:task', timeout=30)
+
+    def test_app_does_not_import_cad_stack(self):
+        code = "import sys, app; print(sorted({'cadquery', 'OCP', 'generation_utils'} & set(sys.modules)))"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                                env={**os.environ, 'WORKER_SELF_TEST': '0'})
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+import json
+import threading
+import time
+from unittest.mock import patch
+
+import tracing
+from task_runner import run_task_with_timeout
+import app as app_module
+
+def traced_task(x):
+    with tracing.span("generate.build", tracing.param_attributes('test', {'x': x})):
+        return x * 2
+
+class TracingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.exporter = tracing.MemoryExporter()
+        tracing.set_exporter(self.exporter)
+
+    def tearDown(self):
+        tracing.set_exporter(None)
+
+    def spans_by_name(self):
+        return {s.name: s for s in self.exporter.spans}
+
+    def test_nested_spans_share_trace(self):
+        with tracing.span("parent") as parent:
+            with tracing.span("child") as child:
+                pass
+        self.assertEqual(child.trace_id, parent.trace_id)
+        self.assertEqual(child.parent_id, parent.span_id)
+        self.assertIsNone(parent.parent_id)
+        self.assertEqual([s.name for s in self.exporter.spans], ["child", "parent"])
+
+    def test_remote_parent_from_traceparent(self):
+        header = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        with tracing.span("request", traceparent=header) as s:
+            pass
+        self.assertEqual(s.trace_id, "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(s.parent_id, "b7ad6b7169203331")
+        self.assertIsNone(tracing.parse_traceparent("garbage"))
+
+    def test_error_status_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError("boom")
+        self.assertEqual(self.exporter.spans[0].status, tracing.STATUS_ERROR)
+
+    def test_context_crosses_process_boundary(self):
+        with tracing.span("request") as root:
+            result = run_task_with_timeout(traced_task, args=(21,), timeout=30)
+        self.assertEqual(result, 42)
+
+        spans = self.spans_by_name()
+        dispatch = spans["worker.dispatch"]
+        run = spans["worker.run"]
+        build = spans["generate.build"]
+        self.assertEqual(dispatch.parent_id, root.span_id)
+        self.assertEqual(run.parent_id, dispatch.span_id)
+        self.assertEqual(spans["worker.startup"].parent_id, run.span_id)
+        self.assertEqual(build.parent_id, run.span_id)
+        self.assertEqual(build.trace_id, root.trace_id)
+        self.assertEqual(build.attributes, {"generator": "test", "params.x": 21})
+
+    def test_collected_spans_stay_in_their_context(self):
+        seen = {}
+
+        def other_thread():
+            with tracing.span("elsewhere"):
+                pass
+            seen["exported"] = [s.name for s in self.exporter.spans]
+
+        with tracing.collect_spans() as spans:
+            with tracing.span("collected"):
+                pass
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+        self.assertEqual([s["name"] for s in spans], ["collected"])
+        self.assertEqual(seen["exported"], ["elsewhere"])
+
+    def test_batch_exporter_needs_write(self):
+        with self.assertRaises(TypeError):
+            tracing.BatchExporter()
+
+    def test_batch_exporter_flushes_a_trickle(self):
+        class Recorder(tracing.BatchExporter):
+            def __init__(self):
+                self.written = []
+                super().__init__(batch_size=1000, flush_interval=0.2)
+
+            def write(self, payload):
+                self.written.append(time.monotonic())
+
+        with tracing.span("s") as s:
+            pass
+        exporter = Recorder()
+        self.addCleanup(exporter.shutdown)
+        start = time.monotonic()
+        # A span every 50ms, well within flush_interval of the one before
+        while time.monotonic() - start < 0.8:
+            exporter.export(s)
+            time.sleep(0.05)
+        self.assertGreaterEqual(len(exporter.written), 2)
+        self.assertLess(exporter.written[0] - start, 0.5)
+
+    def test_otlp_round_trip(self):
+        with tracing.span("s", {"a": 1, "b": "two", "c": True, "d": 1.5}) as s:
+            pass
+        restored = tracing.Span.from_otlp(json.loads(json.dumps(s.to_otlp())))
+        self.assertEqual(restored.span_id, s.span_id)
+        self.assertEqual(restored.attributes["b"], "two")
+        self.assertEqual(restored.end_ns, s.end_ns)
+
+    def test_request_span_in_flask(self):
+
+        with patch.object(app_module, 'run_task_with_timeout') as mock_run:
+            mock_run.return_value = {'x': 1, 'y': 1, 'z': 1}
+            response = app_module.app.test_client().post('/api/generate_box_info', json={'width': 1})
+
+        self.assertEqual(response.status_code, 200)
+        request_span = self.spans_by_name()["POST /api/generate_box_info"]
+        self.assertEqual(response.headers['X-Trace-Id'], request_span.trace_id)
+        self.assertEqual(request_span.attributes["http.status_code"], 200)
+
+if __name__ == '__main__':
+    unittest.main()
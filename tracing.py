@@ -0,0 +1,363 @@
+"""
+Lightweight request tracing.
+
+Spans use W3C trace context ids and are exported in the OTLP/JSON span format, so the
+output can be fed to any OpenTelemetry collector (or just read from a local file).
+
+Configuration (environment):
+    TRACING_EXPORTER  none (default) | file | otlp
+    TRACING_FILE      path for the file exporter (default: traces.jsonl)
+    OTLP_ENDPOINT     collector URL for the otlp exporter (default: http://localhost:4318/v1/traces)
+"""
+import abc
+import atexit
+import contextvars
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+SERVICE_NAME = "opengridgen"
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# When set (inside worker processes) finished spans are collected here instead of exported
+_collected = contextvars.ContextVar("collected_spans", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def end(self, end_ns=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        _finish(self)
+
+    @property
+    def duration(self):
+        """Duration in seconds (None while the span is open)."""
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e9
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+    @classmethod
+    def from_otlp(cls, data):
+        span = cls(data["name"], data["traceId"], data.get("parentSpanId"), start_ns=int(data["startTimeUnixNano"]))
+        span.span_id = data["spanId"]
+        span.end_ns = int(data["endTimeUnixNano"])
+        span.attributes = {a["key"]: _otlp_value(a["value"]) for a in data["attributes"]}
+        span.status = data["status"]["code"]
+        span.status_message = data["status"].get("message", "")
+        return span
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_value(value):
+    if "intValue" in value:
+        return int(value["intValue"])
+    return list(value.values())[0]
+
+
+def parse_traceparent(header):
+    """
+    Parse a W3C traceparent header into (trace_id, span_id), or None if it is malformed.
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_traceparent():
+    span = _current_span.get()
+    return span.traceparent if span else None
+
+
+def start_span(name, attributes=None, traceparent=None, start_ns=None):
+    """
+    Start a span as a child of the current span, or of the remote parent given by traceparent.
+    The caller is responsible for ending it; prefer the span() context manager.
+    """
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent)
+    if remote:
+        trace_id, parent_id = remote
+    elif parent:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+    return Span(name, trace_id, parent_id, attributes, start_ns)
+
+
+def activate(span):
+    """Make span the current span. Returns a token for deactivate()."""
+    return _current_span.set(span)
+
+
+def deactivate(token):
+    _current_span.reset(token)
+
+
+@contextmanager
+def span(name, attributes=None, traceparent=None, start_ns=None):
+    s = start_span(name, attributes, traceparent, start_ns)
+    token = activate(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        deactivate(token)
+        s.end()
+
+
+def param_attributes(generator, params):
+    """Span attributes for a generator and its normalized params."""
+    attrs = {"generator": generator}
+    for key, value in params.items():
+        attrs[f"params.{key}"] = value
+    return attrs
+
+
+@contextmanager
+def collect_spans():
+    """
+    Collect spans finished inside the block instead of exporting them.
+    Used in worker processes, which send their spans back to the parent for export.
+    """
+    spans = []
+    token = _collected.set(spans)
+    try:
+        yield spans
+    finally:
+        _collected.reset(token)
+
+
+def export_collected(spans):
+    """Export spans (as OTLP dicts) collected in another process."""
+    for data in spans:
+        _finish(Span.from_otlp(data), collect=False)
+
+
+def _finish(span, collect=True):
+    collected = _collected.get() if collect else None
+    if collected is not None:
+        collected.append(span.to_otlp())
+        return
+    exporter = get_exporter()
+    if exporter is not None:
+        exporter.export(span)
+
+
+class MemoryExporter:
+    """Keeps finished spans in memory, for tests."""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def shutdown(self):
+        pass
+
+
+class BatchExporter(abc.ABC):
+    """
+    Exports spans in OTLP/JSON batches from a background thread, so tracing never adds
+    file or network latency to a request. Subclasses implement write().
+    """
+
+    def __init__(self, batch_size=64, flush_interval=1.0, queue_size=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        # A batch is written once full, or flush_interval after its first span: a steady
+        # trickle of spans must not hold the first ones back indefinitely
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                span = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                span = False
+            if span is None:
+                break
+            if span:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(span)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+                deadline = None
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.write(otlp_payload(batch))
+        except Exception:
+            self.dropped += len(batch)
+
+    @abc.abstractmethod
+    def write(self, payload):
+        """Send one OTLP/JSON export request; raising drops the batch."""
+
+    def shutdown(self):
+        self.queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class FileExporter(BatchExporter):
+    """Appends one OTLP/JSON export request per line, like the collector's file exporter."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        super().__init__(**kwargs)
+
+    def write(self, payload):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(payload) + "\n")
+
+
+class OTLPHttpExporter(BatchExporter):
+    """Posts OTLP/JSON export requests to a collector's /v1/traces endpoint."""
+
+    def __init__(self, endpoint, timeout=5.0, **kwargs):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.session = requests.Session()
+        super().__init__(**kwargs)
+
+    def write(self, payload):
+        resp = self.session.post(self.endpoint, json=payload, timeout=self.timeout)
+        resp.raise_for_status()
+
+
+def otlp_payload(spans):
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": SERVICE_NAME},
+                "spans": [s.to_otlp() for s in spans],
+            }],
+        }]
+    }
+
+
+_exporter = None
+_exporter_pid = None
+
+
+def exporter_from_env(env=None):
+    env = os.environ if env is None else env
+    kind = env.get("TRACING_EXPORTER", "none").lower()
+    if kind == "file":
+        return FileExporter(env.get("TRACING_FILE", "traces.jsonl"))
+    if kind == "otlp":
+        return OTLPHttpExporter(env.get("OTLP_ENDPOINT", "http://localhost:4318/v1/traces"))
+    return None
+
+
+def set_exporter(exporter):
+    global _exporter, _exporter_pid
+    _exporter = exporter
+    _exporter_pid = os.getpid()
+
+
+def get_exporter():
+    # Exporter threads don't survive fork, never export from a child that inherited one
+    if _exporter_pid != os.getpid():
+        return None
+    return _exporter
+
+
+def configure_tracing(env=None):
+    """Install the exporter described by the environment. Returns it (None if tracing is off)."""
+    exporter = exporter_from_env(env)
+    set_exporter(exporter)
+    if exporter is not None:
+        atexit.register(exporter.shutdown)
+    return exporter
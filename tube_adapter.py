@@ -1,4 +1,5 @@
 import cadquery as cq
+from part_export import export_step, export_stl
 
 class TubeAdapter:
     def __init__(self,
@@ -111,8 +112,8 @@ class TubeAdapter:
 
     def save_step_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStep(filename)
+        export_step(self.cq_obj.val(), filename, 'tube_adapter')
 
     def save_stl_file(self, filename):
         if not self.cq_obj: self.render()
-        self.cq_obj.val().exportStl(filename)
+        export_stl(self.cq_obj.val(), filename, 1e-3, 0.1, relative=True)
@@ -0,0 +1,191 @@
+"""
+Generation worker daemon: python -m worker
+
+Claims jobs from JOB_QUEUE (see job_queue.py) and runs each one like the web server
+runs a local generation: in a worker process from task_runner, with the job's timeout.
+While a job runs, the daemon sends heartbeats and stops the job when it was cancelled.
+The generated files go to the artifact store (the mesh cache, and with CACHE_BACKEND
+the backend shared with the web servers), named by the job's artifact key; the job's
+result is the part's dimensions, and it records the address of the files
+(/artifacts/<key>.<format>).
+
+Run one daemon per machine with as many concurrent jobs as it has cores for. The
+daemon exits on SIGTERM or Ctrl-C after cancelling its running jobs, which then go back
+to the queue. The web server can also run workers itself (JOB_LOCAL_WORKERS).
+
+Configuration (environment, besides JOB_QUEUE and the cache settings):
+    WORKER_CONCURRENCY   jobs run at once (default: number of CPUs)
+    WORKER_ID            name of the daemon in the queue (default: host name and process id)
+    WORKER_POLL_SECONDS  how often an idle daemon looks for jobs (default: 0.5)
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+import uuid
+
+import task_runner
+from cancellation import Cancelled, CancelToken
+from generators import lod_path
+from job_queue import queue_from_env
+from mesh_cache import MeshCache
+
+logger = logging.getLogger("worker")
+
+SHUTDOWN = "worker shutdown"
+# Artifact variant of each export format (see mesh_cache.VARIANTS)
+FORMAT_VARIANTS = {'stl': 'fine', 'step': 'step'}
+
+
+def output_files(output_path, format, lods=()):
+    """{variant: path} of the files a generation task writes to output_path."""
+    if not output_path:
+        return {}
+    files = {FORMAT_VARIANTS[format]: output_path}
+    files.update({lod: lod_path(output_path, lod) for lod in lods})
+    return files
+
+
+class Worker:
+    def __init__(self, queue, artifacts, worker_id=None, concurrency=None, poll_seconds=0.5):
+        self.queue = queue
+        self.artifacts = artifacts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.poll_seconds = poll_seconds
+        self.stopping = threading.Event()
+        self._running = {}  # job id: cancel token
+        self._lock = threading.Lock()
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        queue = queue_from_env(env)
+        if queue is None:
+            raise SystemExit("Set JOB_QUEUE to the queue of the web servers (see job_queue.py)")
+        artifacts = MeshCache.from_env(env)
+        if not artifacts.enabled:
+            raise SystemExit("Workers deliver files through the mesh cache: MESH_CACHE_MAX_MB must not be 0")
+        concurrency = int(env["WORKER_CONCURRENCY"]) if env.get("WORKER_CONCURRENCY") else None
+        return cls(queue, artifacts, worker_id=env.get("WORKER_ID"), concurrency=concurrency,
+                   poll_seconds=float(env.get("WORKER_POLL_SECONDS", 0.5)))
+
+    def run_job(self, job):
+        """Run a claimed job and report its result; heartbeats stop it when it is cancelled."""
+        cancel = CancelToken()
+        with self._lock:
+            self._running[job.id] = cancel
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.queue.heartbeat_seconds):
+                if not self.queue.heartbeat(job.id, self.worker_id):
+                    cancel.cancel("cancelled")
+
+        heartbeat = threading.Thread(target=beat, name=f"heartbeat-{job.id}", daemon=True)
+        heartbeat.start()
+        kwargs = dict(job.kwargs)
+        timeout = kwargs.pop('timeout')
+        key = kwargs.pop('artifact_key', None)
+        files = {}
+        artifact = None
+        try:
+            if 'format' in kwargs:
+                kwargs['output_path'] = os.path.join(tempfile.gettempdir(), f"job_{job.id}_{uuid.uuid4().hex}.{kwargs['format']}")
+            files = output_files(kwargs.get('output_path'), kwargs.get('format'), kwargs.get('lods', ()))
+            dims = task_runner.run_task_with_timeout(job.task, kwargs=kwargs, timeout=timeout, cancel=cancel)
+            if files:
+                self.artifacts.put(key, {variant: path for variant, path in files.items() if os.path.exists(path)}, dims)
+                artifact = f"/artifacts/{key}.{kwargs['format']}"
+            if self._finish(job, result=dims, artifact=artifact):
+                self.completed += 1
+        except Cancelled as e:
+            # Cancelled by the web server: nothing to report. Shutting down: the job is
+            # retried elsewhere once its heartbeat is stale.
+            logger.info("Job %s stopped (%s)", job.id, e.reason)
+        except Exception as e:
+            logger.warning("Job %s failed: %s", job.id, e)
+            if self._finish(job, error=e):
+                self.failed += 1
+        finally:
+            stopped.set()
+            heartbeat.join()
+            with self._lock:
+                self._running.pop(job.id, None)
+            for path in files.values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _finish(self, job, **outcome):
+        """Report a job's outcome; if the queue is unreachable the job is retried once its heartbeat is stale."""
+        try:
+            self.queue.finish(job.id, self.worker_id, **outcome)
+            return True
+        except Exception as e:
+            logger.warning("Could not report job %s: %s", job.id, e)
+            return False
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.claim(self.worker_id)
+            except Exception as e:
+                logger.warning("Could not claim a job: %s", e)
+                job = None
+            if job is None:
+                self.stopping.wait(self.poll_seconds)
+                continue
+            try:
+                self.run_job(job)
+            except Exception:
+                # Never let one job end this thread: the daemon would run with fewer threads
+                logger.exception("Job %s crashed the worker thread", job.id)
+
+    def start(self, daemon=False):
+        logger.info("Worker %s running %d jobs at once from %s", self.worker_id, self.concurrency,
+                    type(self.queue).__name__)
+        self._threads = [threading.Thread(target=self._loop, name=f"worker-{i}", daemon=daemon)
+                         for i in range(self.concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    def run(self):
+        self.start()
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self):
+        self.stopping.set()
+        with self._lock:
+            for cancel in self._running.values():
+                cancel.cancel(SHUTDOWN)
+
+    def stats(self):
+        with self._lock:
+            return {"id": self.worker_id, "concurrency": self.concurrency, "running": len(self._running),
+                    "completed": self.completed, "failed": self.failed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run generation jobs from JOB_QUEUE.")
+    parser.add_argument("--concurrency", type=int, help="jobs run at once (default: WORKER_CONCURRENCY or CPUs)")
+    args = parser.parse_args(argv)
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    worker = Worker.from_env()
+    if args.concurrency:
+        worker.concurrency = args.concurrency
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: worker.stop())
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()